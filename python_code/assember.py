@@ -1,11 +1,20 @@
 import argparse
-from typing import Optional
+import base64
+import hashlib
+import json
+import os
+import sys
+from array import array
+from typing import BinaryIO, Iterable, Iterator, Optional, TextIO
 
 
 class Instruction:
     def to_binary(self) -> str:
         raise NotImplementedError("Subclasses should implement this method")
 
+    def to_word(self) -> int:
+        raise NotImplementedError("Subclasses should implement this method")
+
 
 class AInstruction(Instruction):
     def __init__(self, value: int) -> None:
@@ -17,12 +26,74 @@ class AInstruction(Instruction):
     def to_binary(self) -> str:
         return f"{self.value:016b}"
 
+    def to_word(self) -> int:
+        return self.value
+
+
+DEST_TABLE = {
+    None: "000",
+    "M": "001",
+    "D": "010",
+    "MD": "011",
+    "A": "100",
+    "AM": "101",
+    "AD": "110",
+    "AMD": "111",
+}
+
+COMP_TABLE = {
+    "0": "0101010",
+    "1": "0111111",
+    "-1": "0111010",
+    "D": "0001100",
+    "A": "0110000",
+    "!D": "0001101",
+    "!A": "0110001",
+    "-D": "0001111",
+    "-A": "0110011",
+    "D+1": "0011111",
+    "A+1": "0110111",
+    "D-1": "0001110",
+    "A-1": "0110010",
+    "D+A": "0000010",
+    "D-A": "0010011",
+    "A-D": "0000111",
+    "D&A": "0000000",
+    "D|A": "0010101",
+    "M": "1110000",
+    "!M": "1110001",
+    "-M": "1110011",
+    "M+1": "1110111",
+    "M-1": "1110010",
+    "D+M": "1000010",
+    "D-M": "1010011",
+    "M-D": "1000111",
+    "D&M": "1000000",
+    "D|M": "1010101",
+}
+
+JUMP_TABLE = {
+    None: "000",
+    "JGT": "001",
+    "JEQ": "010",
+    "JGE": "011",
+    "JLT": "100",
+    "JNE": "101",
+    "JLE": "110",
+    "JMP": "111",
+}
+
 
 class CInstruction(Instruction):
     def __init__(self, dest: Optional[str], comp: str, jump: Optional[str]) -> None:
         self.dest = dest
         self.comp = comp
         self.jump = jump
+        self.binary = (
+            f"111{self.comp_to_bits(comp)}{self.dest_to_bits(dest)}"
+            f"{self.jump_to_bits(jump)}"
+        )
+        self.word = int(self.binary, 2)
 
     def __repr__(self) -> str:
         dest_str = f"{self.dest}=" if self.dest else ""
@@ -30,143 +101,108 @@ class CInstruction(Instruction):
         return f"{dest_str}{self.comp}{jump_str}"
 
     def to_binary(self) -> str:
-        dest_bits = self.dest_to_bits(self.dest)
-        comp_bits = self.comp_to_bits(self.comp)
-        jump_bits = self.jump_to_bits(self.jump)
-        return f"111{comp_bits}{dest_bits}{jump_bits}"
+        return self.binary
+
+    def to_word(self) -> int:
+        return self.word
 
     def dest_to_bits(self, dest: Optional[str]) -> str:
-        dest_table = {
-            None: "000",
-            "M": "001",
-            "D": "010",
-            "MD": "011",
-            "A": "100",
-            "AM": "101",
-            "AD": "110",
-            "AMD": "111",
-        }
-        return dest_table.get(dest, "000")
+        return DEST_TABLE.get(dest, "000")
 
     def comp_to_bits(self, comp: str) -> str:
-        comp_table = {
-            "0": "0101010",
-            "1": "0111111",
-            "-1": "0111010",
-            "D": "0001100",
-            "A": "0110000",
-            "!D": "0001101",
-            "!A": "0110001",
-            "-D": "0001111",
-            "-A": "0110011",
-            "D+1": "0011111",
-            "A+1": "0110111",
-            "D-1": "0001110",
-            "A-1": "0110010",
-            "D+A": "0000010",
-            "D-A": "0010011",
-            "A-D": "0000111",
-            "D&A": "0000000",
-            "D|A": "0010101",
-            "M": "1110000",
-            "!M": "1110001",
-            "-M": "1110011",
-            "M+1": "1110111",
-            "M-1": "1110010",
-            "D+M": "1000010",
-            "D-M": "1010011",
-            "M-D": "1000111",
-            "D&M": "1000000",
-            "D|M": "1010101",
-        }
-        return comp_table.get(comp, "0000000")
+        return COMP_TABLE.get(comp, "0000000")
 
     def jump_to_bits(self, jump: Optional[str]) -> str:
-        jump_table = {
-            None: "000",
-            "JGT": "001",
-            "JEQ": "010",
-            "JGE": "011",
-            "JLT": "100",
-            "JNE": "101",
-            "JLE": "110",
-            "JMP": "111",
-        }
-        return jump_table.get(jump, "000")
+        return JUMP_TABLE.get(jump, "000")
 
 
-class Assember:
-    def __init__(self, asm: str) -> None:
-        self.tagsTable: dict[str, int] = {
-            "R0": 0,
-            "R1": 1,
-            "R2": 2,
-            "R3": 3,
-            "R4": 4,
-            "R5": 5,
-            "R6": 6,
-            "R7": 7,
-            "R8": 8,
-            "R9": 9,
-            "R10": 10,
-            "R11": 11,
-            "R12": 12,
-            "R13": 13,
-            "R14": 14,
-            "R15": 15,
-            "SCREEN": 16384,
-            "KBD": 24576,
-            "SP": 0,
-            "LCL": 1,
-            "ARG": 2,
-            "THIS": 3,
-            "THAT": 4,
-        }
+c_instruction_cache: dict[str, CInstruction] = {}
+c_instruction_cache_hits = 0
+c_instruction_cache_misses = 0
+
+
+def get_c_instruction(instruction: str) -> CInstruction:
+    global c_instruction_cache_hits
+    global c_instruction_cache_misses
+    ins = c_instruction_cache.get(instruction)
+    if ins is not None:
+        c_instruction_cache_hits += 1
+        return ins
+    c_instruction_cache_misses += 1
+    parts = instruction.split(";")
+    comp_dest = parts[0].split("=")
+    comp = comp_dest[-1]
+    dest = comp_dest[0] if len(comp_dest) > 1 else None
+    jump = parts[1] if len(parts) > 1 else None
+    ins = CInstruction(dest, comp, jump)
+    c_instruction_cache[instruction] = ins
+    return ins
+
+
+def get_c_instruction_cache_stats() -> dict[str, int]:
+    return {
+        "size": len(c_instruction_cache),
+        "hits": c_instruction_cache_hits,
+        "misses": c_instruction_cache_misses,
+    }
+
+
+def clear_c_instruction_cache() -> None:
+    global c_instruction_cache_hits
+    global c_instruction_cache_misses
+    c_instruction_cache.clear()
+    c_instruction_cache_hits = 0
+    c_instruction_cache_misses = 0
+
+
+PREDEFINED_SYMBOLS: dict[str, int] = {
+    "R0": 0,
+    "R1": 1,
+    "R2": 2,
+    "R3": 3,
+    "R4": 4,
+    "R5": 5,
+    "R6": 6,
+    "R7": 7,
+    "R8": 8,
+    "R9": 9,
+    "R10": 10,
+    "R11": 11,
+    "R12": 12,
+    "R13": 13,
+    "R14": 14,
+    "R15": 15,
+    "SCREEN": 16384,
+    "KBD": 24576,
+    "SP": 0,
+    "LCL": 1,
+    "ARG": 2,
+    "THIS": 3,
+    "THAT": 4,
+}
+
+
+def clean_lines(lines: Iterable[str]) -> Iterator[str]:
+    for line in lines:
+        if "/" in line:
+            line = line.partition("//")[0]
+        line = line.strip()
+        if not line:
+            continue
+        if " " in line or "\t" in line:
+            line = "".join(line.split())
+        yield line
+
+
+class SymbolResolver:
+    def __init__(self) -> None:
+        self.tagsTable: dict[str, int] = dict(PREDEFINED_SYMBOLS)
         self.varTable: dict[str, int] = {}
-        self.instructions = [self.str_to_instruction(ins) for ins in self.cut(asm)]
-        self.binary = [ins.to_binary() for ins in self.instructions]
 
-    def cut(self, asm: str) -> list[str]:
-        instructions = []
-        instruction_current = ""
-        iscomment = False
-        meetaslash = False
-        isTag = False
-        line_number = 0
-        tag_current = ""
-        for char in asm:
-            if char == "\n":
-                if instruction_current != "":
-                    instructions.append(instruction_current)
-                    instruction_current = ""
-                    line_number += 1
-                iscomment = False
-            elif char == "/":
-                if meetaslash:
-                    iscomment = True
-                    meetaslash = False
-                else:
-                    meetaslash = True
-            elif char == "(":
-                if not iscomment:
-                    isTag = True
-            elif char == ")":
-                if isTag:
-                    self.tagsTable[tag_current] = line_number
-                    isTag = False
-                    tag_current = ""
-                else:
-                    if not iscomment:
-                        raise ValueError("Unmatched opening parenthesis")
-            else:
-                if not iscomment and char != " ":
-                    if isTag:
-                        tag_current += char
-                    else:
-                        instruction_current += char
-        if instruction_current != "":
-            instructions.append(instruction_current)
-        return instructions
+    def add_label(self, line: str, address: int) -> None:
+        if line[-1] != ")":
+            raise ValueError(f"Unmatched opening parenthesis: {line}")
+        self.tagsTable[line[1:-1]] = address
 
     def str_to_instruction(self, instruction: str) -> Instruction:
         if instruction.startswith("@"):
@@ -182,29 +218,297 @@ class Assember:
                 self.varTable[value] = new_var
                 return AInstruction(new_var)
         else:
-            parts = instruction.split(";")
-            comp_dest = parts[0].split("=")
-            comp = comp_dest[-1]
-            dest = comp_dest[0] if len(comp_dest) > 1 else None
-            jump = parts[1] if len(parts) > 1 else None
-            return CInstruction(dest, comp, jump)
+            return get_c_instruction(instruction)
+
+
+class Assember(SymbolResolver):
+    def __init__(self, asm: str) -> None:
+        super().__init__()
+        self.instructions = [self.str_to_instruction(ins) for ins in self.cut(asm)]
+        self.words = array("H", [ins.to_word() for ins in self.instructions])
+
+    @property
+    def binary(self) -> list[str]:
+        return [f"{word:016b}" for word in self.words]
+
+    def to_words(self) -> list[int]:
+        return self.words.tolist()
+
+    def to_bytes(self, byteorder: str = "big") -> bytes:
+        return words_to_bytes(self.words, byteorder)
+
+    def cut(self, asm: str) -> list[str]:
+        instructions = []
+        append = instructions.append
+        for line in clean_lines(asm.splitlines()):
+            if line[0] == "(":
+                self.add_label(line, len(instructions))
+            elif ")" in line:
+                raise ValueError(f"Unmatched closing parenthesis: {line}")
+            else:
+                append(line)
+        return instructions
+
+
+class StreamingAssember(SymbolResolver):
+    def __init__(self, filepath: str) -> None:
+        super().__init__()
+        self.filepath = filepath
+        self.length = self.scan_labels()
+
+    @property
+    def binary(self) -> list[str]:
+        return [f"{word:016b}" for word in self.iter_words()]
+
+    def to_words(self) -> list[int]:
+        return list(self.iter_words())
+
+    def to_bytes(self, byteorder: str = "big") -> bytes:
+        return words_to_bytes(array("H", self.iter_words()), byteorder)
+
+    def scan_labels(self) -> int:
+        address = 0
+        with open(self.filepath, "r") as f:
+            for line in clean_lines(f):
+                if line[0] == "(":
+                    self.add_label(line, address)
+                elif ")" in line:
+                    raise ValueError(f"Unmatched closing parenthesis: {line}")
+                else:
+                    address += 1
+        return address
+
+    def iter_words(self) -> Iterator[int]:
+        with open(self.filepath, "r") as f:
+            for line in clean_lines(f):
+                if line[0] != "(":
+                    yield self.str_to_instruction(line).to_word()
+
+    def write(
+        self,
+        output_path: str,
+        fmt: str = "hack",
+        byteorder: str = "big",
+        chunk_size: int = 8192,
+    ) -> None:
+        chunk = array("H")
+        with open_output(output_path, fmt) as f:
+            for word in self.iter_words():
+                chunk.append(word)
+                if len(chunk) >= chunk_size:
+                    write_words(chunk, f, fmt, byteorder)
+                    del chunk[:]
+            write_words(chunk, f, fmt, byteorder)
+
+
+class AssemblyCache:
+    def __init__(self, cache_dir: str, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(__file__, "rb") as f:
+            # entries written by another version of the assembler are not reused
+            self.fingerprint = hashlib.sha256(f.read()).hexdigest()
+        self.stats_path = os.path.join(cache_dir, "stats.json")
+
+    def key(self, asm: str) -> str:
+        digest = hashlib.sha256(self.fingerprint.encode())
+        digest.update(asm.encode())
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key: str) -> Optional[tuple[array, dict[str, int], dict[str, int]]]:
+        path = self.entry_path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+            # the modification time doubles as the last use for LRU eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            self.record("misses")
+            return None
+        self.record("hits")
+        words = array("H")
+        words.frombytes(base64.b64decode(entry["words"]))
+        if sys.byteorder != "big":
+            words.byteswap()
+        return words, entry["tagsTable"], entry["varTable"]
+
+    def put(self, key: str, assember: Assember) -> None:
+        path = self.entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        entry = {
+            "words": base64.b64encode(assember.to_bytes("big")).decode(),
+            "tagsTable": assember.tagsTable,
+            "varTable": assember.varTable,
+        }
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".json") and file_name != "stats.json":
+                path = os.path.join(self.cache_dir, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.record("evictions")
+
+    def load_stats(self) -> dict[str, int]:
+        try:
+            with open(self.stats_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"hits": 0, "misses": 0, "evictions": 0}
+
+    def record(self, counter: str) -> None:
+        stats = self.load_stats()
+        stats[counter] = stats.get(counter, 0) + 1
+        tmp_path = f"{self.stats_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(stats, f)
+        os.replace(tmp_path, self.stats_path)
+
+    def summary(self) -> str:
+        stats = self.load_stats()
+        total = stats["hits"] + stats["misses"]
+        rate = 100 * stats["hits"] / total if total else 0.0
+        return (
+            f"Assembly cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({rate:.1f}% hit rate), {stats['evictions']} evictions"
+        )
+
+
+def words_to_bytes(words: array, byteorder: str = "big") -> bytes:
+    if byteorder not in ("big", "little"):
+        raise ValueError(f"Unknown byte order: {byteorder}")
+    if byteorder != sys.byteorder:
+        words = array("H", words)
+        words.byteswap()
+    return words.tobytes()
+
+
+def write_hack(words: array, f: TextIO) -> None:
+    f.write("".join(f"{word:016b}\n" for word in words))
+
+
+def write_bin(words: array, f: BinaryIO, byteorder: str = "big") -> None:
+    f.write(words_to_bytes(words, byteorder))
+
+
+OUTPUT_FORMATS = {
+    "hack": ".hack",
+    "bin": ".bin",
+}
+
+
+def open_output(output_path: str, fmt: str):
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {fmt}")
+    return open(output_path, "wb" if fmt == "bin" else "w")
+
+
+def write_words(words: array, f, fmt: str, byteorder: str) -> None:
+    if fmt == "hack":
+        write_hack(words, f)
+    else:
+        write_bin(words, f, byteorder)
+
+
+def write_output(words: array, output_path: str, fmt: str, byteorder: str) -> None:
+    with open_output(output_path, fmt) as f:
+        write_words(words, f, fmt, byteorder)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Hack Assembler")
     parser.add_argument("filepath", help="Path to the file to read")
     parser.add_argument("-o", help="Output file path")
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=list(OUTPUT_FORMATS),
+        default="hack",
+        help="Output format: .hack text or raw 16-bit words",
+    )
+    parser.add_argument(
+        "--byteorder",
+        choices=["big", "little"],
+        default="big",
+        help="Byte order of the words in bin output",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Assemble in two passes over the file without holding it in memory",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="Serve unchanged inputs from assembled output stored in this directory",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        metavar="MB",
+        help="Evict the least recently used cache entries beyond this size",
+    )
+    parser.add_argument(
+        "--stats", action="store_true", help="Print C-instruction cache statistics"
+    )
     args = parser.parse_args()
-    with open(args.filepath, "r") as f:
-        content = f.read()
-    assember = Assember(content)
+    if args.cache and args.stream:
+        parser.error("--cache needs the whole program in memory, not --stream")
     if not args.o:
-        output_path = args.filepath.replace(".asm", ".hack")
+        output_path = args.filepath.replace(".asm", OUTPUT_FORMATS[args.format])
     else:
         output_path = args.o
-    with open(output_path, "w") as f:
-        for line in assember.binary:
-            f.write(line + "\n")
+    if args.stream:
+        StreamingAssember(args.filepath).write(
+            output_path, args.format, args.byteorder
+        )
+    else:
+        with open(args.filepath, "r") as f:
+            content = f.read()
+        if args.cache:
+            cache = AssemblyCache(args.cache, args.cache_size * 1024 * 1024)
+            key = cache.key(content)
+            cached = cache.get(key)
+            if cached is not None:
+                words = cached[0]
+            else:
+                assember = Assember(content)
+                cache.put(key, assember)
+                words = assember.words
+        else:
+            words = Assember(content).words
+        write_output(words, output_path, args.format, args.byteorder)
+    if args.stats and args.cache:
+        print(cache.summary())
+    if args.stats:
+        stats = get_c_instruction_cache_stats()
+        print(
+            f"C-instruction cache: {stats['size']} distinct, "
+            f"{stats['hits']} hits, {stats['misses']} misses"
+        )
 
 
 if __name__ == "__main__":
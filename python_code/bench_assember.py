@@ -0,0 +1,156 @@
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from assember import Assember
+
+
+def legacy_cut(asm: str, tagsTable: dict[str, int]) -> list[str]:
+    # the per-character state machine Assember.cut used before the
+    # line-oriented tokenizer, kept here as the baseline for comparison
+    instructions = []
+    instruction_current = ""
+    iscomment = False
+    meetaslash = False
+    isTag = False
+    line_number = 0
+    tag_current = ""
+    for char in asm:
+        if char == "\n":
+            if instruction_current != "":
+                instructions.append(instruction_current)
+                instruction_current = ""
+                line_number += 1
+            iscomment = False
+        elif char == "/":
+            if meetaslash:
+                iscomment = True
+                meetaslash = False
+            else:
+                meetaslash = True
+        elif char == "(":
+            if not iscomment:
+                isTag = True
+        elif char == ")":
+            if isTag:
+                tagsTable[tag_current] = line_number
+                isTag = False
+                tag_current = ""
+            else:
+                if not iscomment:
+                    raise ValueError("Unmatched opening parenthesis")
+        else:
+            if not iscomment and char != " ":
+                if isTag:
+                    tag_current += char
+                else:
+                    instruction_current += char
+    if instruction_current != "":
+        instructions.append(instruction_current)
+    return instructions
+
+
+def gen_asm(lines: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    c_instructions = [
+        "AM=M-1",
+        "D=M",
+        "A=A-1",
+        "M=D+M",
+        "M=M+1",
+        "A=M-1",
+        "M=D",
+        "D=A",
+        "0;JMP",
+        "D;JNE",
+    ]
+    out = []
+    label_num = 0
+    while len(out) < lines:
+        r = rng.random()
+        if r < 0.02:
+            out.append(f"(LABEL_{label_num})")
+            label_num += 1
+        elif r < 0.05:
+            out.append("// generated comment")
+        elif r < 0.35:
+            out.append(rng.choice(["@SP", "@LCL", "@R13", f"@{rng.randrange(32768)}"]))
+        else:
+            ins = rng.choice(c_instructions)
+            out.append(f"    {ins}" if r < 0.5 else f"{ins} // trailing")
+    return "\n".join(out) + "\n"
+
+
+def bench_cut(lines: int, repeat: int) -> None:
+    asm = gen_asm(lines)
+    assember = Assember("")
+    legacy_table: dict[str, int] = {}
+    assert legacy_cut(asm, legacy_table) == assember.cut(asm)
+    assert all(assember.tagsTable[k] == v for k, v in legacy_table.items())
+    for name, cut in [
+        ("legacy", lambda: legacy_cut(asm, {})),
+        ("line", lambda: Assember("").cut(asm)),
+    ]:
+        best = min(timed(cut) for _ in range(repeat))
+        print(f"{name:>8}: {best:8.3f}s  {lines / best:14,.0f} lines/s")
+
+
+RSS_CHILD = """
+import resource, sys
+sys.argv = ["assember.py"] + sys.argv[1:]
+from assember import main
+main()
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def bench_rss(lines: int) -> None:
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        asm_path = os.path.join(tmp, "Big.asm")
+        # generated in chunks: a child's ru_maxrss starts from the parent's
+        # high-water mark, so the parent must stay small too
+        with open(asm_path, "w") as f:
+            for seed, start in enumerate(range(0, lines, 100_000)):
+                f.write(gen_asm(min(100_000, lines - start), seed))
+        size = os.path.getsize(asm_path) / 1024 / 1024
+        print(f"input: {lines:,} lines, {size:.1f} MiB")
+        for name, extra in [("Assember", []), ("stream", ["--stream"])]:
+            out_path = os.path.join(tmp, "Big.hack")
+            start = time.perf_counter()
+            result = subprocess.run(
+                [sys.executable, "-c", RSS_CHILD, asm_path, "-o", out_path] + extra,
+                cwd=here,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            elapsed = time.perf_counter() - start
+            peak = int(result.stdout.split()[-1]) / 1024
+            print(f"{name:>8}: peak RSS {peak:8.1f} MiB  {elapsed:6.2f}s")
+
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hack Assembler benchmarks")
+    parser.add_argument("bench", nargs="?", choices=["cut", "rss"], default="cut")
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    if args.bench == "cut":
+        bench_cut(args.lines, args.repeat)
+    else:
+        bench_rss(args.lines)
+
+
+if __name__ == "__main__":
+    main()
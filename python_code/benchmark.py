@@ -0,0 +1,139 @@
+import argparse
+import json
+import time
+from functools import partial
+from typing import Callable
+
+import vm_translator
+import vm_translator_opt
+from assember import Assember, clean_lines
+from hack_emulator import ROM_SIZE, HackEmulator
+from vm_corpus import Program, all_programs, to_signed
+
+TRANSLATORS: dict[str, Callable[[list[tuple[str, str]], bool], list[str]]] = {
+    "vm_translator": vm_translator.translate,
+    "vm_translator_opt": vm_translator_opt.translate,
+    "vm_translator_opt_speed": partial(vm_translator_opt.translate, opt="speed"),
+    "vm_translator_opt_size": partial(vm_translator_opt.translate, opt="size"),
+    "vm_translator_opt_tos": partial(vm_translator_opt.translate, tos_cache=True),
+    "vm_translator_opt_vsp": partial(vm_translator_opt.translate, virtual_sp=True),
+    "vm_translator_opt_frames": partial(
+        vm_translator_opt.translate, static_frames=True
+    ),
+    "vm_translator_opt_inline": partial(
+        vm_translator_opt.translate, max_inline_instructions=20
+    ),
+}
+
+
+def count_vm_instructions(program: Program) -> int:
+    return sum(
+        len(vm_translator.VMTranslator("").cut(code)) for _, code in program.sources
+    )
+
+
+def run_program(program: Program, translator: str) -> dict:
+    start = time.perf_counter()
+    asm = TRANSLATORS[translator](program.sources, program.bootstrap)
+    translate_time = time.perf_counter() - start
+    rom_words = sum(1 for line in clean_lines(asm) if line[0] != "(")
+    result = {
+        "program": program.name,
+        "translator": translator,
+        "rom_words": rom_words,
+        "cycles": 0,
+        "halted": False,
+        "correct": False,
+        "mismatches": {},
+        "translate_seconds": round(translate_time, 4),
+        "run_seconds": 0.0,
+    }
+    if rom_words > ROM_SIZE:
+        # labels past 32K cannot even be encoded, nothing to run
+        return result
+    emulator = HackEmulator(Assember("\n".join(asm)).words)
+    for address, value in program.ram.items():
+        emulator.poke(address, value)
+    start = time.perf_counter()
+    cycles = emulator.run(program.max_cycles)
+    run_time = time.perf_counter() - start
+    mismatches = {
+        address: emulator.peek(address)
+        for address, value in program.expected.items()
+        if emulator.peek(address) != to_signed(value)
+    }
+    result.update(
+        {
+            "cycles": cycles,
+            "halted": emulator.halted,
+            "correct": not mismatches,
+            "mismatches": mismatches,
+            "run_seconds": round(run_time, 4),
+        }
+    )
+    return result
+
+
+def run_benchmarks(programs: list[Program], translators: list[str]) -> list[dict]:
+    results = []
+    for program in programs:
+        vm_count = count_vm_instructions(program)
+        for translator in translators:
+            result = run_program(program, translator)
+            result["vm_instructions"] = vm_count
+            results.append(result)
+    return results
+
+
+def format_table(results: list[dict], baseline: str) -> str:
+    base = {r["program"]: r for r in results if r["translator"] == baseline}
+    header = (
+        f"{'program':<20} {'translator':<24} {'vm':>6} {'rom':>7} "
+        f"{'rom %':>7} {'cycles':>11} {'cycles %':>9} {'ok':>4}"
+    )
+    lines = [header, "-" * len(header)]
+    for r in results:
+        b = base.get(r["program"], r)
+        rom_pct = 100 * r["rom_words"] / b["rom_words"]
+        cycle_pct = 100 * r["cycles"] / b["cycles"] if b["cycles"] else 100
+        if r["rom_words"] > ROM_SIZE:
+            ok = "ROM"
+        elif r["correct"] and r["halted"]:
+            ok = "yes"
+        else:
+            ok = "NO"
+        lines.append(
+            f"{r['program']:<20} {r['translator']:<24} {r['vm_instructions']:>6} "
+            f"{r['rom_words']:>7} {rom_pct:>6.1f}% {r['cycles']:>11} "
+            f"{cycle_pct:>8.1f}% {ok:>4}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VM translator benchmarks")
+    parser.add_argument(
+        "-t",
+        "--translator",
+        action="append",
+        choices=list(TRANSLATORS),
+        help="Translator to run, may be repeated (default: all)",
+    )
+    parser.add_argument(
+        "-p", "--program", action="append", help="Only run programs with this name"
+    )
+    parser.add_argument("--json", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+    translators = args.translator or list(TRANSLATORS)
+    programs = all_programs()
+    if args.program:
+        programs = [p for p in programs if p.name in args.program]
+    results = run_benchmarks(programs, translators)
+    print(format_table(results, translators[0]))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import sys
+import time
+from array import array
+from typing import Callable, Iterable, Optional
+
+from assember import Assember
+
+ROM_SIZE = 32768
+RAM_SIZE = 65536
+
+ALU_TABLE: dict[str, Callable[[int, int], int]] = {
+    "101010": lambda d, y: 0,
+    "111111": lambda d, y: 1,
+    "111010": lambda d, y: 0xFFFF,
+    "001100": lambda d, y: d,
+    "110000": lambda d, y: y,
+    "001101": lambda d, y: d ^ 0xFFFF,
+    "110001": lambda d, y: y ^ 0xFFFF,
+    "001111": lambda d, y: -d & 0xFFFF,
+    "110011": lambda d, y: -y & 0xFFFF,
+    "011111": lambda d, y: (d + 1) & 0xFFFF,
+    "110111": lambda d, y: (y + 1) & 0xFFFF,
+    "001110": lambda d, y: (d - 1) & 0xFFFF,
+    "110010": lambda d, y: (y - 1) & 0xFFFF,
+    "000010": lambda d, y: (d + y) & 0xFFFF,
+    "010011": lambda d, y: (d - y) & 0xFFFF,
+    "000111": lambda d, y: (y - d) & 0xFFFF,
+    "000000": lambda d, y: d & y,
+    "010101": lambda d, y: d | y,
+}
+
+
+def alu(c_bits: int) -> Callable[[int, int], int]:
+    # generic ALU for the comp bit patterns the assembler never emits
+    zx, nx, zy, ny, f, no = ((c_bits >> (5 - i)) & 1 for i in range(6))
+
+    def compute(d: int, y: int) -> int:
+        x = 0 if zx else d
+        x = x ^ 0xFFFF if nx else x
+        y = 0 if zy else y
+        y = y ^ 0xFFFF if ny else y
+        out = (x + y) & 0xFFFF if f else x & y
+        return out ^ 0xFFFF if no else out
+
+    return compute
+
+
+alu_functions = [
+    ALU_TABLE.get(f"{c_bits:06b}") or alu(c_bits) for c_bits in range(64)
+]
+
+
+def decode(word: int) -> Optional[tuple]:
+    if word < 0x8000:
+        return None
+    use_m = (word >> 12) & 1
+    c_bits = (word >> 6) & 0x3F
+    fn = alu_functions[c_bits]
+    jump = word & 0x7
+    # indexed by 0 for out == 0, 1 for out > 0, 2 for out < 0
+    taken = (bool(jump & 0x2), bool(jump & 0x1), bool(jump & 0x4))
+    return (
+        fn,
+        use_m,
+        (word >> 5) & 1,
+        (word >> 4) & 1,
+        (word >> 3) & 1,
+        taken if jump else None,
+    )
+
+
+dispatch_table: list[Optional[tuple]] = []
+
+
+def get_dispatch_table() -> list[Optional[tuple]]:
+    if not dispatch_table:
+        dispatch_table.extend(decode(word) for word in range(65536))
+    return dispatch_table
+
+
+class HackEmulator:
+    def __init__(self, program: Iterable[int]) -> None:
+        self.rom = array("H", program)
+        if len(self.rom) > ROM_SIZE:
+            raise ValueError(f"Program has {len(self.rom)} words, ROM holds {ROM_SIZE}")
+        self.table = get_dispatch_table()
+        self.halt_targets = self.find_halt_loops()
+        self.reset()
+
+    def reset(self) -> None:
+        self.ram = array("H", bytes(2 * RAM_SIZE))
+        self.pc = 0
+        self.a = 0
+        self.d = 0
+        self.cycles = 0
+        self.halted = False
+
+    def find_halt_loops(self) -> set[int]:
+        # (END) @END 0;JMP: jumping to an @t at address t followed by an
+        # unconditional jump can never leave the loop again
+        targets = set()
+        rom = self.rom
+        for address in range(len(rom) - 1):
+            if rom[address] == address:
+                entry = self.table[rom[address + 1]]
+                if entry is not None and entry[5] == (True, True, True):
+                    targets.add(address)
+        return targets
+
+    def run(self, max_cycles: int) -> int:
+        rom = self.rom
+        ram = self.ram
+        table = self.table
+        halt_targets = self.halt_targets
+        size = len(rom)
+        pc, a, d = self.pc, self.a, self.d
+        cycles = 0
+        halted = self.halted
+        while cycles < max_cycles and not halted:
+            if pc >= size:
+                halted = True
+                break
+            ins = rom[pc]
+            cycles += 1
+            if ins < 0x8000:
+                a = ins
+                pc += 1
+                continue
+            fn, use_m, dest_a, dest_d, dest_m, taken = table[ins]
+            address = a
+            out = fn(d, ram[a] if use_m else a)
+            if dest_m:
+                ram[address] = out
+            if dest_a:
+                a = out
+            if dest_d:
+                d = out
+            if taken is not None and taken[(out != 0) + (out >= 0x8000)]:
+                pc = address
+                if address in halt_targets:
+                    halted = True
+            else:
+                pc += 1
+        self.pc, self.a, self.d = pc, a, d
+        self.cycles += cycles
+        self.halted = halted
+        return cycles
+
+    def peek(self, address: int) -> int:
+        value = self.ram[address]
+        return value - 0x10000 if value & 0x8000 else value
+
+    def poke(self, address: int, value: int) -> None:
+        self.ram[address] = value & 0xFFFF
+
+
+def load_program(path: str, byteorder: str = "big") -> array:
+    if path.endswith(".asm"):
+        with open(path, "r") as f:
+            return Assember(f.read()).words
+    elif path.endswith(".bin"):
+        words = array("H")
+        with open(path, "rb") as f:
+            words.frombytes(f.read())
+        if byteorder != sys.byteorder:
+            words.byteswap()
+        return words
+    else:
+        with open(path, "r") as f:
+            return array("H", [int(line, 2) for line in f if line.strip()])
+
+
+def parse_assignment(text: str) -> tuple[int, int]:
+    address, value = text.split("=")
+    return int(address), int(value)
+
+
+def parse_range(text: str) -> range:
+    if "-" in text:
+        start, end = text.split("-")
+        return range(int(start), int(end) + 1)
+    return range(int(text), int(text) + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hack CPU Emulator")
+    parser.add_argument("filepath", help="Path to a .hack, .bin or .asm file")
+    parser.add_argument(
+        "--cycles", type=int, default=10_000_000, help="Maximum cycles to run"
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="ADDR=VALUE",
+        help="Initial RAM value, may be repeated",
+    )
+    parser.add_argument(
+        "--dump",
+        action="append",
+        default=[],
+        metavar="ADDR[-ADDR]",
+        help="RAM cells to print after the run, may be repeated",
+    )
+    parser.add_argument(
+        "--byteorder",
+        choices=["big", "little"],
+        default="big",
+        help="Byte order of the words in bin input",
+    )
+    args = parser.parse_args()
+    emulator = HackEmulator(load_program(args.filepath, args.byteorder))
+    for assignment in args.set:
+        emulator.poke(*parse_assignment(assignment))
+    start = time.perf_counter()
+    cycles = emulator.run(args.cycles)
+    elapsed = time.perf_counter() - start
+    state = "halted" if emulator.halted else "stopped"
+    print(f"{state} after {cycles} cycles, pc={emulator.pc}")
+    print(f"{elapsed:.3f}s, {cycles / elapsed if elapsed else 0:,.0f} instructions/s")
+    for text in args.dump:
+        for address in parse_range(text):
+            print(f"RAM[{address}] = {emulator.peek(address)}")
+
+
+if __name__ == "__main__":
+    main()
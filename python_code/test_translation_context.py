@@ -0,0 +1,42 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import vm_translator
+import vm_translator_opt
+from vm_corpus import Program, gen_many_functions, standard_programs
+
+ROUNDS = 8
+
+
+def corpus_programs() -> list[Program]:
+    programs = {program.name: program for program in standard_programs()}
+    # comparison labels in one, calls and returns in the other
+    return [programs["StackTest"], gen_many_functions(100)]
+
+
+@pytest.mark.parametrize(
+    "translate",
+    [vm_translator.translate, vm_translator_opt.translate],
+    ids=["vm_translator", "vm_translator_opt"],
+)
+def test_threads_match_serial(translate) -> None:
+    programs = corpus_programs()
+    serial = [translate(program.sources, program.bootstrap) for program in programs]
+    jobs = [i % len(programs) for i in range(ROUNDS * len(programs))]
+    interval = sys.getswitchinterval()
+    # switch threads often so that any shared translator state interleaves
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(
+                executor.map(
+                    lambda i: translate(programs[i].sources, programs[i].bootstrap),
+                    jobs,
+                )
+            )
+    finally:
+        sys.setswitchinterval(interval)
+    for i, asm in zip(jobs, results):
+        assert asm == serial[i], programs[i].name
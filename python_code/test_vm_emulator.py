@@ -0,0 +1,27 @@
+import pytest
+
+import vm_emulator
+from vm_corpus import Program, all_programs, to_signed
+from vm_emulator import VMEmulator, VMProgram
+
+MODES = ["fused", "no_fuse", "hot_visits_1"]
+
+
+def run_program(program: Program, fuse: bool) -> VMEmulator:
+    emulator = VMEmulator(VMProgram(program.sources, program.bootstrap, fuse))
+    for address, value in program.ram.items():
+        emulator.poke(address, value)
+    emulator.run(program.max_cycles)
+    return emulator
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("program", all_programs(), ids=lambda program: program.name)
+def test_program_results(program: Program, mode: str, monkeypatch) -> None:
+    if mode == "hot_visits_1":
+        # every entry point is compiled the first time it is reached
+        monkeypatch.setattr(vm_emulator, "HOT_VISITS", 1)
+    emulator = run_program(program, mode != "no_fuse")
+    assert emulator.halted
+    for address, value in program.expected.items():
+        assert emulator.peek(address) == to_signed(value), address
@@ -0,0 +1,383 @@
+from typing import Optional
+
+import pytest
+
+from vm_translator_opt import (
+    AsmOptimizer,
+    ControlFlowGraph,
+    Instruction,
+    TranslationContext,
+    ValueTable,
+    VMCodeOptimizer,
+    VMTranslator,
+    constant_value,
+    cut_to_basic_blocks,
+    fold,
+    parse,
+    push_constant,
+)
+
+
+def parse_vm(lines: list[str]) -> list[Instruction]:
+    translator = VMTranslator("", TranslationContext())
+    return [translator.str_to_instruction(line) for line in lines]
+
+
+def vm_lines(code: list[Instruction]) -> list[str]:
+    return [repr(ins) for ins in code]
+
+
+@pytest.mark.parametrize(
+    "operation, x, y, expected",
+    [
+        ("add", 0x7FFF, 1, 0x8000),
+        ("add", 0xFFFF, 1, 0),
+        ("sub", 0, 1, 0xFFFF),
+        ("and", 0xF0F0, 0xFF00, 0xF000),
+        ("or", 0xF0F0, 0x0F00, 0xFFF0),
+        ("eq", 5, 5, 0xFFFF),
+        ("eq", 0x8000, 0, 0),
+        ("gt", 0xFFFF, 0, 0),
+        ("lt", 0xFFFF, 0, 0xFFFF),
+        ("gt", 0x8000, 0xFFFF, 0),
+        # x - y overflows, the translated comparison would get it wrong too
+        ("gt", 0x7FFF, 0x8000, None),
+        ("lt", 0x8000, 1, None),
+        ("eq", 0x8000, 0x7FFF, None),
+    ],
+)
+def test_fold(operation: str, x: int, y: int, expected: Optional[int]) -> None:
+    assert fold(operation, x, y) == expected
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (5, ["push constant 5"]),
+        (0x7FFF, ["push constant 32767"]),
+        (0x8000, ["push constant 32767", "not"]),
+        (0xFFFF, ["push constant 1", "neg"]),
+        (-3, ["push constant 3", "neg"]),
+    ],
+)
+def test_push_constant(value: int, expected: list[str]) -> None:
+    assert vm_lines(push_constant(value)) == expected
+
+
+@pytest.mark.parametrize(
+    "lines, expected",
+    [
+        ([], None),
+        (["push constant 7"], (7, 1)),
+        (["push constant 32767", "not"], (0x8000, 2)),
+        (["push constant 1", "neg"], (0xFFFF, 2)),
+        (["push constant 0", "neg"], (0, 2)),
+        (["neg"], None),
+        (["push local 0", "neg"], None),
+        (["push constant 1", "label L", "neg"], None),
+        (["push constant 1", "pop local 0"], None),
+    ],
+)
+def test_constant_value(lines: list[str], expected: Optional[tuple]) -> None:
+    code = parse_vm(lines)
+    assert constant_value(code, len(code)) == expected
+
+
+@pytest.mark.parametrize(
+    "lines, expected",
+    [
+        # fold constants
+        (["push constant 2", "push constant 3", "add"], ["push constant 5"]),
+        (
+            ["push constant 1", "push constant 2", "sub"],
+            ["push constant 1", "neg"],
+        ),
+        (
+            ["push constant 32767", "push constant 1", "add"],
+            ["push constant 32767", "not"],
+        ),
+        (
+            ["push constant 1", "push constant 2", "add", "push constant 3", "add"],
+            ["push constant 6"],
+        ),
+        (
+            ["push constant 3", "neg", "push constant 5", "and"],
+            ["push constant 5"],
+        ),
+        (
+            ["push constant 32767", "not", "push constant 0", "lt"],
+            ["push constant 1", "neg"],
+        ),
+        (
+            ["push constant 32767", "not", "push constant 1", "gt"],
+            ["push constant 32767", "not", "push constant 1", "gt"],
+        ),
+        (
+            ["push constant 1", "label L", "push constant 2", "add"],
+            ["push constant 1", "label L", "push constant 2", "add"],
+        ),
+        # simplify algebra
+        (["push local 0", "push constant 0", "add"], ["push local 0"]),
+        (["push local 0", "push constant 0", "sub"], ["push local 0"]),
+        (["push constant 0", "push local 0", "or"], ["push local 0"]),
+        (
+            ["push constant 0", "push local 0", "sub"],
+            ["push constant 0", "push local 0", "sub"],
+        ),
+        (["push local 0", "not", "not"], ["push local 0"]),
+        (["push local 0", "neg", "neg"], ["push local 0"]),
+        (["push constant 32767", "not", "not"], ["push constant 32767"]),
+        (
+            ["push local 0", "not", "label L", "not"],
+            ["push local 0", "not", "label L", "not"],
+        ),
+        (
+            ["push local 0", "not", "neg"],
+            ["push local 0", "not", "neg"],
+        ),
+        # remove dead code
+        (
+            ["goto L", "push constant 1", "pop local 0", "label L", "push constant 2"],
+            ["goto L", "label L", "push constant 2"],
+        ),
+        (
+            ["push constant 1", "return", "push constant 2", "function Main.f 0"],
+            ["push constant 1", "return", "function Main.f 0"],
+        ),
+    ],
+)
+def test_vm_code_optimizer(lines: list[str], expected: list[str]) -> None:
+    assert vm_lines(VMCodeOptimizer(parse_vm(lines)).optimized_code) == expected
+
+
+@pytest.mark.parametrize(
+    "a, comp, expected",
+    [
+        ((None, 5), "0", (None, 0)),
+        ((None, 5), "-1", (None, 0xFFFF)),
+        ((None, 5), "A+1", (None, 6)),
+        ((None, 5), "-A", (None, 0xFFFB)),
+        ((None, 5), "!A", (None, 0xFFFA)),
+        (("x", 0), "A+1", ("x", 1)),
+        (("x", 0), "A-1", ("x", 0xFFFF)),
+        (("x", 3), "A", ("x", 3)),
+    ],
+)
+def test_value_table_evaluate(a: tuple, comp: str, expected: tuple) -> None:
+    values = ValueTable()
+    values.a = a
+    assert values.evaluate(comp) == expected
+
+
+def test_value_table_numbers_equal_expressions_alike() -> None:
+    values = ValueTable()
+    values.a = values.load(("x", 0))
+    assert values.evaluate("D+A") == values.evaluate("A+D")
+    assert values.evaluate("D&A") == values.evaluate("D&A")
+    assert values.evaluate("D-A") != values.evaluate("A-D")
+    assert values.evaluate("D-D") == (None, 0)
+
+
+def test_value_table_aliasing() -> None:
+    values = ValueTable()
+    stack = values.load((None, 0))
+    other = values.load((None, 1))
+    top, below = (stack[0], 1), (stack[0], 2)
+    # registers never alias variables, variables start at 16
+    assert not values.may_alias((None, 3), (None, 20))
+    assert not values.may_alias(("x", 0), (None, 5))
+    assert values.may_alias(("x", 0), (None, 20))
+    assert not values.may_alias(("x", 0), ("y", 0))
+    # stack addresses never alias registers or variables
+    assert not values.may_alias(top, ("x", 0))
+    assert not values.may_alias(top, (None, 13))
+    assert not values.may_alias(top, below)
+    assert values.may_alias(top, other)
+
+
+def test_value_table_store_forgets_aliases() -> None:
+    values = ValueTable()
+    x = values.load(("x", 0))
+    r13 = values.load((None, 13))
+    values.store((None, 20), values.fresh())
+    assert values.load((None, 13)) == r13
+    assert values.load(("x", 0)) != x
+
+
+@pytest.mark.parametrize(
+    "lines, expected",
+    [
+        (["@5", "D=A", "@5", "D=A"], ["@5", "D=A"]),
+        (
+            ["@SP", "A=M", "D=M", "@SP", "A=M", "D=M"],
+            ["@SP", "A=M", "D=M"],
+        ),
+        (["@R13", "M=D", "@R13", "M=D"], ["@R13", "M=D"]),
+        # the A left loaded is live where the block is left
+        (
+            ["@R13", "M=D", "@R14", "M=D", "@R13", "M=D"],
+            ["@R13", "M=D", "@R14", "M=D", "@R13"],
+        ),
+        (
+            ["@x", "M=D", "@SP", "A=M", "M=0", "@x", "M=D"],
+            ["@x", "M=D", "@SP", "A=M", "M=0", "@x"],
+        ),
+        (
+            ["@x", "M=D", "@5", "M=0", "@x", "M=D"],
+            ["@x", "M=D", "@5", "M=0", "@x"],
+        ),
+        # x may be allocated at 20
+        (
+            ["@x", "M=D", "@20", "M=0", "@x", "M=D"],
+            ["@x", "M=D", "@20", "M=0", "@x", "M=D"],
+        ),
+        # LCL may point into the stack
+        (
+            ["@SP", "A=M", "M=D", "@LCL", "A=M", "M=0", "@SP", "A=M", "M=D"],
+            ["@SP", "A=M", "M=D", "@LCL", "A=M", "M=0", "@SP", "A=M", "M=D"],
+        ),
+        (["@SP", "D=M", "@R13", "A=D", "@SP", "A=D"], ["@SP", "D=M", "A=D"]),
+        # dead stores to registers overwritten before they are read
+        (["@R13", "M=D", "@R13", "M=0"], ["@R13", "M=0"]),
+        (
+            ["@R13", "M=D", "@R13", "D=M", "@R13", "M=0"],
+            ["@R13", "M=0"],
+        ),
+        (["@R13", "M=D", "@L", "0;JMP"], ["@R13", "M=D", "@L", "0;JMP"]),
+        # SP stepped up and back down
+        (
+            ["@SP", "M=M+1", "A=M-1", "M=D", "@SP", "AM=M-1", "D=M"],
+            ["@SP", "A=M", "M=D"],
+        ),
+    ],
+)
+def test_optimize_block(lines: list[str], expected: list[str]) -> None:
+    block = AsmOptimizer([]).optimize_block([parse(line) for line in lines])
+    assert [repr(ins) for ins in block] == expected
+
+
+def control_flow_graph(lines: list[str]) -> ControlFlowGraph:
+    return ControlFlowGraph(cut_to_basic_blocks([parse(line) for line in lines]))
+
+
+@pytest.mark.parametrize(
+    "lines, expected",
+    [
+        # a chain of jumps to jumps, stopping at a block that does something
+        (
+            ["@A", "0;JMP", "(A)", "@B", "0;JMP", "(B)", "D=1", "@B", "0;JMP"],
+            [["@B", "0;JMP"], ["(A)", "@B", "0;JMP"], ["(B)", "D=1", "@B", "0;JMP"]],
+        ),
+        # an empty block falls through to the next label
+        (
+            ["@A", "D;JEQ", "(A)", "(B)", "D=1"],
+            [["@B", "D;JEQ"], ["(A)"], ["(B)", "D=1"]],
+        ),
+        # cycles of jumps end where they started
+        (
+            ["@A", "0;JMP", "(A)", "@B", "0;JMP", "(B)", "@A", "0;JMP"],
+            [["@A", "0;JMP"], ["(A)", "@B", "0;JMP"], ["(B)", "@A", "0;JMP"]],
+        ),
+        # a return address handed to a shared routine through R15
+        (
+            [
+                "@A",
+                "D=A",
+                "@R15",
+                "M=D",
+                "@F",
+                "0;JMP",
+                "(A)",
+                "@B",
+                "0;JMP",
+                "(B)",
+                "D=0",
+            ],
+            [
+                ["@B", "D=A", "@R15", "M=D", "@F", "0;JMP"],
+                ["(A)", "@B", "0;JMP"],
+                ["(B)", "D=0"],
+            ],
+        ),
+        # any other register may be read back as data
+        (
+            [
+                "@A",
+                "D=A",
+                "@R14",
+                "M=D",
+                "@F",
+                "0;JMP",
+                "(A)",
+                "@B",
+                "0;JMP",
+                "(B)",
+                "D=0",
+            ],
+            [
+                ["@A", "D=A", "@R14", "M=D", "@F", "0;JMP"],
+                ["(A)", "@B", "0;JMP"],
+                ["(B)", "D=0"],
+            ],
+        ),
+    ],
+)
+def test_thread_jumps(lines: list[str], expected: list[list[str]]) -> None:
+    blocks = AsmOptimizer([]).thread_jumps(control_flow_graph(lines))
+    assert [[repr(ins) for ins in block] for block in blocks] == expected
+
+
+@pytest.mark.parametrize(
+    "lines, expected",
+    [
+        # every block placed behind the jump to it, the jumps then go
+        (
+            [
+                "@B",
+                "0;JMP",
+                "(A)",
+                "D=1",
+                "@END",
+                "0;JMP",
+                "(B)",
+                "D=0",
+                "@A",
+                "0;JMP",
+                "(END)",
+                "@END",
+                "0;JMP",
+            ],
+            ["(B)", "D=0", "(A)", "D=1", "(END)", "@END", "0;JMP"],
+        ),
+        # a chain running off the end of the program stays last
+        (
+            ["@B", "0;JMP", "(A)", "D=1", "(B)", "D=0"],
+            ["@B", "0;JMP", "(A)", "D=1", "(B)", "D=0"],
+        ),
+        # a chain of blocks falling through moves as a whole
+        (
+            [
+                "D=0",
+                "@C",
+                "0;JMP",
+                "(B)",
+                "D=1",
+                "@END",
+                "0;JMP",
+                "(C)",
+                "M=D",
+                "@B",
+                "0;JMP",
+                "(END)",
+                "@END",
+                "0;JMP",
+            ],
+            ["D=0", "(C)", "M=D", "(B)", "D=1", "(END)", "@END", "0;JMP"],
+        ),
+    ],
+)
+def test_lay_out_blocks(lines: list[str], expected: list[str]) -> None:
+    optimizer = AsmOptimizer([])
+    blocks = optimizer.lay_out_blocks(control_flow_graph(lines))
+    asm = optimizer.remove_jumps_to_next([ins for block in blocks for ins in block])
+    assert [repr(ins) for ins in asm] == expected
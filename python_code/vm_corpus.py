@@ -0,0 +1,453 @@
+import random
+
+
+class Program:
+    def __init__(
+        self,
+        name: str,
+        sources: list[tuple[str, str]],
+        bootstrap: bool,
+        ram: dict[int, int],
+        expected: dict[int, int],
+        max_cycles: int = 10_000_000,
+    ) -> None:
+        self.name = name
+        self.sources = sources
+        self.bootstrap = bootstrap
+        self.ram = ram
+        self.expected = expected
+        self.max_cycles = max_cycles
+
+    def __repr__(self) -> str:
+        return f"Program({self.name})"
+
+
+BASIC_SEGMENTS = {0: 256, 1: 300, 2: 400, 3: 3000, 4: 3010}
+
+SIMPLE_ADD = """\
+// Pushes and adds two constants.
+push constant 7
+push constant 8
+add
+"""
+
+STACK_TEST = """\
+// Executes a sequence of arithmetic and logical operations on the stack.
+push constant 17
+push constant 17
+eq
+push constant 17
+push constant 16
+eq
+push constant 16
+push constant 17
+eq
+push constant 892
+push constant 891
+lt
+push constant 891
+push constant 892
+lt
+push constant 891
+push constant 891
+lt
+push constant 32767
+push constant 32766
+gt
+push constant 32766
+push constant 32767
+gt
+push constant 32766
+push constant 32766
+gt
+push constant 57
+push constant 31
+push constant 53
+add
+push constant 112
+sub
+neg
+and
+push constant 82
+or
+not
+"""
+
+BASIC_TEST = """\
+// Executes pop and push commands using the virtual memory segments.
+push constant 10
+pop local 0
+push constant 21
+push constant 22
+pop argument 2
+pop argument 1
+push constant 36
+pop this 6
+push constant 42
+push constant 45
+pop that 5
+pop that 2
+push constant 510
+pop temp 6
+push local 0
+push that 5
+add
+push argument 1
+sub
+push this 6
+push this 6
+add
+sub
+push temp 6
+add
+"""
+
+BASIC_LOOP = """\
+// Computes the sum 1 + 2 + ... + argument[0] and pushes the
+// result onto the stack. Argument[0] is initialized by the test
+// script before this code starts running.
+push constant 0
+pop local 0         // initializes sum = 0
+label LOOP_START
+push argument 0
+push local 0
+add
+pop local 0\t        // sum = sum + counter
+push argument 0
+push constant 1
+sub
+pop argument 0      // counter--
+push argument 0
+if-goto LOOP_START  // If counter != 0, goto LOOP_START
+push local 0
+"""
+
+FIBONACCI_MAIN = """\
+// Computes the n'th element of the Fibonacci series, recursively.
+// n is given in argument[0]. Called by the Sys.init function
+// (part of the Sys.vm file), which also pushes the argument[0]
+// parameter before this code starts running.
+
+function Main.fibonacci 0
+push argument 0
+push constant 2
+lt                     // checks if n<2
+if-goto IF_TRUE
+goto IF_FALSE
+label IF_TRUE          // if n<2, return n
+push argument 0
+return
+label IF_FALSE         // if n>=2, returns fib(n-2)+fib(n-1)
+push argument 0
+push constant 2
+sub
+call Main.fibonacci 1  // computes fib(n-2)
+push argument 0
+push constant 1
+sub
+call Main.fibonacci 1  // computes fib(n-1)
+add                    // returns fib(n-1) + fib(n-2)
+return
+"""
+
+FIBONACCI_SYS = """\
+// Pushes a constant, say n, onto the stack, and calls the Main.fibonacii
+// function, which computes the n'th element of the Fibonacci series.
+// Note that by convention, the Sys.init function is called "automatically"
+// by the bootstrap code.
+
+function Sys.init 0
+push constant {n}
+call Main.fibonacci 1   // computes the n'th fibonacci element
+label WHILE
+goto WHILE              // loops infinitely
+"""
+
+STATICS_CLASS = """\
+// Stores two supplied arguments in static[0] and static[1].
+function {name}.set 0
+push argument 0
+pop static 0
+push argument 1
+pop static 1
+push constant 0
+return
+
+// Returns static[0] - static[1].
+function {name}.get 0
+push static 0
+push static 1
+sub
+return
+"""
+
+STATICS_SYS = """\
+// Tests that different functions, stored in two different
+// class files, manipulate the static segment correctly.
+function Sys.init 0
+push constant 6
+push constant 8
+call Class1.set 2
+pop temp 0 // Dumps the return value
+push constant 23
+push constant 15
+call Class2.set 2
+pop temp 0 // Dumps the return value
+call Class1.get 0
+call Class2.get 0
+label WHILE
+goto WHILE
+"""
+
+
+def fibonacci(n: int) -> int:
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+
+
+def to_signed(value: int) -> int:
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def gen_arith_loop(iterations: int) -> Program:
+    sys_vm = f"""\
+function Sys.init 0
+push constant {iterations}
+call Main.run 1
+pop temp 0
+label WHILE
+goto WHILE
+"""
+    main_vm = """\
+function Main.run 3
+push constant 0
+pop local 0
+push constant 0
+pop local 1
+label LOOP
+push local 1
+push argument 0
+lt
+not
+if-goto END
+push local 0
+push local 1
+add
+push constant 3
+and
+push local 0
+add
+pop local 0
+push local 1
+push constant 7
+gt
+if-goto SKIP
+push local 2
+push constant 1
+add
+pop local 2
+label SKIP
+push local 1
+push constant 1
+add
+pop local 1
+goto LOOP
+label END
+push local 0
+push local 2
+sub
+return
+"""
+    total = count = 0
+    for i in range(iterations):
+        total = to_signed(((total + i) & 3) + total)
+        if not i > 7:
+            count += 1
+    return Program(
+        f"ArithLoop{iterations}",
+        [("ArithLoop/Main.vm", main_vm), ("ArithLoop/Sys.vm", sys_vm)],
+        bootstrap=True,
+        ram={},
+        expected={5: to_signed(total - count)},
+    )
+
+
+def gen_many_functions(count: int, seed: int = 0) -> Program:
+    rng = random.Random(seed)
+    ops = {
+        "add": lambda x, y: x + y,
+        "sub": lambda x, y: x - y,
+        "and": lambda x, y: x & y,
+        "or": lambda x, y: x | y,
+    }
+    cmps = {
+        "gt": lambda x, y: x > y,
+        "lt": lambda x, y: x < y,
+        "eq": lambda x, y: x == y,
+    }
+    functions = []
+    main_body = ["function Main.main 1", "push constant 0", "pop local 0"]
+    acc = 0
+    for k in range(count):
+        c = rng.randrange(256)
+        op = rng.choice(list(ops))
+        cmp = rng.choice(list(cmps))
+        functions.append(
+            f"""\
+function Main.f{k} 1
+push argument 0
+push constant {c}
+{op}
+push constant 255
+and
+pop local 0
+push local 0
+push argument 1
+{cmp}
+if-goto T
+push local 0
+push argument 1
+add
+return
+label T
+push local 0
+neg
+return
+"""
+        )
+        main_body.extend(
+            [
+                "push local 0",
+                f"push constant {k % 256}",
+                f"call Main.f{k} 2",
+                "pop local 0",
+            ]
+        )
+        local0 = to_signed(ops[op](acc, c)) & 255
+        if cmps[cmp](local0, k % 256):
+            acc = to_signed(-local0)
+        else:
+            acc = to_signed(local0 + k % 256)
+    main_body.extend(["push local 0", "return"])
+    sys_vm = """\
+function Sys.init 0
+call Main.main 0
+pop temp 0
+label WHILE
+goto WHILE
+"""
+    main_vm = "\n".join(main_body) + "\n" + "".join(functions)
+    return Program(
+        f"ManyFunctions{count}",
+        [("ManyFunctions/Main.vm", main_vm), ("ManyFunctions/Sys.vm", sys_vm)],
+        bootstrap=True,
+        ram={},
+        expected={5: acc},
+    )
+
+
+def standard_programs() -> list[Program]:
+    return [
+        Program(
+            "SimpleAdd",
+            [("SimpleAdd/SimpleAdd.vm", SIMPLE_ADD)],
+            bootstrap=False,
+            ram={0: 256},
+            expected={0: 257, 256: 15},
+        ),
+        Program(
+            "StackTest",
+            [("StackTest/StackTest.vm", STACK_TEST)],
+            bootstrap=False,
+            ram={0: 256},
+            expected={
+                0: 266,
+                256: -1,
+                257: 0,
+                258: 0,
+                259: 0,
+                260: -1,
+                261: 0,
+                262: -1,
+                263: 0,
+                264: 0,
+                265: -91,
+            },
+        ),
+        Program(
+            "BasicTest",
+            [("BasicTest/BasicTest.vm", BASIC_TEST)],
+            bootstrap=False,
+            ram=dict(BASIC_SEGMENTS),
+            expected={
+                256: 472,
+                300: 10,
+                401: 21,
+                402: 22,
+                3006: 36,
+                3012: 42,
+                3015: 45,
+                11: 510,
+            },
+        ),
+        Program(
+            "BasicLoop",
+            [("BasicLoop/BasicLoop.vm", BASIC_LOOP)],
+            bootstrap=False,
+            ram={0: 256, 1: 300, 2: 400, 400: 3},
+            expected={0: 257, 256: 6},
+        ),
+        Program(
+            "FibonacciElement",
+            [
+                ("FibonacciElement/Main.vm", FIBONACCI_MAIN),
+                ("FibonacciElement/Sys.vm", FIBONACCI_SYS.format(n=4)),
+            ],
+            bootstrap=True,
+            ram={},
+            expected={0: 262, 261: 3},
+        ),
+        Program(
+            "StaticsTest",
+            [
+                ("StaticsTest/Class1.vm", STATICS_CLASS.format(name="Class1")),
+                ("StaticsTest/Class2.vm", STATICS_CLASS.format(name="Class2")),
+                ("StaticsTest/Sys.vm", STATICS_SYS),
+            ],
+            bootstrap=True,
+            ram={},
+            expected={0: 263, 261: -2, 262: 8},
+        ),
+    ]
+
+
+def synthetic_programs() -> list[Program]:
+    return [
+        Program(
+            "BasicLoop1000",
+            [("BasicLoop/BasicLoop.vm", BASIC_LOOP)],
+            bootstrap=False,
+            ram={0: 256, 1: 300, 2: 400, 400: 1000},
+            expected={0: 257, 256: to_signed(1000 * 1001 // 2)},
+        ),
+        Program(
+            "Fibonacci15",
+            [
+                ("FibonacciElement/Main.vm", FIBONACCI_MAIN),
+                ("FibonacciElement/Sys.vm", FIBONACCI_SYS.format(n=15)),
+            ],
+            bootstrap=True,
+            ram={},
+            expected={0: 262, 261: fibonacci(15)},
+        ),
+        gen_arith_loop(2000),
+        gen_many_functions(100),
+        gen_many_functions(300),
+    ]
+
+
+def all_programs() -> list[Program]:
+    return standard_programs() + synthetic_programs()
@@ -0,0 +1,621 @@
+import argparse
+import os
+import time
+from typing import Callable, Optional
+
+from vm_translator import (
+    ArithmeticLogicalInstruction,
+    BranchingInstruction,
+    Instruction,
+    PushPopInstruction,
+    TranslationContext,
+    VMTranslator,
+    read_sources,
+)
+
+RAM_SIZE = 32768
+STATIC_BASE = 16
+# most VM commands compiled into one block, across all of its branches
+BLOCK_SIZE = 64
+# visits to an entry point before a block starting there is compiled, colder
+# code is interpreted since compiling costs as much as a few hundred commands
+HOT_VISITS = 8
+
+(
+    HALT,
+    LABEL,
+    PUSH_CONSTANT,
+    PUSH_SEGMENT,
+    PUSH_ADDRESS,
+    POP_SEGMENT,
+    POP_ADDRESS,
+    ADD,
+    SUB,
+    NEG,
+    EQ,
+    GT,
+    LT,
+    AND,
+    OR,
+    NOT,
+    GOTO,
+    IF_GOTO,
+    CALL,
+    FUNCTION,
+    RETURN,
+) = range(21)
+
+SEGMENT_POINTERS = {"local": 1, "argument": 2, "this": 3, "that": 4}
+
+ARITHMETIC_OPCODES = {
+    "add": ADD,
+    "sub": SUB,
+    "neg": NEG,
+    "eq": EQ,
+    "gt": GT,
+    "lt": LT,
+    "and": AND,
+    "or": OR,
+    "not": NOT,
+}
+
+JUMP_OPCODES = {GOTO, IF_GOTO}
+
+BINARY_EXPRESSIONS = {
+    ADD: "({} + {}) & 0xFFFF",
+    SUB: "({} - {}) & 0xFFFF",
+    AND: "{} & {}",
+    OR: "{} | {}",
+}
+
+# comparisons stay Python booleans until something other than if-goto uses them
+COMPARE_EXPRESSIONS = {EQ: "{} == {}", GT: "{} > {}", LT: "{} < {}"}
+
+Block = Callable[[list[int]], tuple[int, int]]
+# return address, locals saving the caller's segment pointers, the commands
+# the caller traced so far and where its result goes, in Trace.moved units
+Frame = tuple[int, list[str], frozenset[int], int]
+
+
+class VMProgram:
+    def __init__(
+        self, sources: list[tuple[str, str]], bootstrap: bool, fuse: bool = True
+    ) -> None:
+        self.static_table: dict[str, int] = {}
+        self.function_table: dict[str, int] = {}
+        # jump targets are label names until link() replaces them by indexes
+        code: list[tuple] = []
+        if bootstrap:
+            code.append((CALL, "Sys.init", 0, 0))
+            code.append((HALT, 0, 0, 0))
+        for path, content in sources:
+            ctx = TranslationContext(path)
+            parser = VMTranslator("", ctx)
+            for text in parser.cut(content):
+                code.append(self.compile(parser.str_to_instruction(text), ctx))
+        code.append((HALT, 0, 0, 0))
+        self.code: list[tuple[int, int, int, int]] = self.link(code)
+        # blocks are compiled once the emulator has entered them HOT_VISITS times
+        self.blocks: list[Optional[Block]] = [None] * len(self.code)
+        self.visits = [0] * len(self.code)
+        self.hot_visits = HOT_VISITS if fuse else None
+        self.compiler = BlockCompiler(self.code)
+
+    def compile(self, ins: Instruction, ctx: TranslationContext) -> tuple:
+        if isinstance(ins, PushPopInstruction):
+            if ins.segment == "constant":
+                if ins.command != "push":
+                    raise ValueError(f"Cannot pop to constant in {ctx.file_path}")
+                return (PUSH_CONSTANT, ins.index & 0xFFFF, 0, 0)
+            elif ins.segment in SEGMENT_POINTERS:
+                op = PUSH_SEGMENT if ins.command == "push" else POP_SEGMENT
+                return (op, SEGMENT_POINTERS[ins.segment], ins.index, 0)
+            else:
+                op = PUSH_ADDRESS if ins.command == "push" else POP_ADDRESS
+                return (op, self.address(ins, ctx), 0, 0)
+        elif isinstance(ins, ArithmeticLogicalInstruction):
+            if ins.operation not in ARITHMETIC_OPCODES:
+                raise ValueError(f"Unknown arithmetic operation: {ins.operation}")
+            return (ARITHMETIC_OPCODES[ins.operation], 0, 0, 0)
+        elif isinstance(ins, BranchingInstruction):
+            label = f"{ctx.function_current}${ins.label}"
+            if ins.command == "label":
+                return (LABEL, label, 0, 0)
+            return (GOTO if ins.command == "goto" else IF_GOTO, label, 0, 0)
+        elif ins.command == "function":
+            ctx.function_current = ins.function_name
+            return (FUNCTION, ins.function_name, ins.num_args, 0)
+        elif ins.command == "call":
+            return (CALL, ins.function_name, ins.num_args, 0)
+        return (RETURN, 0, 0, 0)
+
+    def address(self, ins: PushPopInstruction, ctx: TranslationContext) -> int:
+        if ins.segment == "static":
+            name = f"{ctx.get_file_name()}.{ins.index}"
+            if name not in self.static_table:
+                self.static_table[name] = STATIC_BASE + len(self.static_table)
+            return self.static_table[name]
+        elif ins.segment == "temp":
+            return 5 + ins.index
+        elif ins.segment == "pointer":
+            return 3 + ins.index
+        raise ValueError(f"Unknown segment: {ins.segment} in {ctx.file_path}")
+
+    def link(self, code: list[tuple]) -> list[tuple[int, int, int, int]]:
+        labels: dict[str, int] = {}
+        linked = []
+        for entry in code:
+            if entry[0] == LABEL:
+                labels[entry[1]] = len(linked)
+            else:
+                if entry[0] == FUNCTION:
+                    self.function_table[entry[1]] = len(linked)
+                linked.append(entry)
+        for index, (op, a, b, c) in enumerate(linked):
+            if op in JUMP_OPCODES:
+                if a not in labels:
+                    raise ValueError(f"Undefined label: {a}")
+                if op == GOTO and labels[a] == index:
+                    # label X / goto X never makes progress again
+                    linked[index] = (HALT, 0, 0, 0)
+                else:
+                    linked[index] = (op, labels[a], b, c)
+            elif op == CALL:
+                if a not in self.function_table:
+                    raise ValueError(f"Undefined function: {a}")
+                # the call also runs the callee's function command
+                target = self.function_table[a]
+                linked[index] = (op, target + 1, b, linked[target][2])
+            elif op == FUNCTION:
+                linked[index] = (op, 0, b, c)
+        return linked
+
+    def block(self, start: int) -> Block:
+        block = self.blocks[start] = self.compiler.compile(start)
+        return block
+
+
+class Trace:
+    def __init__(
+        self,
+        indent: str,
+        stack: Optional[list[tuple[str, bool]]] = None,
+        reads: Optional[dict[str, str]] = None,
+        depth: int = 0,
+        weight: int = 0,
+        frames: Optional[list[Frame]] = None,
+        moved: int = 0,
+    ) -> None:
+        self.indent = indent
+        # expressions for the values pushed so far, and whether each is a
+        # comparison that has not been turned into 0xFFFF/0 yet
+        self.stack = stack if stack is not None else []
+        # locals holding memory cells read since the last write
+        self.reads = reads if reads is not None else {}
+        # cells popped below sp
+        self.depth = depth
+        # VM commands run on the way to this point
+        self.weight = weight
+        # calls made inside the block, whose return address is known
+        self.frames = frames if frames is not None else []
+        # how far calls have moved sp up from ram[0] at the start of the block
+        self.moved = moved
+
+    def branch(self) -> "Trace":
+        return Trace(
+            self.indent + "    ",
+            list(self.stack),
+            dict(self.reads),
+            self.depth,
+            self.weight,
+            list(self.frames),
+            self.moved,
+        )
+
+
+class BlockCompiler:
+    def __init__(self, code: list[tuple[int, int, int, int]]) -> None:
+        self.code = code
+
+    def compile(self, start: int) -> Block:
+        # a block is a Python function running VM commands from start until a
+        # return to outside the block, a halt, a jump back into itself or
+        # BLOCK_SIZE commands, on both sides of every if-goto and through
+        # called functions; values on the stack stay in locals until the
+        # block leaves, and it returns the next command and how many VM
+        # commands it ran
+        self.lines = ["def block(ram):", "    sp = ram[0]"]
+        self.temps = 0
+        self.budget = BLOCK_SIZE
+        self.emit(start, Trace("    "), set())
+        namespace: dict[str, Block] = {}
+        exec("\n".join(self.lines), namespace)
+        return namespace["block"]
+
+    def emit(self, pc: int, trace: Trace, path: set[int]) -> None:
+        path = set(path)
+        while True:
+            if pc in path or self.budget == 0:
+                self.leave(trace, pc)
+                return
+            path.add(pc)
+            op, a, b, c = self.code[pc]
+            pc += 1
+            trace.weight += 1
+            self.budget -= 1
+            if op == PUSH_CONSTANT:
+                trace.stack.append((str(a), False))
+            elif op == PUSH_SEGMENT:
+                address = self.segment(trace, a, b)
+                trace.stack.append((self.read(trace, f"ram[{address}]"), False))
+            elif op == PUSH_ADDRESS:
+                trace.stack.append((self.read(trace, f"ram[{a}]"), False))
+            elif op == POP_SEGMENT:
+                self.write(trace, f"ram[{self.segment(trace, a, b)}]")
+            elif op == POP_ADDRESS:
+                self.write(trace, f"ram[{a}]")
+            elif op in BINARY_EXPRESSIONS:
+                y = self.pop(trace)
+                x = self.pop(trace)
+                expression = BINARY_EXPRESSIONS[op].format(x, y)
+                trace.stack.append((f"({expression})", False))
+            elif op in COMPARE_EXPRESSIONS:
+                y = self.pop(trace)
+                x = self.pop(trace)
+                if op != EQ:
+                    # signed comparison of 16-bit words
+                    x, y = signed(x), signed(y)
+                expression = COMPARE_EXPRESSIONS[op].format(x, y)
+                trace.stack.append((f"({expression})", True))
+            elif op == NOT:
+                expression, condition = self.pop_expression(trace)
+                if condition:
+                    trace.stack.append((f"(not {expression})", True))
+                else:
+                    trace.stack.append((f"({expression} ^ 0xFFFF)", False))
+            elif op == NEG:
+                trace.stack.append((f"(-{self.pop(trace)} & 0xFFFF)", False))
+            elif op == GOTO:
+                pc = a
+            elif op == IF_GOTO:
+                expression, _ = self.pop_expression(trace)
+                self.line(trace, f"if {expression}:")
+                self.emit(a, trace.branch(), path)
+            elif op == CALL:
+                self.call(trace, pc, a, b, c, frozenset(path))
+                # commands can be traced again in a deeper frame
+                path = set()
+                pc = a
+            elif op == RETURN:
+                if not trace.frames:
+                    self.ret(trace)
+                    return
+                pc, caller_path = self.inline_return(trace)
+                path = set(caller_path)
+            elif op == FUNCTION:
+                trace.stack.extend([("0", False)] * b)
+            else:
+                # -1 - the halt's own index, it stays the current command
+                self.flush(trace)
+                self.line(trace, f"return {-pc}, {trace.weight}")
+                return
+
+    def line(self, trace: Trace, text: str) -> None:
+        self.lines.append(trace.indent + text)
+
+    def read(self, trace: Trace, expression: str) -> str:
+        # memory is read in program order, and again only after a write
+        if expression not in trace.reads:
+            self.temps += 1
+            self.line(trace, f"t{self.temps} = {expression}")
+            trace.reads[expression] = f"t{self.temps}"
+        return trace.reads[expression]
+
+    def write(self, trace: Trace, target: str) -> None:
+        self.line(trace, f"{target} = {self.pop(trace)}")
+        trace.reads.clear()
+
+    def segment(self, trace: Trace, pointer: int, index: int) -> str:
+        address = self.read(trace, f"ram[{pointer}]")
+        return f"{address} + {index}" if index else address
+
+    def pop_expression(self, trace: Trace) -> tuple[str, bool]:
+        if trace.stack:
+            return trace.stack.pop()
+        trace.depth += 1
+        return self.read(trace, f"ram[sp - {trace.depth}]"), False
+
+    def pop(self, trace: Trace) -> str:
+        return value(*self.pop_expression(trace))
+
+    def flush(self, trace: Trace) -> None:
+        # the values still on the stack are written out when the block leaves
+        offset = len(trace.stack) - trace.depth
+        if trace.stack:
+            values = "".join(f"{value(*entry)}, " for entry in trace.stack)
+            end = offset_from_sp(offset)
+            self.line(trace, f"ram[{base(trace)} : {end}] = ({values})")
+        if offset:
+            self.line(trace, f"ram[0] = {offset_from_sp(offset)}")
+
+    def leave(self, trace: Trace, pc: int) -> None:
+        self.flush(trace)
+        self.line(trace, f"return {pc}, {trace.weight}")
+
+    def call(
+        self,
+        trace: Trace,
+        pc: int,
+        target: int,
+        num_args: int,
+        num_locals: int,
+        path: frozenset[int],
+    ) -> None:
+        # the arguments, the saved frame and the zeroed locals in one store
+        offset = len(trace.stack) - trace.depth
+        saved = [self.read(trace, f"ram[{i}]") for i in range(1, 5)]
+        values = [value(*entry) for entry in trace.stack] + [str(pc)] + saved
+        values += ["0"] * num_locals
+        end = offset + 5 + num_locals
+        items = "".join(f"{item}, " for item in values)
+        self.line(trace, f"ram[{base(trace)} : sp + {end}] = ({items})")
+        # the trace goes on into the callee, with its own stack and the frame
+        # pointers it was just given
+        self.line(trace, f"sp += {end}")
+        trace.moved += end
+        self.temps += 2
+        local, arg = f"t{self.temps - 1}", f"t{self.temps}"
+        if num_locals:
+            self.line(trace, f"ram[1] = {local} = sp - {num_locals}")
+            self.line(trace, "ram[0] = sp")
+        else:
+            self.line(trace, f"ram[0] = ram[1] = {local} = sp")
+        frame_size = 5 + num_locals + num_args
+        self.line(trace, f"ram[2] = {arg} = sp - {frame_size}")
+        trace.frames.append((pc, saved, path, trace.moved - frame_size))
+        trace.stack = []
+        trace.reads = {"ram[1]": local, "ram[2]": arg}
+        trace.depth = 0
+        trace.weight += 1
+
+    def ret(self, trace: Trace) -> None:
+        # the return address is read before the value can overwrite it, the
+        # argument segment starts at the frame when there are no arguments
+        result = self.pop(trace)
+        frame = self.read(trace, "ram[1]")
+        arg = self.read(trace, "ram[2]")
+        restore = "pc, ram[1], ram[2], ram[3], ram[4]"
+        self.line(trace, f"{restore} = ram[{frame} - 5 : {frame}]")
+        self.line(trace, f"ram[{arg}] = {result}")
+        self.line(trace, f"ram[0] = {arg} + 1")
+        self.line(trace, f"return pc, {trace.weight}")
+
+    def inline_return(self, trace: Trace) -> tuple[int, frozenset[int]]:
+        # a return from a call made in the block goes on tracing the caller,
+        # with the result on its stack at the callee's argument 0 and sp left
+        # where the latest call moved it
+        result = self.pop(trace)
+        pc, saved, path, arg = trace.frames.pop()
+        items = "".join(f"{item}, " for item in saved)
+        self.line(trace, f"ram[1:5] = ({items})")
+        trace.stack = [(result, False)]
+        trace.reads = {f"ram[{i}]": pointer for i, pointer in enumerate(saved, 1)}
+        trace.depth = trace.moved - arg
+        return pc, path
+
+
+def offset_from_sp(offset: int) -> str:
+    if offset:
+        return f"sp + {offset}" if offset > 0 else f"sp - {-offset}"
+    return "sp"
+
+
+def base(trace: Trace) -> str:
+    return offset_from_sp(-trace.depth)
+
+
+def value(expression: str, condition: bool) -> str:
+    return f"(0xFFFF if {expression} else 0)" if condition else expression
+
+
+def signed(expression: str) -> str:
+    if expression.isdigit():
+        return str(int(expression) ^ 0x8000)
+    return f"{expression} ^ 0x8000"
+
+
+class VMEmulator:
+    def __init__(self, program: VMProgram) -> None:
+        self.program = program
+        self.reset()
+
+    def reset(self) -> None:
+        self.ram = [0] * RAM_SIZE
+        self.ram[0] = 256
+        self.pc = 0
+        self.ops = 0
+        self.halted = False
+
+    def run(self, max_ops: int) -> int:
+        program = self.program
+        code = program.code
+        blocks = program.blocks
+        visits = program.visits
+        hot_visits = program.hot_visits
+        ram = self.ram
+        pc = self.pc
+        ops = 0
+        # blocks and runs of commands up to a jump always go to their end, so
+        # max_ops can be passed by a few commands
+        while ops < max_ops:
+            # jump and call targets and return addresses are the entry points
+            # where a hot block takes over from the interpreter
+            block = blocks[pc]
+            if block is None:
+                visits[pc] += 1
+                if visits[pc] == hot_visits:
+                    block = program.block(pc)
+            if block is not None:
+                pc, weight = block(ram)
+                ops += weight
+                if pc < 0:
+                    pc = -1 - pc
+                    self.halted = True
+                    break
+                continue
+            sp = ram[0]
+            while True:
+                op, a, b, c = code[pc]
+                pc += 1
+                ops += 1
+                if op == PUSH_CONSTANT:
+                    ram[sp] = a
+                    sp += 1
+                elif op == PUSH_SEGMENT:
+                    ram[sp] = ram[ram[a] + b]
+                    sp += 1
+                elif op == POP_SEGMENT:
+                    sp -= 1
+                    ram[ram[a] + b] = ram[sp]
+                elif op == ADD:
+                    sp -= 1
+                    ram[sp - 1] = (ram[sp - 1] + ram[sp]) & 0xFFFF
+                elif op == SUB:
+                    sp -= 1
+                    ram[sp - 1] = (ram[sp - 1] - ram[sp]) & 0xFFFF
+                elif op == IF_GOTO:
+                    sp -= 1
+                    if ram[sp]:
+                        pc = a
+                        break
+                elif op == GOTO:
+                    pc = a
+                    break
+                elif op == PUSH_ADDRESS:
+                    ram[sp] = ram[a]
+                    sp += 1
+                elif op == POP_ADDRESS:
+                    sp -= 1
+                    ram[a] = ram[sp]
+                elif op == LT:
+                    sp -= 1
+                    x, y = ram[sp - 1] ^ 0x8000, ram[sp] ^ 0x8000
+                    ram[sp - 1] = 0xFFFF if x < y else 0
+                elif op == GT:
+                    sp -= 1
+                    x, y = ram[sp - 1] ^ 0x8000, ram[sp] ^ 0x8000
+                    ram[sp - 1] = 0xFFFF if x > y else 0
+                elif op == EQ:
+                    sp -= 1
+                    ram[sp - 1] = 0xFFFF if ram[sp - 1] == ram[sp] else 0
+                elif op == CALL:
+                    # the call also runs the callee's function command
+                    saved = [pc, ram[1], ram[2], ram[3], ram[4]]
+                    ram[sp : sp + 5 + c] = saved + [0] * c
+                    ram[2] = sp - b
+                    ram[1] = sp + 5
+                    sp += 5 + c
+                    pc = a
+                    ops += 1
+                    break
+                elif op == RETURN:
+                    # the return address is read before the value can
+                    # overwrite it, as in compiled blocks
+                    frame = ram[1]
+                    arg = ram[2]
+                    result = ram[sp - 1]
+                    pc, ram[1], ram[2], ram[3], ram[4] = ram[frame - 5 : frame]
+                    ram[arg] = result
+                    sp = arg + 1
+                    break
+                elif op == AND:
+                    sp -= 1
+                    ram[sp - 1] &= ram[sp]
+                elif op == OR:
+                    sp -= 1
+                    ram[sp - 1] |= ram[sp]
+                elif op == NOT:
+                    ram[sp - 1] ^= 0xFFFF
+                elif op == NEG:
+                    ram[sp - 1] = -ram[sp - 1] & 0xFFFF
+                elif op == FUNCTION:
+                    ram[sp : sp + b] = [0] * b
+                    sp += b
+                else:
+                    # a halt stays the current command
+                    pc -= 1
+                    self.halted = True
+                    break
+            ram[0] = sp
+            if self.halted:
+                break
+        self.pc = pc
+        self.ops += ops
+        return ops
+
+    def peek(self, address: int) -> int:
+        value = self.ram[address]
+        return value - 0x10000 if value & 0x8000 else value
+
+    def poke(self, address: int, value: int) -> None:
+        self.ram[address] = value & 0xFFFF
+
+
+def parse_assignment(text: str) -> tuple[int, int]:
+    address, value = text.split("=")
+    return int(address), int(value)
+
+
+def parse_range(text: str) -> range:
+    if "-" in text:
+        start, end = text.split("-")
+        return range(int(start), int(end) + 1)
+    return range(int(text), int(text) + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VM Emulator")
+    parser.add_argument("inputpath", help="Path to the .vm file or dir to run")
+    parser.add_argument(
+        "--ops", type=int, default=100_000_000, help="Maximum VM operations to run"
+    )
+    parser.add_argument(
+        "--no-fuse",
+        action="store_true",
+        help="Interpret every VM command instead of compiling hot code",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="ADDR=VALUE",
+        help="Initial RAM value, may be repeated",
+    )
+    parser.add_argument(
+        "--dump",
+        action="append",
+        default=[],
+        metavar="ADDR[-ADDR]",
+        help="RAM cells to print after the run, may be repeated",
+    )
+    args = parser.parse_args()
+    if not os.path.exists(args.inputpath):
+        raise FileNotFoundError(f"Input path does not exist: {args.inputpath}")
+    bootstrap = os.path.isdir(args.inputpath)
+    program = VMProgram(read_sources(args.inputpath), bootstrap, not args.no_fuse)
+    emulator = VMEmulator(program)
+    for assignment in args.set:
+        emulator.poke(*parse_assignment(assignment))
+    start = time.perf_counter()
+    ops = emulator.run(args.ops)
+    elapsed = time.perf_counter() - start
+    state = "halted" if emulator.halted else "stopped"
+    print(f"{state} after {ops} VM operations")
+    print(f"{elapsed:.3f}s, {ops / elapsed if elapsed else 0:,.0f} VM operations/s")
+    for text in args.dump:
+        for address in parse_range(text):
+            print(f"RAM[{address}] = {emulator.peek(address)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,34 @@
 import argparse
 import os
+from typing import Optional
 
-file_path = ""
-function_current = "WarningNotInAFunction"
 
+class TranslationContext:
+    def __init__(self, file_path: str = "") -> None:
+        self.file_path = file_path
+        self.function_current = "WarningNotInAFunction"
+        self.num_eq = -1
+        self.num_gt = -1
+        self.num_lt = -1
+        self.current_function_call_num = 0
 
-def set_file_path(path: str) -> None:
-    global file_path
-    file_path = path
-
-
-def get_file_path() -> str:
-    global file_path
-    return file_path
-
-
-def set_function_current(function_name: str) -> None:
-    global function_current
-    function_current = function_name
-
-
-def get_function_current() -> str:
-    global function_current
-    return function_current
+    def get_file_name(self) -> str:
+        return self.file_path.split("/")[-1].split(".")[0]
 
 
 class Instruction:
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         raise NotImplementedError("Subclasses should implement this method")
 
 
 class ArithmeticLogicalInstruction(Instruction):
-    num_eq = -1
-    num_gt = -1
-    num_lt = -1
-
     def __init__(self, operation: str) -> None:
         self.operation = operation
 
     def __repr__(self) -> str:
         return self.operation
 
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         match self.operation:
             case "add":
                 return [
@@ -75,7 +62,7 @@ class ArithmeticLogicalInstruction(Instruction):
                 return ["//neg", "@SP", "AM=M-1", "M=-M", "@SP", "M=M+1", ""]
 
             case "eq":
-                ArithmeticLogicalInstruction.num_eq += 1
+                ctx.num_eq += 1
                 return [
                     "//eq",
                     "@SP",
@@ -84,25 +71,25 @@ class ArithmeticLogicalInstruction(Instruction):
                     "@SP",
                     "AM=M-1",
                     "D=D-M",
-                    f"@EQ_TRUE.{ArithmeticLogicalInstruction.num_eq}",
+                    f"@EQ_TRUE.{ctx.num_eq}",
                     "D;JEQ",
                     "@SP",
                     "A=M",
                     "M=0",
-                    f"@EQ_END.{ArithmeticLogicalInstruction.num_eq}",
+                    f"@EQ_END.{ctx.num_eq}",
                     "0;JMP",
-                    f"(EQ_TRUE.{ArithmeticLogicalInstruction.num_eq})",
+                    f"(EQ_TRUE.{ctx.num_eq})",
                     "@SP",
                     "A=M",
                     "M=-1",
-                    f"(EQ_END.{ArithmeticLogicalInstruction.num_eq})",
+                    f"(EQ_END.{ctx.num_eq})",
                     "@SP",
                     "M=M+1",
                     "",
                 ]
 
             case "gt":
-                ArithmeticLogicalInstruction.num_gt += 1
+                ctx.num_gt += 1
                 return [
                     "//gt",
                     "@SP",
@@ -111,25 +98,25 @@ class ArithmeticLogicalInstruction(Instruction):
                     "@SP",
                     "AM=M-1",
                     "D=M-D",
-                    f"@GT_TRUE.{ArithmeticLogicalInstruction.num_gt}",
+                    f"@GT_TRUE.{ctx.num_gt}",
                     "D;JGT",
                     "@SP",
                     "A=M",
                     "M=0",
-                    f"@GT_END.{ArithmeticLogicalInstruction.num_gt}",
+                    f"@GT_END.{ctx.num_gt}",
                     "0;JMP",
-                    f"(GT_TRUE.{ArithmeticLogicalInstruction.num_gt})",
+                    f"(GT_TRUE.{ctx.num_gt})",
                     "@SP",
                     "A=M",
                     "M=-1",
-                    f"(GT_END.{ArithmeticLogicalInstruction.num_gt})",
+                    f"(GT_END.{ctx.num_gt})",
                     "@SP",
                     "M=M+1",
                     "",
                 ]
 
             case "lt":
-                ArithmeticLogicalInstruction.num_lt += 1
+                ctx.num_lt += 1
                 return [
                     "//lt",
                     "@SP",
@@ -138,18 +125,18 @@ class ArithmeticLogicalInstruction(Instruction):
                     "@SP",
                     "AM=M-1",
                     "D=M-D",
-                    f"@LT_TRUE.{ArithmeticLogicalInstruction.num_lt}",
+                    f"@LT_TRUE.{ctx.num_lt}",
                     "D;JLT",
                     "@SP",
                     "A=M",
                     "M=0",
-                    f"@LT_END.{ArithmeticLogicalInstruction.num_lt}",
+                    f"@LT_END.{ctx.num_lt}",
                     "0;JMP",
-                    f"(LT_TRUE.{ArithmeticLogicalInstruction.num_lt})",
+                    f"(LT_TRUE.{ctx.num_lt})",
                     "@SP",
                     "A=M",
                     "M=-1",
-                    f"(LT_END.{ArithmeticLogicalInstruction.num_lt})",
+                    f"(LT_END.{ctx.num_lt})",
                     "@SP",
                     "M=M+1",
                     "",
@@ -197,7 +184,7 @@ class PushPopInstruction(Instruction):
     def __repr__(self) -> str:
         return f"{self.command} {self.segment} {self.index}"
 
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         if self.segment in ["local", "argument", "this", "that"]:
             segment_base = {
                 "local": "LCL",
@@ -250,7 +237,7 @@ class PushPopInstruction(Instruction):
                 "",
             ]
         elif self.segment == "static":
-            file_name = get_file_path().split("/")[-1].split(".")[0]
+            file_name = ctx.get_file_name()
             if self.command == "push":
                 return [
                     f"//push static {self.index}",
@@ -307,8 +294,8 @@ class BranchingInstruction(Instruction):
     def __repr__(self) -> str:
         return f"{self.command} {self.label}"
 
-    def to_asm(self) -> list[str]:
-        function_current = get_function_current()
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
+        function_current = ctx.function_current
         if self.command == "label":
             return [
                 f"//label {self.label}",
@@ -337,8 +324,6 @@ class BranchingInstruction(Instruction):
 
 
 class FunctionInstruction(Instruction):
-    current_function_call_num = 0
-
     def __init__(
         self, command: str, function_name: str = "", num_args: int = 0
     ) -> None:
@@ -352,9 +337,9 @@ class FunctionInstruction(Instruction):
         else:
             return f"{self.command} {self.function_name} {self.num_args}"
 
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         if self.command == "function":
-            set_function_current(self.function_name)
+            ctx.function_current = self.function_name
             asm_lines = [
                 f"//function {self.function_name} {self.num_args}",
                 f"({self.function_name})",
@@ -372,9 +357,9 @@ class FunctionInstruction(Instruction):
                 )
             return asm_lines
         elif self.command == "call":
-            i = FunctionInstruction.current_function_call_num
-            FunctionInstruction.current_function_call_num += 1
-            function_current = get_function_current()
+            i = ctx.current_function_call_num
+            ctx.current_function_call_num += 1
+            function_current = ctx.function_current
             return [
                 f"//call {self.function_name} {self.num_args}",
                 f"@{function_current}$ret.{i}",
@@ -428,7 +413,7 @@ class FunctionInstruction(Instruction):
                 "",
             ]
         elif self.command == "return":
-            FunctionInstruction.current_function_call_num = 0
+            ctx.current_function_call_num = 0
             return [
                 "//return",
                 "@LCL",
@@ -479,11 +464,12 @@ class FunctionInstruction(Instruction):
 
 
 class VMTranslator:
-    def __init__(self, vm_code: str) -> None:
+    def __init__(self, vm_code: str, ctx: Optional[TranslationContext] = None) -> None:
+        self.ctx = ctx if ctx is not None else TranslationContext()
         self.instructions = [self.str_to_instruction(ins) for ins in self.cut(vm_code)]
         self.asm = []
         for ins in self.instructions:
-            asm_lines = ins.to_asm()
+            asm_lines = ins.to_asm(self.ctx)
             self.asm.extend(asm_lines)
 
     def cut(self, vm_code: str) -> list[str]:
@@ -545,10 +531,42 @@ class VMTranslator:
                 return FunctionInstruction(command, function_name, num_args)
         else:
             raise ValueError(
-                f"Unknown VM instruction: {instruction} in {get_file_path()}"
+                f"Unknown VM instruction: {instruction} in {self.ctx.file_path}"
             )
 
 
+def translate(sources: list[tuple[str, str]], bootstrap: bool) -> list[str]:
+    ctx = TranslationContext()
+    asm = []
+    if bootstrap:
+        asm.extend(["@256", "D=A", "@SP", "M=D"])
+        # call function Sys.init
+        initCall = FunctionInstruction("call", "Sys.init", 0)
+        asm.extend(initCall.to_asm(ctx))
+    for path, content in sources:
+        ctx.file_path = path
+        ctx.function_current = "WarningNotInAFunction"
+        vm_translator = VMTranslator(content, ctx)
+        asm.extend(vm_translator.asm)
+    return asm
+
+
+def read_sources(inputpath: str) -> list[tuple[str, str]]:
+    if os.path.isdir(inputpath):
+        paths = [
+            os.path.join(inputpath, file_name)
+            for file_name in sorted(os.listdir(inputpath))
+            if file_name.endswith(".vm")
+        ]
+    else:
+        paths = [inputpath]
+    sources = []
+    for path in paths:
+        with open(path, "r") as f:
+            sources.append((path, f.read()))
+    return sources
+
+
 def main():
     parser = argparse.ArgumentParser(description="VM to ASM Translator")
     parser.add_argument("inputpath", help="Path to the file or dir to read")
@@ -564,40 +582,22 @@ def main():
             dir_name = os.path.basename(os.path.normpath(inputpath))
             parent_dir = os.path.dirname(os.path.normpath(inputpath))
             output_path = os.path.join(parent_dir, dir_name + ".asm")
+        asm = translate(read_sources(inputpath), bootstrap=True)
         with open(output_path, "w") as f:
             f.write("// Translated by VMTranslator\n")
             f.write("// Input directory: " + inputpath + "\n")
             f.write("\n")
-            f.write("@256\n")
-            f.write("D=A\n")
-            f.write("@SP\n")
-            f.write("M=D\n")
-            # call function Sys.init
-            initCall = FunctionInstruction("call", "Sys.init", 0)
-            for line in initCall.to_asm():
+            for line in asm:
                 f.write(line + "\n")
-        for file_name in os.listdir(inputpath):
-            if file_name.endswith(".vm"):
-                set_file_path(os.path.join(inputpath, file_name))
-                set_function_current("WarningNotInAFunction")
-                with open(os.path.join(inputpath, file_name), "r") as f:
-                    content = f.read()
-                vm_translator = VMTranslator(content)
-                with open(output_path, "a") as f:
-                    for line in vm_translator.asm:
-                        f.write(line + "\n")
     else:
-        set_file_path(args.inputpath)
-        with open(args.inputpath, "r") as f:
-            content = f.read()
-        vm_translator = VMTranslator(content)
+        asm = translate(read_sources(inputpath), bootstrap=False)
         if args.o:
             output_path = args.o
         else:
             base, _ = os.path.splitext(args.inputpath)
             output_path = base + ".asm"
         with open(output_path, "w") as f:
-            for line in vm_translator.asm:
+            for line in asm:
                 f.write(line + "\n")
 
 
@@ -1,9 +1,13 @@
 import argparse
+import hashlib
+import json
 import os
-
-file_path = ""
-function_current = "WarningNotInAFunction"
-
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable, Optional
 
 eq_share = [
     "(Eq_share)",
@@ -237,43 +241,131 @@ def gen_Function_m_Local_share(m: int) -> list[str]:
         ]
 
 
-Function_Local_set = set()
-
-function_Local_share = []
-
-
-def deal_with_Function_Local_share(m: int) -> None:
-    global function_Local_share
-    global Function_Local_set
-    if m not in Function_Local_set:
-        Function_Local_set.add(m)
-        function_Local_share.extend(gen_Function_m_Local_share(m))
-
-
-def set_file_path(path: str) -> None:
-    global file_path
-    file_path = path
-
-
-def get_file_path() -> str:
-    global file_path
-    return file_path
-
-
-def set_function_current(function_name: str) -> None:
-    global function_current
-    function_current = function_name
-
-
-def get_function_current() -> str:
-    global function_current
-    return function_current
+class TranslationContext:
+    def __init__(self, file_path: str = "") -> None:
+        self.file_path = file_path
+        self.function_current = "WarningNotInAFunction"
+        self.function_local_set: set[int] = set()
+        self.num_eq = -1
+        self.num_gt = -1
+        self.num_lt = -1
+        self.current_function_call_num = 0
+        self.call_num = -1
+        self.function_define_num = -1
+        self.eqAfterPush_num = -1
+        self.gtAfterPush_num = -1
+        self.ltAfterPush_num = -1
+        # the top of the stack is in D and not yet written to the stack
+        self.tos_in_d = False
+        # with a virtual SP the real stack pointer is RAM[SP] + sp_offset
+        self.virtual_sp = False
+        self.sp_offset = 0
+        # functions keeping their arguments and locals in fixed cells
+        self.static_frames: dict[str, "StaticFrame"] = {}
+        self.frame: Optional["StaticFrame"] = None
+
+    def get_file_name(self) -> str:
+        return self.file_path.split("/")[-1].split(".")[0]
+
+    def scoped_label(self, name: str, num: int) -> str:
+        # numbered labels restart in every file, the file name keeps them apart
+        file_name = self.get_file_name()
+        return f"{name}_{file_name}.{num}" if file_name else f"{name}_{num}"
 
 
 class ExtendedInstruction:
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         raise NotImplementedError("Subclasses should implement this method")
 
+    def to_asm_tos(self, ctx: TranslationContext) -> list[str]:
+        # instructions that do not know about the cached top of the stack get
+        # it written back first
+        return flush_stack(ctx) + self.to_asm(ctx)
+
+
+def stack_slot(ctx: TranslationContext, offset: int) -> list[str]:
+    # A = RAM[SP] + offset, a slot further away than M-1 moves RAM[SP] on the
+    # way there for the same number of words, that keeps the offset small
+    if offset == 0:
+        return ["@SP", "A=M"]
+    elif offset == -1:
+        return ["@SP", "A=M-1"]
+    elif offset > 0:
+        ctx.sp_offset -= offset
+        return ["@SP"] + ["M=M+1"] * (offset - 1) + ["AM=M+1"]
+    ctx.sp_offset -= offset + 1
+    return ["@SP"] + ["M=M-1"] * (-offset - 2) + ["AM=M-1", "A=A-1"]
+
+
+def spill_tos(ctx: TranslationContext) -> list[str]:
+    if not ctx.tos_in_d:
+        return []
+    ctx.tos_in_d = False
+    if not ctx.virtual_sp:
+        return ["@SP", "M=M+1", "A=M-1", "M=D"]
+    slot = ctx.sp_offset
+    ctx.sp_offset += 1
+    return stack_slot(ctx, slot) + ["M=D"]
+
+
+def pop_slot(ctx: TranslationContext) -> list[str]:
+    # A = address of the top of the stack, removed from the stack
+    if not ctx.virtual_sp:
+        return ["@SP", "AM=M-1"]
+    ctx.sp_offset -= 1
+    return stack_slot(ctx, ctx.sp_offset)
+
+
+def pop_tos(ctx: TranslationContext) -> list[str]:
+    # D = top of the stack, removed from the stack
+    if ctx.tos_in_d:
+        return []
+    return pop_slot(ctx) + ["D=M"]
+
+
+def pop_slot_committed(ctx: TranslationContext) -> list[str]:
+    # pop_slot with the virtual SP written back on the way
+    offset = ctx.sp_offset - 1
+    ctx.sp_offset = 0
+    if offset == 0:
+        return ["@SP", "A=M"]
+    step = "M=M+1" if offset > 0 else "M=M-1"
+    return ["@SP"] + [step] * (abs(offset) - 1) + ["A" + step]
+
+
+def pop_tos_committed(ctx: TranslationContext) -> list[str]:
+    if ctx.tos_in_d:
+        return commit_sp(ctx)
+    return pop_slot_committed(ctx) + ["D=M"]
+
+
+def flush_stack(ctx: TranslationContext) -> list[str]:
+    # the stack as the plain instructions expect it
+    if ctx.tos_in_d and ctx.sp_offset == 0:
+        ctx.tos_in_d = False
+        return ["@SP", "M=M+1", "A=M-1", "M=D"]
+    return spill_tos(ctx) + commit_sp(ctx)
+
+
+def commit_sp(ctx: TranslationContext) -> list[str]:
+    # writes the virtual SP back before code that reads RAM[SP], keeps D
+    offset = ctx.sp_offset
+    ctx.sp_offset = 0
+    if offset == 0:
+        return []
+    elif abs(offset) <= 3:
+        return ["@SP"] + ["M=M+1" if offset > 0 else "M=M-1"] * abs(offset)
+    return [
+        "@R13",
+        "M=D",
+        f"@{abs(offset)}",
+        "D=A",
+        "@SP",
+        "M=D+M" if offset > 0 else "M=M-D",
+        "@R13",
+        "D=M",
+    ]
+
 
 class Instruction(ExtendedInstruction):
     pass
@@ -284,9 +376,6 @@ class MultiInstruction(ExtendedInstruction):
 
 
 class ArithmeticLogicalInstruction(Instruction):
-    num_eq = -1
-    num_gt = -1
-    num_lt = -1
 
     def __init__(self, operation: str) -> None:
         self.operation = operation
@@ -294,7 +383,7 @@ class ArithmeticLogicalInstruction(Instruction):
     def __repr__(self) -> str:
         return self.operation
 
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         match self.operation:
             case "add":
                 return [
@@ -318,39 +407,42 @@ class ArithmeticLogicalInstruction(Instruction):
                 return ["@SP", "A=M-1", "M=-M"]
 
             case "eq":
-                ArithmeticLogicalInstruction.num_eq += 1
+                ctx.num_eq += 1
+                label = ctx.scoped_label("Eq", ctx.num_eq)
                 return [
-                    f"@Eq_{ArithmeticLogicalInstruction.num_eq}",
+                    f"@{label}",
                     "D=A",
                     "@R15",
                     "M=D",
                     "@Eq_share",
                     "0;JMP",
-                    f"(Eq_{ArithmeticLogicalInstruction.num_eq})",
+                    f"({label})",
                 ]
 
             case "gt":
-                ArithmeticLogicalInstruction.num_gt += 1
+                ctx.num_gt += 1
+                label = ctx.scoped_label("Gt", ctx.num_gt)
                 return [
-                    f"@Gt_{ArithmeticLogicalInstruction.num_gt}",
+                    f"@{label}",
                     "D=A",
                     "@R15",
                     "M=D",
                     "@Gt_share",
                     "0;JMP",
-                    f"(Gt_{ArithmeticLogicalInstruction.num_gt})",
+                    f"({label})",
                 ]
 
             case "lt":
-                ArithmeticLogicalInstruction.num_lt += 1
+                ctx.num_lt += 1
+                label = ctx.scoped_label("Lt", ctx.num_lt)
                 return [
-                    f"@Lt_{ArithmeticLogicalInstruction.num_lt}",
+                    f"@{label}",
                     "D=A",
                     "@R15",
                     "M=D",
                     "@Lt_share",
                     "0;JMP",
-                    f"(Lt_{ArithmeticLogicalInstruction.num_lt})",
+                    f"({label})",
                 ]
 
             case "and":
@@ -375,17 +467,38 @@ class ArithmeticLogicalInstruction(Instruction):
             case _:
                 raise ValueError(f"Unknown arithmetic operation: {self.operation}")
 
+    def to_asm_tos(self, ctx: TranslationContext) -> list[str]:
+        if self.operation in BINOP_SYMBOLS:
+            # y in D, x comes off the stack
+            asm = pop_tos(ctx) + pop_slot(ctx)
+            ctx.tos_in_d = True
+            return asm + [f"D={binop_comp(self.operation, 'M', d_is_left=False)}"]
+        elif self.operation in ("neg", "not") and ctx.tos_in_d:
+            return ["D=-D" if self.operation == "neg" else "D=!D"]
+        elif self.operation in ("eq", "gt", "lt") and ctx.tos_in_d:
+            ctx.tos_in_d = False
+            return (
+                commit_sp(ctx)
+                + ["@R13", "M=D"]
+                + call_after_push_share(self.operation, ctx)
+            )
+        return super().to_asm_tos(ctx)
+
 
 class PushPopInstruction(Instruction):
-    def __init__(self, command: str, segment: str, index: int) -> None:
+    def __init__(
+        self, command: str, segment: str, index: int, file_name: str = ""
+    ) -> None:
         self.command = command
         self.segment = segment
         self.index = index
+        # the file a static belongs to when it is not the one translated
+        self.file_name = file_name
 
     def __repr__(self) -> str:
         return f"{self.command} {self.segment} {self.index}"
 
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         if self.segment in ["local", "argument", "this", "that"]:
             segment_base = {
                 "local": "LCL",
@@ -429,30 +542,11 @@ class PushPopInstruction(Instruction):
                 "A=M-1",
                 "M=D",
             ]
-        elif self.segment == "static":
-            file_name = get_file_path().split("/")[-1].split(".")[0]
-            if self.command == "push":
-                return [
-                    f"@{file_name}.{self.index}",
-                    "D=M",
-                    "@SP",
-                    "M=M+1",
-                    "A=M-1",
-                    "M=D",
-                ]
-            else:
-                return [
-                    "@SP",
-                    "AM=M-1",
-                    "D=M",
-                    f"@{file_name}.{self.index}",
-                    "M=D",
-                ]
         else:
-            base_address = 5 if self.segment == "temp" else 3
+            address = direct_address(self, ctx)
             if self.command == "push":
                 return [
-                    f"@{base_address + self.index}",
+                    f"@{address}",
                     "D=M",
                     "@SP",
                     "M=M+1",
@@ -464,10 +558,29 @@ class PushPopInstruction(Instruction):
                     "@SP",
                     "AM=M-1",
                     "D=M",
-                    f"@{base_address + self.index}",
+                    f"@{address}",
                     "M=D",
                 ]
 
+    def to_asm_tos(self, ctx: TranslationContext) -> list[str]:
+        if self.command == "push":
+            asm = spill_tos(ctx) + load_to_d(self, ctx)
+            ctx.tos_in_d = True
+            return asm
+        to_a = address_to_a(self, ctx)
+        if not ctx.tos_in_d and (to_a is None or not ctx.virtual_sp):
+            return commit_sp(ctx) + self.to_asm(ctx)
+        asm = pop_tos(ctx)
+        ctx.tos_in_d = False
+        if to_a is not None:
+            return asm + to_a + ["M=D"]
+        return (
+            asm
+            + ["@R14", "M=D"]
+            + store_d(self, ctx)[0]
+            + ["@R14", "D=M", "@R13", "A=M", "M=D"]
+        )
+
 
 class BranchingInstruction(Instruction):
     def __init__(self, command: str, label: str) -> None:
@@ -477,8 +590,8 @@ class BranchingInstruction(Instruction):
     def __repr__(self) -> str:
         return f"{self.command} {self.label}"
 
-    def to_asm(self) -> list[str]:
-        function_current = get_function_current()
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
+        function_current = ctx.function_current
         if self.command == "label":
             return [
                 f"({function_current}${self.label})",
@@ -499,11 +612,15 @@ class BranchingInstruction(Instruction):
         else:
             raise ValueError(f"Unknown branching command: {self.command}")
 
+    def to_asm_tos(self, ctx: TranslationContext) -> list[str]:
+        if self.command == "if-goto":
+            asm = pop_tos_committed(ctx)
+            ctx.tos_in_d = False
+            return asm + [f"@{ctx.function_current}${self.label}", "D;JNE"]
+        return super().to_asm_tos(ctx)
+
 
 class FunctionInstruction(Instruction):
-    current_function_call_num = 0
-    call_num = -1
-    function_define_num = -1
 
     def __init__(
         self, command: str, function_name: str = "", num_args: int = 0
@@ -518,10 +635,13 @@ class FunctionInstruction(Instruction):
         else:
             return f"{self.command} {self.function_name} {self.num_args}"
 
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         if self.command == "function":
-            set_function_current(self.function_name)
-            if self.num_args == 0:
+            ctx.function_current = self.function_name
+            ctx.frame = ctx.static_frames.get(self.function_name)
+            if ctx.frame is not None:
+                return [f"({self.function_name})"] + ctx.frame.entry()
+            elif self.num_args == 0:
                 return [
                     f"({self.function_name})",
                 ]
@@ -534,23 +654,34 @@ class FunctionInstruction(Instruction):
                     "M=0",
                 ]
             else:
-                deal_with_Function_Local_share(self.num_args)
-                FunctionInstruction.function_define_num += 1
+                ctx.function_local_set.add(self.num_args)
+                ctx.function_define_num += 1
+                label = ctx.scoped_label(
+                    "FunctionLocal_share", ctx.function_define_num
+                )
                 return [
                     f"({self.function_name})",
-                    f"@FunctionLocal_share_{FunctionInstruction.function_define_num}",
+                    f"@{label}",
                     "D=A",
                     "@R15",
                     "M=D",
                     f"@Function{self.num_args}Local_share",
                     "0;JMP",
-                    f"(FunctionLocal_share_{FunctionInstruction.function_define_num})",
+                    f"({label})",
                 ]
         elif self.command == "call":
-            i = FunctionInstruction.current_function_call_num
-            FunctionInstruction.current_function_call_num += 1
-            FunctionInstruction.call_num += 1
-            function_current = get_function_current()
+            frame = ctx.static_frames.get(self.function_name)
+            if frame is not None:
+                asm = []
+                for index in reversed(range(self.num_args)):
+                    cell = frame_slot(frame.argument(index))
+                    asm.extend(["@SP", "AM=M-1", "D=M", f"@{cell}", "M=D"])
+                return asm + self.static_call(ctx, frame)
+            i = ctx.current_function_call_num
+            ctx.current_function_call_num += 1
+            ctx.call_num += 1
+            label = ctx.scoped_label("Call", ctx.call_num)
+            function_current = ctx.function_current
             return [
                 f"@{function_current}$ret.{i}",
                 "D=A",
@@ -560,19 +691,22 @@ class FunctionInstruction(Instruction):
                 "D=A",
                 "@R14",
                 "M=D",
-                f"@Call_{FunctionInstruction.call_num}",
+                f"@{label}",
                 "D=A",
                 "@R15",
                 "M=D",
                 "@Call_share",
                 "0;JMP",
-                f"(Call_{FunctionInstruction.call_num})",
+                f"({label})",
                 f"@{self.function_name}",
                 "0;JMP",
                 f"({function_current}$ret.{i})",
             ]
         elif self.command == "return":
-            FunctionInstruction.current_function_call_num = 0
+            ctx.current_function_call_num = 0
+            if ctx.frame is not None:
+                # the return value stays where the first argument was
+                return ctx.frame.restore_pointers() + ctx.frame.return_jump()
             return [
                 "@Return_share",
                 "0;JMP",
@@ -580,6 +714,43 @@ class FunctionInstruction(Instruction):
         else:
             raise ValueError(f"Unknown function command: {self.command}")
 
+    def static_call(self, ctx: TranslationContext, frame: "StaticFrame") -> list[str]:
+        # the arguments are in the frame already
+        i = ctx.current_function_call_num
+        ctx.current_function_call_num += 1
+        return_label = f"{ctx.function_current}$ret.{i}"
+        return [
+            f"@{return_label}",
+            "D=A",
+            f"@{frame.return_address()}",
+            "M=D",
+            f"@{self.function_name}",
+            "0;JMP",
+            f"({return_label})",
+        ]
+
+    def to_asm_tos(self, ctx: TranslationContext) -> list[str]:
+        # a static frame returns its value in D instead of on the stack
+        frame = ctx.static_frames.get(self.function_name)
+        if self.command == "call" and frame is not None:
+            asm = []
+            for index in reversed(range(self.num_args)):
+                cell = frame_slot(frame.argument(index))
+                asm.extend(pop_tos(ctx) + [f"@{cell}", "M=D"])
+                ctx.tos_in_d = False
+            asm.extend(flush_stack(ctx) + self.static_call(ctx, frame))
+            ctx.tos_in_d = True
+            return asm
+        elif self.command == "return" and ctx.frame is not None:
+            ctx.current_function_call_num = 0
+            asm = []
+            if ctx.frame.saved_pointers:
+                asm.extend(flush_stack(ctx) + ctx.frame.restore_pointers())
+            asm.extend(pop_tos_committed(ctx) + ctx.frame.return_jump())
+            ctx.tos_in_d = False
+            return asm
+        return super().to_asm_tos(ctx)
+
 
 class PopAfterPushInstruction(MultiInstruction):
     def __init__(
@@ -591,7 +762,7 @@ class PopAfterPushInstruction(MultiInstruction):
     def __repr__(self) -> str:
         return f"move {self.push_ins.segment} {self.push_ins.index} to {self.pop_ins.segment} {self.pop_ins.index}"
 
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         if self.pop_ins.segment in ["local", "argument", "this", "that"]:
             pop_segment_base = {
                 "local": "LCL",
@@ -632,66 +803,16 @@ class PopAfterPushInstruction(MultiInstruction):
                     "A=M",
                     "M=D",
                 ]
-            elif self.push_ins.segment == "static":
-                file_name = get_file_path().split("/")[-1].split(".")[0]
-                return save_target_address + [
-                    f"@{file_name}.{self.push_ins.index}",
-                    "D=M",
-                    "@R13",
-                    "A=M",
-                    "M=D",
-                ]
             else:
-                base_address = 5 if self.push_ins.segment == "temp" else 3
                 return save_target_address + [
-                    f"@{base_address + self.push_ins.index}",
+                    f"@{direct_address(self.push_ins, ctx)}",
                     "D=M",
                     "@R13",
                     "A=M",
                     "M=D",
                 ]
-        elif self.pop_ins.segment == "static":
-            file_name = get_file_path().split("/")[-1].split(".")[0]
-            if self.push_ins.segment in ["local", "argument", "this", "that"]:
-                push_segment_base = {
-                    "local": "LCL",
-                    "argument": "ARG",
-                    "this": "THIS",
-                    "that": "THAT",
-                }[self.push_ins.segment]
-                return [
-                    f"@{push_segment_base}",
-                    "D=M",
-                    f"@{self.push_ins.index}",
-                    "A=D+A",
-                    "D=M",
-                    f"@{file_name}.{self.pop_ins.index}",
-                    "M=D",
-                ]
-            elif self.push_ins.segment == "constant":
-                return [
-                    f"@{self.push_ins.index}",
-                    "D=A",
-                    f"@{file_name}.{self.pop_ins.index}",
-                    "M=D",
-                ]
-            elif self.push_ins.segment == "static":
-                return [
-                    f"@{file_name}.{self.push_ins.index}",
-                    "D=M",
-                    f"@{file_name}.{self.pop_ins.index}",
-                    "M=D",
-                ]
-            else:
-                base_address = 5 if self.push_ins.segment == "temp" else 3
-                return [
-                    f"@{base_address + self.push_ins.index}",
-                    "D=M",
-                    f"@{file_name}.{self.pop_ins.index}",
-                    "M=D",
-                ]
         else:
-            pop_base_address = 5 if self.pop_ins.segment == "temp" else 3
+            pop_address = direct_address(self.pop_ins, ctx)
             if self.push_ins.segment in ["local", "argument", "this", "that"]:
                 push_segment_base = {
                     "local": "LCL",
@@ -705,30 +826,21 @@ class PopAfterPushInstruction(MultiInstruction):
                     f"@{self.push_ins.index}",
                     "A=D+A",
                     "D=M",
-                    f"@{pop_base_address + self.pop_ins.index}",
+                    f"@{pop_address}",
                     "M=D",
                 ]
             elif self.push_ins.segment == "constant":
                 return [
                     f"@{self.push_ins.index}",
                     "D=A",
-                    f"@{pop_base_address + self.pop_ins.index}",
-                    "M=D",
-                ]
-            elif self.push_ins.segment == "static":
-                file_name = get_file_path().split("/")[-1].split(".")[0]
-                return [
-                    f"@{file_name}.{self.push_ins.index}",
-                    "D=M",
-                    f"@{pop_base_address + self.pop_ins.index}",
+                    f"@{pop_address}",
                     "M=D",
                 ]
             else:
-                push_base_address = 5 if self.push_ins.segment == "temp" else 3
                 return [
-                    f"@{push_base_address + self.push_ins.index}",
+                    f"@{direct_address(self.push_ins, ctx)}",
                     "D=M",
-                    f"@{pop_base_address + self.pop_ins.index}",
+                    f"@{pop_address}",
                     "M=D",
                 ]
 
@@ -741,7 +853,7 @@ class AddSubAndOrAfterPushInstruction(MultiInstruction):
     def __repr__(self) -> str:
         return f"{self.after} {self.push_ins.segment} {self.push_ins.index}"
 
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         do = (
             "M=D+M"
             if self.after == "add"
@@ -776,30 +888,26 @@ class AddSubAndOrAfterPushInstruction(MultiInstruction):
                 "A=M-1",
                 do,
             ]
-        elif self.push_ins.segment == "static":
-            file_name = get_file_path().split("/")[-1].split(".")[0]
-            return [
-                f"@{file_name}.{self.push_ins.index}",
-                "D=M",
-                "@SP",
-                "A=M-1",
-                do,
-            ]
         else:
-            base_address = 5 if self.push_ins.segment == "temp" else 3
             return [
-                f"@{base_address + self.push_ins.index}",
+                f"@{direct_address(self.push_ins, ctx)}",
                 "D=M",
                 "@SP",
                 "A=M-1",
                 do,
             ]
 
+    def to_asm_tos(self, ctx: TranslationContext) -> list[str]:
+        if not ctx.tos_in_d and (
+            not ctx.virtual_sp or operand_to_a(self.push_ins, ctx) is None
+        ):
+            return super().to_asm_tos(ctx)
+        asm = pop_tos(ctx)
+        ctx.tos_in_d = True
+        return asm + binop_with_d(self.after, self.push_ins, ctx)
+
 
 class EqGtLtAfterPushInstruction(MultiInstruction):
-    eqAfterPush_num = -1
-    gtAfterPush_num = -1
-    ltAfterPush_num = -1
 
     def __init__(self, push_ins: PushPopInstruction, after: str) -> None:
         self.push_ins = push_ins
@@ -808,7 +916,7 @@ class EqGtLtAfterPushInstruction(MultiInstruction):
     def __repr__(self) -> str:
         return f"{self.after} after {self.push_ins.segment} {self.push_ins.index}"
 
-    def to_asm(self) -> list[str]:
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
         if self.push_ins.segment in ["local", "argument", "this", "that"]:
             segment_base = {
                 "local": "LCL",
@@ -832,56 +940,54 @@ class EqGtLtAfterPushInstruction(MultiInstruction):
                 "@R13",
                 "M=D",
             ]
-        elif self.push_ins.segment == "static":
-            file_name = get_file_path().split("/")[-1].split(".")[0]
-            save_y_to_R13 = [
-                f"@{file_name}.{self.push_ins.index}",
-                "D=M",
-                "@R13",
-                "M=D",
-            ]
         else:
-            base_address = 5 if self.push_ins.segment == "temp" else 3
             save_y_to_R13 = [
-                f"@{base_address + self.push_ins.index}",
+                f"@{direct_address(self.push_ins, ctx)}",
                 "D=M",
                 "@R13",
                 "M=D",
             ]
-        if self.after == "eq":
-            EqGtLtAfterPushInstruction.eqAfterPush_num += 1
-            doAfter = [
-                f"@EqAfterPush_{EqGtLtAfterPushInstruction.eqAfterPush_num}",
-                "D=A",
-                "@R15",
-                "M=D",
-                "@EqAfterPush_share",
-                "0;JMP",
-                f"(EqAfterPush_{EqGtLtAfterPushInstruction.eqAfterPush_num})",
-            ]
-        elif self.after == "gt":
-            EqGtLtAfterPushInstruction.gtAfterPush_num += 1
-            doAfter = [
-                f"@GtAfterPush_{EqGtLtAfterPushInstruction.gtAfterPush_num}",
-                "D=A",
-                "@R15",
-                "M=D",
-                "@GtAfterPush_share",
-                "0;JMP",
-                f"(GtAfterPush_{EqGtLtAfterPushInstruction.gtAfterPush_num})",
-            ]
-        else:
-            EqGtLtAfterPushInstruction.ltAfterPush_num += 1
-            doAfter = [
-                f"@LtAfterPush_{EqGtLtAfterPushInstruction.ltAfterPush_num}",
-                "D=A",
-                "@R15",
-                "M=D",
-                "@LtAfterPush_share",
-                "0;JMP",
-                f"(LtAfterPush_{EqGtLtAfterPushInstruction.ltAfterPush_num})",
-            ]
-        return save_y_to_R13 + doAfter
+        return save_y_to_R13 + call_after_push_share(self.after, ctx)
+
+
+def call_after_push_share(operation: str, ctx: TranslationContext) -> list[str]:
+    # y is in R13 and x on top of the stack
+    if operation == "eq":
+        ctx.eqAfterPush_num += 1
+        label = ctx.scoped_label("EqAfterPush", ctx.eqAfterPush_num)
+        return [
+            f"@{label}",
+            "D=A",
+            "@R15",
+            "M=D",
+            "@EqAfterPush_share",
+            "0;JMP",
+            f"({label})",
+        ]
+    elif operation == "gt":
+        ctx.gtAfterPush_num += 1
+        label = ctx.scoped_label("GtAfterPush", ctx.gtAfterPush_num)
+        return [
+            f"@{label}",
+            "D=A",
+            "@R15",
+            "M=D",
+            "@GtAfterPush_share",
+            "0;JMP",
+            f"({label})",
+        ]
+    else:
+        ctx.ltAfterPush_num += 1
+        label = ctx.scoped_label("LtAfterPush", ctx.ltAfterPush_num)
+        return [
+            f"@{label}",
+            "D=A",
+            "@R15",
+            "M=D",
+            "@LtAfterPush_share",
+            "0;JMP",
+            f"({label})",
+        ]
 
 
 class IfGotoAfterPushInstruction(MultiInstruction):
@@ -894,8 +1000,8 @@ class IfGotoAfterPushInstruction(MultiInstruction):
     def __repr__(self) -> str:
         return f"if-goto after {self.push_ins.segment} {self.push_ins.index} to {self.if_goto_ins.label}"
 
-    def to_asm(self) -> list[str]:
-        function_current = get_function_current()
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
+        function_current = ctx.function_current
         if self.push_ins.segment in ["local", "argument", "this", "that"]:
             segment_base = {
                 "local": "LCL",
@@ -917,18 +1023,9 @@ class IfGotoAfterPushInstruction(MultiInstruction):
                 return []
             else:
                 return [f"@{function_current}${self.if_goto_ins.label}", "0;JMP"]
-        elif self.push_ins.segment == "static":
-            file_name = get_file_path().split("/")[-1].split(".")[0]
-            return [
-                f"@{file_name}.{self.push_ins.index}",
-                "D=M",
-                f"@{function_current}${self.if_goto_ins.label}",
-                "D;JNE",
-            ]
         else:
-            base_address = 5 if self.push_ins.segment == "temp" else 3
             return [
-                f"@{base_address + self.push_ins.index}",
+                f"@{direct_address(self.push_ins, ctx)}",
                 "D=M",
                 f"@{function_current}${self.if_goto_ins.label}",
                 "D;JNE",
@@ -945,8 +1042,8 @@ class IfGotoAfterEqGtLtInstruction(MultiInstruction):
     def __repr__(self) -> str:
         return f"if {self.comp_ins.operation} goto {self.if_goto_ins.label}"
 
-    def to_asm(self) -> list[str]:
-        function_current = get_function_current()
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
+        function_current = ctx.function_current
         jump_cmd = (
             "D;JEQ"
             if self.comp_ins.operation == "eq"
@@ -965,15 +1062,345 @@ class IfGotoAfterEqGtLtInstruction(MultiInstruction):
             jump_cmd,
         ]
 
+    def to_asm_tos(self, ctx: TranslationContext) -> list[str]:
+        asm = pop_tos(ctx) + pop_slot_committed(ctx) + ["D=M-D"]
+        ctx.tos_in_d = False
+        # the jump of the plain version
+        return asm + self.to_asm(ctx)[-2:]
+
+
+SEGMENT_BASES = {"local": "LCL", "argument": "ARG", "this": "THIS", "that": "THAT"}
+BINOP_SYMBOLS = {"add": "+", "sub": "-", "and": "&", "or": "|"}
+
+
+def direct_address(ins: PushPopInstruction, ctx: TranslationContext) -> Optional[str]:
+    if ins.segment == "static":
+        return f"{ins.file_name or ctx.get_file_name()}.{ins.index}"
+    elif ins.segment in ["temp", "pointer"]:
+        base_address = 5 if ins.segment == "temp" else 3
+        return str(base_address + ins.index)
+    elif ins.segment == "frame":
+        return frame_slot(ins.index)
+    return None
+
+
+def address_to_a(
+    ins: PushPopInstruction, ctx: TranslationContext
+) -> Optional[list[str]]:
+    # points A at the cell without touching D, segment cells only near the base
+    address = direct_address(ins, ctx)
+    if address is not None:
+        return [f"@{address}"]
+    elif ins.segment in SEGMENT_BASES and ins.index <= 2:
+        return [f"@{SEGMENT_BASES[ins.segment]}", "A=M"] + ["A=A+1"] * ins.index
+    return None
+
+
+def load_to_d(ins: PushPopInstruction, ctx: TranslationContext) -> list[str]:
+    if ins.segment == "constant":
+        return [f"@{ins.index}", "D=A"]
+    to_a = address_to_a(ins, ctx)
+    if to_a is not None:
+        return to_a + ["D=M"]
+    return [
+        f"@{SEGMENT_BASES[ins.segment]}",
+        "D=M",
+        f"@{ins.index}",
+        "A=D+A",
+        "D=M",
+    ]
+
+
+def operand_to_a(
+    ins: PushPopInstruction, ctx: TranslationContext
+) -> Optional[tuple[list[str], str]]:
+    # the operand as A or M without touching D
+    if ins.segment == "constant":
+        return [f"@{ins.index}"], "A"
+    to_a = address_to_a(ins, ctx)
+    return (to_a, "M") if to_a is not None else None
+
+
+def binop_comp(operation: str, other: str, d_is_left: bool = True) -> str:
+    if operation == "sub" and not d_is_left:
+        return f"{other}-D"
+    return f"D{BINOP_SYMBOLS[operation]}{other}"
+
+
+def binop_to_d(
+    x_ins: PushPopInstruction,
+    y_ins: PushPopInstruction,
+    operation: str,
+    ctx: TranslationContext,
+) -> list[str]:
+    y_operand = operand_to_a(y_ins, ctx)
+    if y_operand is not None:
+        to_a, other = y_operand
+        return load_to_d(x_ins, ctx) + to_a + [f"D={binop_comp(operation, other)}"]
+    x_operand = operand_to_a(x_ins, ctx)
+    if x_operand is not None:
+        to_a, other = x_operand
+        return (
+            load_to_d(y_ins, ctx)
+            + to_a
+            + [f"D={binop_comp(operation, other, d_is_left=False)}"]
+        )
+    return (
+        load_to_d(x_ins, ctx)
+        + ["@R14", "M=D"]
+        + load_to_d(y_ins, ctx)
+        + ["@R14", f"D={binop_comp(operation, 'M', d_is_left=False)}"]
+    )
+
+
+def binop_with_d(
+    operation: str, y_ins: PushPopInstruction, ctx: TranslationContext
+) -> list[str]:
+    # D = D op y
+    y_operand = operand_to_a(y_ins, ctx)
+    if y_operand is not None:
+        to_a, other = y_operand
+        return to_a + [f"D={binop_comp(operation, other)}"]
+    return (
+        ["@R14", "M=D"]
+        + load_to_d(y_ins, ctx)
+        + ["@R14", f"D={binop_comp(operation, 'M', d_is_left=False)}"]
+    )
+
+
+def store_d(
+    pop_ins: PushPopInstruction, ctx: TranslationContext
+) -> tuple[list[str], list[str]]:
+    # (code to run before D is computed, code storing D in the cell)
+    to_a = address_to_a(pop_ins, ctx)
+    if to_a is not None:
+        return [], to_a + ["M=D"]
+    save_target_address = [
+        f"@{SEGMENT_BASES[pop_ins.segment]}",
+        "D=M",
+        f"@{pop_ins.index}",
+        "D=D+A",
+        "@R13",
+        "M=D",
+    ]
+    return save_target_address, ["@R13", "A=M", "M=D"]
+
+
+class PushPushBinopInstruction(MultiInstruction):
+    def __init__(
+        self, x_ins: PushPopInstruction, y_ins: PushPopInstruction, operation: str
+    ) -> None:
+        self.x_ins = x_ins
+        self.y_ins = y_ins
+        self.operation = operation
+
+    def __repr__(self) -> str:
+        return (
+            f"push {self.x_ins.segment} {self.x_ins.index} {self.operation} "
+            f"{self.y_ins.segment} {self.y_ins.index}"
+        )
+
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
+        return binop_to_d(self.x_ins, self.y_ins, self.operation, ctx) + [
+            "@SP",
+            "M=M+1",
+            "A=M-1",
+            "M=D",
+        ]
+
+    def to_asm_tos(self, ctx: TranslationContext) -> list[str]:
+        asm = spill_tos(ctx) + binop_to_d(self.x_ins, self.y_ins, self.operation, ctx)
+        ctx.tos_in_d = True
+        return asm
+
+
+class PushPushBinopPopInstruction(MultiInstruction):
+    def __init__(
+        self,
+        x_ins: PushPopInstruction,
+        y_ins: PushPopInstruction,
+        operation: str,
+        pop_ins: PushPopInstruction,
+    ) -> None:
+        self.x_ins = x_ins
+        self.y_ins = y_ins
+        self.operation = operation
+        self.pop_ins = pop_ins
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.pop_ins.segment} {self.pop_ins.index} = "
+            f"{self.x_ins.segment} {self.x_ins.index} {self.operation} "
+            f"{self.y_ins.segment} {self.y_ins.index}"
+        )
+
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
+        save_target_address, store = store_d(self.pop_ins, ctx)
+        return (
+            save_target_address
+            + binop_to_d(self.x_ins, self.y_ins, self.operation, ctx)
+            + store
+        )
+
+
+class PushBinopPopInstruction(MultiInstruction):
+    def __init__(
+        self, y_ins: PushPopInstruction, operation: str, pop_ins: PushPopInstruction
+    ) -> None:
+        self.y_ins = y_ins
+        self.operation = operation
+        self.pop_ins = pop_ins
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.pop_ins.segment} {self.pop_ins.index} = top {self.operation} "
+            f"{self.y_ins.segment} {self.y_ins.index}"
+        )
+
+    def to_asm(self, ctx: TranslationContext) -> list[str]:
+        save_target_address, store = store_d(self.pop_ins, ctx)
+        pop_x = ["@SP", "AM=M-1", "D=M"]
+        compute = binop_with_d(self.operation, self.y_ins, ctx)
+        return save_target_address + pop_x + compute + store
+
+    def to_asm_tos(self, ctx: TranslationContext) -> list[str]:
+        save_target_address, store = store_d(self.pop_ins, ctx)
+        if save_target_address:
+            return super().to_asm_tos(ctx)
+        asm = pop_tos(ctx)
+        ctx.tos_in_d = False
+        return asm + binop_with_d(self.operation, self.y_ins, ctx) + store
+
+
+def instruction_token(ins: Instruction) -> str:
+    if isinstance(ins, ArithmeticLogicalInstruction):
+        return ins.operation
+    return ins.command
+
+
+PUSH = {"push"}
+POP = {"pop"}
+IF_GOTO = {"if-goto"}
+ADD_SUB_AND_OR = {"add", "sub", "and", "or"}
+EQ_GT_LT = {"eq", "gt", "lt"}
+
+# (token sets matched one instruction each, factory for the replacement)
+PEEPHOLE_PATTERNS: list[tuple[tuple[set[str], ...], Callable]] = [
+    (
+        (PUSH, EQ_GT_LT, IF_GOTO),
+        lambda push, cmp, if_goto: [
+            push,
+            IfGotoAfterEqGtLtInstruction(cmp, if_goto),
+        ],
+    ),
+    (
+        (PUSH, PUSH, ADD_SUB_AND_OR, POP),
+        lambda x, y, op, pop: [PushPushBinopPopInstruction(x, y, op.operation, pop)],
+    ),
+    (
+        (PUSH, PUSH, ADD_SUB_AND_OR),
+        lambda x, y, op: [PushPushBinopInstruction(x, y, op.operation)],
+    ),
+    (
+        (PUSH, ADD_SUB_AND_OR, POP),
+        lambda y, op, pop: [PushBinopPopInstruction(y, op.operation, pop)],
+    ),
+    (
+        (PUSH, EQ_GT_LT),
+        lambda push, cmp: [EqGtLtAfterPushInstruction(push, cmp.operation)],
+    ),
+    (
+        (PUSH, ADD_SUB_AND_OR),
+        lambda push, op: [AddSubAndOrAfterPushInstruction(push, op.operation)],
+    ),
+    ((PUSH, POP), lambda push, pop: [PopAfterPushInstruction(push, pop)]),
+    (
+        (PUSH, IF_GOTO),
+        lambda push, if_goto: [IfGotoAfterPushInstruction(push, if_goto)],
+    ),
+    (
+        (EQ_GT_LT, IF_GOTO),
+        lambda cmp, if_goto: [IfGotoAfterEqGtLtInstruction(cmp, if_goto)],
+    ),
+]
+
+
+class PeepholeMatcher:
+    def __init__(
+        self, patterns: list[tuple[tuple[set[str], ...], Callable]]
+    ) -> None:
+        # a trie over instruction tokens, a node is (edges, factory)
+        self.root: tuple[dict, list] = ({}, [None])
+        for tokens, factory in patterns:
+            nodes = [self.root]
+            for token_set in tokens:
+                next_nodes = []
+                for edges, _ in nodes:
+                    for token in sorted(token_set):
+                        next_nodes.append(edges.setdefault(token, ({}, [None])))
+                nodes = next_nodes
+            for _, node_factory in nodes:
+                # earlier patterns win over later ones of the same length
+                if node_factory[0] is None:
+                    node_factory[0] = factory
+
+    def match(self, instructions: list[Instruction]) -> list[ExtendedInstruction]:
+        # longest match at every position, patterns are a few instructions
+        # long so this stays linear in the number of instructions
+        tokens = [instruction_token(ins) for ins in instructions]
+        extended_instructions: list[ExtendedInstruction] = []
+        i = 0
+        while i < len(instructions):
+            edges, _ = self.root
+            longest = None
+            j = i
+            while j < len(instructions) and tokens[j] in edges:
+                edges, factory = edges[tokens[j]]
+                j += 1
+                if factory[0] is not None:
+                    longest = (j, factory[0])
+            if longest is None:
+                extended_instructions.append(instructions[i])
+                i += 1
+            else:
+                end, factory = longest
+                extended_instructions.extend(factory(*instructions[i:end]))
+                i = end
+        return extended_instructions
+
+
+peephole_matcher = PeepholeMatcher(PEEPHOLE_PATTERNS)
+
 
 class VMTranslator:
-    def __init__(self, vm_code: str) -> None:
+    def __init__(
+        self,
+        vm_code: str,
+        ctx: Optional[TranslationContext] = None,
+        tos_cache: bool = False,
+        virtual_sp: bool = False,
+        static_frames: Optional[dict[str, "StaticFrame"]] = None,
+        inlines: Optional[dict[str, tuple]] = None,
+    ) -> None:
+        self.ctx = ctx if ctx is not None else TranslationContext()
+        # the virtual SP is kept by the same code generator as the cached TOS
+        self.ctx.virtual_sp = virtual_sp
+        tos_cache = tos_cache or virtual_sp
+        self.ctx.static_frames = static_frames or {}
         self.instructions = [self.str_to_instruction(ins) for ins in self.cut(vm_code)]
+        self.vm_code_optimizer = VMCodeOptimizer(self.instructions, inlines)
+        self.instructions = self.vm_code_optimizer.optimized_code
+        if static_frames:
+            self.instructions = frame_segments(self.instructions, static_frames)
         self.extended_instructions = self.using_extenedinstruction()
         self.asm = []
         for ins in self.extended_instructions:
-            asm_lines = ins.to_asm()
+            if tos_cache:
+                asm_lines = ins.to_asm_tos(self.ctx)
+            else:
+                asm_lines = ins.to_asm(self.ctx)
             self.asm.extend(asm_lines)
+        self.asm.extend(flush_stack(self.ctx))
 
     def cut(self, vm_code: str) -> list[str]:
         instructions = []
@@ -1034,120 +1461,11 @@ class VMTranslator:
                 return FunctionInstruction(command, function_name, num_args)
         else:
             raise ValueError(
-                f"Unknown VM instruction: {instruction} in {get_file_path()}"
+                f"Unknown VM instruction: {instruction} in {self.ctx.file_path}"
             )
 
     def using_extenedinstruction(self) -> list[ExtendedInstruction]:
-        extended_instructions = []
-        i = 0
-        while i < len(self.instructions):
-            ins_now = self.instructions[i]
-            if isinstance(ins_now, PushPopInstruction) and ins_now.command == "push":
-                if i + 1 < len(self.instructions):
-                    ins_next = self.instructions[i + 1]
-                    if isinstance(
-                        ins_next, ArithmeticLogicalInstruction
-                    ) and ins_next.operation in [
-                        "add",
-                        "sub",
-                        "and",
-                        "or",
-                        "eq",
-                        "gt",
-                        "lt",
-                    ]:
-                        if ins_next.operation in ["eq", "gt", "lt"]:
-                            if i + 2 < len(self.instructions):
-                                ins_next_next = self.instructions[i + 2]
-                                if (
-                                    isinstance(ins_next_next, BranchingInstruction)
-                                    and ins_next_next.command == "if-goto"
-                                ):
-                                    extended_instructions.append(ins_now)
-                                    extended_instructions.append(
-                                        IfGotoAfterEqGtLtInstruction(
-                                            ins_next, ins_next_next
-                                        )
-                                    )
-                                    i += 3
-                                    continue
-                                else:
-                                    extended_instructions.append(
-                                        EqGtLtAfterPushInstruction(
-                                            ins_now, ins_next.operation
-                                        )
-                                    )
-                                    i += 2
-                                    continue
-                            else:
-                                extended_instructions.append(
-                                    EqGtLtAfterPushInstruction(
-                                        ins_now, ins_next.operation
-                                    )
-                                )
-                                i += 2
-                                continue
-                        else:
-                            extended_instructions.append(
-                                AddSubAndOrAfterPushInstruction(
-                                    ins_now, ins_next.operation
-                                )
-                            )
-                            i += 2
-                            continue
-                    elif (
-                        isinstance(ins_next, PushPopInstruction)
-                        and ins_next.command == "pop"
-                    ):
-                        extended_instructions.append(
-                            PopAfterPushInstruction(ins_now, ins_next)
-                        )
-                        i += 2
-                        continue
-                    elif (
-                        isinstance(ins_next, BranchingInstruction)
-                        and ins_next.command == "if-goto"
-                    ):
-                        extended_instructions.append(
-                            IfGotoAfterPushInstruction(ins_now, ins_next)
-                        )
-                        i += 2
-                        continue
-                    else:
-                        extended_instructions.append(ins_now)
-                        i += 1
-                        continue
-                else:
-                    extended_instructions.append(ins_now)
-                    i += 1
-                    continue
-            elif isinstance(
-                ins_now, ArithmeticLogicalInstruction
-            ) and ins_now.operation in ["eq", "gt", "lt"]:
-                if i + 1 < len(self.instructions):
-                    ins_next = self.instructions[i + 1]
-                    if (
-                        isinstance(ins_next, BranchingInstruction)
-                        and ins_next.command == "if-goto"
-                    ):
-                        extended_instructions.append(
-                            IfGotoAfterEqGtLtInstruction(ins_now, ins_next)
-                        )
-                        i += 2
-                        continue
-                    else:
-                        extended_instructions.append(ins_now)
-                        i += 1
-                        continue
-                else:
-                    extended_instructions.append(ins_now)
-                    i += 1
-                    continue
-            else:
-                extended_instructions.append(ins_now)
-                i += 1
-                continue
-        return extended_instructions
+        return peephole_matcher.match(self.instructions)
 
 
 class Asm:
@@ -1185,116 +1503,1005 @@ class LAsm(Asm):
         return f"({self.label})"
 
 
+REGISTER_ADDRESSES = {
+    "SP": 0,
+    "LCL": 1,
+    "ARG": 2,
+    "THIS": 3,
+    "THAT": 4,
+    **{f"R{i}": i for i in range(16)},
+    "SCREEN": 16384,
+    "KBD": 24576,
+}
+
+SP_NAMES = {"SP", "R0", "0"}
+
+# a value is (base, offset): base None is a constant, a str is the address
+# of an assembler symbol and an int numbers an otherwise unknown value
+Value = tuple
+
+
+def symbol_value(symbol: str) -> Value:
+    if symbol.isdigit():
+        return (None, int(symbol))
+    elif symbol in REGISTER_ADDRESSES:
+        return (None, REGISTER_ADDRESSES[symbol])
+    return (symbol, 0)
+
+
+def is_register(address: Optional[Value]) -> bool:
+    return address is not None and address[0] is None and address[1] < 16
+
+
+class ValueTable:
+    def __init__(self) -> None:
+        self.count = 0
+        self.expressions: dict[tuple, Value] = {}
+        # unknown values loaded from SP, everything based on them is a stack
+        # address, which never aliases the registers or the statics
+        self.stack_bases: set[int] = set()
+        self.memory: dict[Value, Value] = {}
+        self.a = self.fresh()
+        self.d = self.fresh()
+
+    def fresh(self) -> Value:
+        self.count += 1
+        return (self.count, 0)
+
+    def expression(self, op: str, x: Value, y: Optional[Value] = None) -> Value:
+        key = (op, x, y)
+        if key not in self.expressions:
+            self.expressions[key] = self.fresh()
+        return self.expressions[key]
+
+    def kind(self, address: Value) -> str:
+        base, offset = address
+        if base is None or (isinstance(base, str) and offset == 0):
+            return "fixed"
+        elif base in self.stack_bases:
+            return "stack"
+        return "other"
+
+    def may_alias(self, x: Value, y: Value) -> bool:
+        if x == y:
+            return True
+        elif x[0] == y[0] and not isinstance(x[0], str):
+            return False
+        kinds = {self.kind(x), self.kind(y)}
+        if kinds == {"fixed"}:
+            # variables are allocated from 16 on, above the registers
+            numeric = [v[1] for v in (x, y) if v[0] is None]
+            return len(numeric) == 1 and numeric[0] >= 16
+        return kinds != {"fixed", "stack"}
+
+    def load(self, address: Value) -> Value:
+        if address not in self.memory:
+            value = self.fresh()
+            if address == (None, 0):
+                self.stack_bases.add(value[0])
+            self.memory[address] = value
+        return self.memory[address]
+
+    def store(self, address: Value, value: Value) -> None:
+        for known in [k for k in self.memory if self.may_alias(k, address)]:
+            del self.memory[known]
+        self.memory[address] = value
+
+    def operand(self, name: str) -> Value:
+        if name == "A":
+            return self.a
+        elif name == "D":
+            return self.d
+        elif name == "M":
+            return self.load(self.a)
+        return (None, int(name))
+
+    def evaluate(self, comp: str) -> Value:
+        if comp in ("0", "1"):
+            return (None, int(comp))
+        elif comp == "-1":
+            return (None, 0xFFFF)
+        elif len(comp) == 1:
+            return self.operand(comp)
+        elif len(comp) == 2:
+            x = self.operand(comp[1])
+            if x[0] is None:
+                return (None, (-x[1] if comp[0] == "-" else ~x[1]) & 0xFFFF)
+            return self.expression(comp[0], x)
+        x, op, y = self.operand(comp[0]), comp[1], self.operand(comp[2])
+        if op == "-":
+            if y[0] is None or x[0] == y[0]:
+                return (x[0] if y[0] is None else None, (x[1] - y[1]) & 0xFFFF)
+            return self.expression(op, x, y)
+        if x[0] is None and y[0] is None:
+            if op == "+":
+                return (None, (x[1] + y[1]) & 0xFFFF)
+            return (None, x[1] & y[1] if op == "&" else x[1] | y[1])
+        if op == "+" and (x[0] is None or y[0] is None):
+            base = y[0] if x[0] is None else x[0]
+            return (base, (x[1] + y[1]) & 0xFFFF)
+        return self.expression(op, *sorted((x, y), key=repr))
+
+
+FALL = "fall"
+JUMP = "jump"
+SHARED_RETURN = "shared_return"
+CALL_RETURN = "call_return"
+
+
+def edge_kind(block: list[Asm], index: int) -> str:
+    # how the label loaded by the @ at index is used
+    if index + 1 < len(block) and isinstance(block[index + 1], CAsm):
+        if block[index + 1].jump:
+            return JUMP
+    for ins in block[index + 1 :]:
+        if isinstance(ins, AAsm):
+            return SHARED_RETURN if ins.value == "R15" else CALL_RETURN
+    return CALL_RETURN
+
+
+class ControlFlowGraph:
+    def __init__(self, blocks: list[list[Asm]]) -> None:
+        # blocks end at labels and unconditional jumps only, a conditional
+        # jump inside a block adds a jump edge from that block
+        self.blocks = blocks
+        self.labels = {
+            block[0].label: index
+            for index, block in enumerate(blocks)
+            if isinstance(block[0], LAsm)
+        }
+        self.successors: list[list[tuple[int, str]]] = [[] for _ in blocks]
+        self.predecessors: list[list[tuple[int, str]]] = [[] for _ in blocks]
+        for index, block in enumerate(blocks):
+            for i, ins in enumerate(block):
+                # a label whose address is taken is entered through an
+                # indirect jump once the routine it was handed to returns
+                if isinstance(ins, AAsm) and ins.value in self.labels:
+                    self.add_edge(index, self.labels[ins.value], edge_kind(block, i))
+            if not ends_with_jump(block) and index + 1 < len(blocks):
+                self.add_edge(index, index + 1, FALL)
+
+    def add_edge(self, source: int, target: int, kind: str) -> None:
+        self.successors[source].append((target, kind))
+        self.predecessors[target].append((source, kind))
+
+    def fall_through(self, index: int) -> Optional[int]:
+        for target, kind in self.successors[index]:
+            if kind == FALL:
+                return target
+        return None
+
+    def reachable(self) -> list[int]:
+        if not self.blocks:
+            return []
+        visited = [False] * len(self.blocks)
+        visited[0] = True
+        stack = [0]
+        while stack:
+            for target, _ in self.successors[stack.pop()]:
+                if not visited[target]:
+                    visited[target] = True
+                    stack.append(target)
+        return [index for index, seen in enumerate(visited) if seen]
+
+    def reachable_blocks(self) -> list[list[Asm]]:
+        return [self.blocks[index] for index in self.reachable()]
+
+
 class AsmOptimizer:
     def __init__(self, asm_code: list[str]) -> None:
-        self.asm = [parse(line) for line in asm_code if line.strip()]
-        self.basic_blocks = self.cut_to_basic_blocks()
-        self.reachable_blocks = self.find_reachable_blocks()
-        self.reachable_blocks_optimized = [
-            self.delete_useless_AAsm(block) for block in self.reachable_blocks
+        # the passes never modify an Asm in place, equal lines can share one
+        parsed: dict[str, Asm] = {}
+        self.asm = [
+            parsed.get(line) or parsed.setdefault(line, parse(line))
+            for line in asm_code
+            if line.strip()
         ]
-        self.optimized_asm = [
-            item for block in self.reachable_blocks_optimized for item in block
+        self.basic_blocks = cut_to_basic_blocks(self.asm)
+        self.reachable_blocks = ControlFlowGraph(self.basic_blocks).reachable_blocks()
+        self.reachable_blocks_optimized = [
+            self.optimize_block(block) for block in self.reachable_blocks
         ]
+        # threading leaves blocks behind that nothing jumps to any more
+        threaded_blocks = self.thread_jumps(
+            ControlFlowGraph(self.reachable_blocks_optimized)
+        )
+        self.cfg = ControlFlowGraph(
+            ControlFlowGraph(threaded_blocks).reachable_blocks()
+        )
+        self.laid_out_blocks = self.lay_out_blocks(self.cfg)
+        self.optimized_asm = self.remove_jumps_to_next(
+            [item for block in self.laid_out_blocks for item in block]
+        )
 
-    def cut_to_basic_blocks(self) -> list[list[Asm]]:
-        blocks: list[list[Asm]] = []
-        current_block: list[Asm] = []
-        for ins in self.asm:
-            if isinstance(ins, LAsm):
-                if current_block:
-                    blocks.append(current_block)
-                current_block = [ins]
-            elif isinstance(ins, CAsm) and ins.jump == "JMP":
-                current_block.append(ins)
-                blocks.append(current_block)
-                current_block = []
-            else:
-                current_block.append(ins)
-        if current_block:
-            blocks.append(current_block)
-        return blocks
-
-    def find_reachable_blocks(self) -> list[list[Asm]]:
-        reachable_blocks: list[int] = []
-        visited = set()
-        table = {"Start": 0} if self.basic_blocks else {}
-        for index, block in enumerate(self.basic_blocks):
-            if isinstance(block[0], LAsm):
-                label = block[0].label
-                table[label] = index
-        stack = ["Start"] if self.basic_blocks else []
-        while stack:
-            label = stack.pop()
-            index = table[label]
-            if index not in visited:
-                visited.add(index)
-                reachable_blocks.append(index)
-                block = self.basic_blocks[index]
-                for i, ins in enumerate(block):
-                    if isinstance(ins, CAsm) and ins.jump and i > 0:
-                        last_ins = block[i - 1]
-                        if isinstance(last_ins, AAsm):
-                            target_label = last_ins.value
-                            stack.append(target_label)
-                            share_list = [
-                                "Eq_share",
-                                "EqAfterPush_share",
-                                "Gt_share",
-                                "GtAfterPush_share",
-                                "Lt_share",
-                                "LtAfterPush_share",
-                                "Call_share",
-                            ]
-                            global Function_Local_set
-                            share_list.extend(
-                                [f"Function{m}Local_share" for m in Function_Local_set]
-                            )
-                            if target_label in share_list:
-                                next_block = self.basic_blocks[index + 1]
-                                if isinstance(next_block[0], LAsm):
-                                    target_label = next_block[0].label
-                                    stack.append(target_label)
-                if label.startswith("Call_"):
-                    next_block = self.basic_blocks[index + 1]
-                    if isinstance(next_block[0], LAsm):
-                        target_label = next_block[0].label
-                        stack.append(target_label)
-                if not (isinstance(block[-1], CAsm) and block[-1].jump == "JMP"):
-                    next_block = (
-                        self.basic_blocks[index + 1]
-                        if index + 1 < len(self.basic_blocks)
-                        else []
-                    )
-                    if next_block and isinstance(next_block[0], LAsm):
-                        target_label = next_block[0].label
-                        stack.append(target_label)
-
-        reachable_blocks.sort()
-        return [self.basic_blocks[i] for i in reachable_blocks]
-
-    def delete_useless_AAsm(self, block: list[Asm]) -> list[Asm]:
-        optimized_block = []
-        ARegister = None
+    def optimize_block(self, block: list[Asm]) -> list[Asm]:
+        block = self.remove_sp_round_trips(block)
+        block, addresses = self.number_values(block)
+        return self.remove_dead_stores(block, addresses)
+
+    def remove_sp_round_trips(self, block: list[Asm]) -> list[Asm]:
+        # @SP M=M+1 ... @SP AM=M-1 leaves SP as it was: drop both updates
+        # and shift the reads of SP in between by one
+        changed = True
+        while changed:
+            changed = False
+            for index in range(1, len(block)):
+                ins, last_ins = block[index], block[index - 1]
+                if (
+                    isinstance(ins, CAsm)
+                    and isinstance(last_ins, AAsm)
+                    and last_ins.value in SP_NAMES
+                    and ins.comp in ("M+1", "M-1")
+                    and "M" in ins.dest
+                    and not ins.jump
+                ):
+                    rewritten = self.undo_sp_step(block, index)
+                    if rewritten is not None:
+                        block = rewritten
+                        changed = True
+                        break
+        return block
+
+    def undo_sp_step(self, block: list[Asm], start: int) -> Optional[list[Asm]]:
+        step = block[start]
+        undo = "M-1" if step.comp == "M+1" else "M+1"
+        if step.comp == "M+1":
+            shifted = {"M-1": "M", "M": "M+1"}
+        else:
+            shifted = {"M+1": "M", "M": "M-1"}
+        rewrites: dict[int, Optional[Asm]] = {start: without_m(step, step.comp)}
+        a_kind = "stack" if "A" in step.dest else "sp"
+        for index in range(start + 1, len(block)):
+            ins = block[index]
+            if isinstance(ins, AAsm):
+                a_kind = "sp" if ins.value in SP_NAMES else "fixed"
+                continue
+            elif not isinstance(ins, CAsm) or ins.jump:
+                return None
+            uses_m = "M" in ins.comp or "M" in ins.dest
+            if a_kind == "sp" and uses_m:
+                if "M" in ins.dest:
+                    if ins.comp != undo:
+                        return None
+                    rewrites[index] = without_m(ins, "M")
+                    rewritten = [rewrites.get(i, ins) for i, ins in enumerate(block)]
+                    return [ins for ins in rewritten if ins is not None]
+                elif ins.comp not in shifted:
+                    return None
+                rewrites[index] = (
+                    CAsm(f"{ins.dest}={shifted[ins.comp]}") if ins.dest else None
+                )
+            elif a_kind == "unknown" and uses_m:
+                return None
+            if "A" in ins.dest:
+                if a_kind == "sp" and ins.comp in shifted:
+                    a_kind = "stack"
+                elif not (a_kind == "stack" and ins.comp in ("A+1", "A-1")):
+                    a_kind = "unknown"
+        return None
+
+    def number_values(
+        self, block: list[Asm]
+    ) -> tuple[list[Asm], list[Optional[Value]]]:
+        values = ValueTable()
+        optimized_block: list[Asm] = []
+        addresses: list[Optional[Value]] = []
+        # the value A had before the @X emitted last, if nothing used it yet
+        a_before: Optional[Value] = None
         for ins in block:
             if isinstance(ins, AAsm):
-                if ins.value == ARegister:
+                value = symbol_value(ins.value)
+                if value == values.a:
                     continue
-                else:
-                    optimized_block.append(ins)
-                    ARegister = ins.value
-            elif isinstance(ins, CAsm):
-                if "A" in ins.dest:
-                    ARegister = None
+                a_before = values.a
+                values.a = value
                 optimized_block.append(ins)
-            else:
+                addresses.append(None)
+                continue
+            elif isinstance(ins, LAsm):
                 optimized_block.append(ins)
+                addresses.append(None)
+                a_before = None
+                continue
+            address = values.a
+            result = values.evaluate(ins.comp)
+            if not ins.jump and ins.dest == "A" and result == a_before:
+                # @X A=... restoring the old A, X was only read on the way
+                optimized_block.pop()
+                addresses.pop()
+                values.a = result
+                a_before = None
+                continue
+            a_before = None
+            if not ins.jump and (
+                ("A" not in ins.dest or values.a == result)
+                and ("D" not in ins.dest or values.d == result)
+                and ("M" not in ins.dest or values.memory.get(address) == result)
+            ):
+                continue
+            if "M" in ins.dest:
+                values.store(address, result)
+            if "A" in ins.dest:
+                values.a = result
+            if "D" in ins.dest:
+                values.d = result
+            optimized_block.append(ins)
+            addresses.append(address if values.kind(address) != "other" else None)
+        return optimized_block, addresses
+
+    def remove_dead_stores(
+        self, block: list[Asm], addresses: list[Optional[Value]]
+    ) -> list[Asm]:
+        # everything is live where the block is left, registers overwritten
+        # further down without being read in between are not
+        live_a = live_d = True
+        dead_registers: set[int] = set()
+        optimized_block: list[Asm] = []
+        for ins, address in zip(reversed(block), reversed(addresses)):
+            if isinstance(ins, AAsm):
+                if live_a:
+                    optimized_block.append(ins)
+                    live_a = False
+                continue
+            elif isinstance(ins, LAsm):
+                optimized_block.append(ins)
+                continue
+            if ins.jump:
+                live_a = live_d = True
+                dead_registers.clear()
+            register = address[1] if is_register(address) else None
+            dest = "".join(
+                r
+                for r in ins.dest
+                if (r == "A" and live_a)
+                or (r == "D" and live_d)
+                or (r == "M" and register not in dead_registers)
+            )
+            if not dest and not ins.jump:
+                continue
+            if dest != ins.dest:
+                ins = CAsm(f"{dest}={ins.comp}")
+            if "A" in dest:
+                live_a = False
+            if "D" in dest:
+                live_d = False
+            if "M" in dest and register is not None:
+                dead_registers.add(register)
+            if "D" in ins.comp:
+                live_d = True
+            if "A" in ins.comp or "M" in ins.comp or "M" in dest or ins.jump:
+                live_a = True
+            if "M" in ins.comp:
+                if register is not None:
+                    dead_registers.discard(register)
+                elif address is None:
+                    dead_registers.clear()
+            optimized_block.append(ins)
+        optimized_block.reverse()
         return optimized_block
 
+    def thread_jumps(self, cfg: "ControlFlowGraph") -> list[list[Asm]]:
+        blocks = cfg.blocks
+
+        def resolve(label: str) -> str:
+            seen = set()
+            while label in cfg.labels and label not in seen:
+                seen.add(label)
+                index = cfg.labels[label]
+                body = blocks[index][1:]
+                fall = cfg.fall_through(index)
+                if not body and fall is not None:
+                    label = blocks[fall][0].label
+                elif len(body) == 2 and jump_target(body) in cfg.labels:
+                    label = jump_target(body)
+                else:
+                    break
+            return label
+
+        threaded_blocks = []
+        for block in blocks:
+            block = list(block)
+            for i in range(len(block) - 1):
+                ins = block[i]
+                if not isinstance(ins, AAsm) or ins.value not in cfg.labels:
+                    continue
+                # R15 only ever feeds the indirect jump a shared routine
+                # returns through, so its label can be threaded like a jump
+                kind = edge_kind(block, i)
+                if is_plain_jump(block[i + 1]) or kind == SHARED_RETURN:
+                    target = resolve(ins.value)
+                    if target != ins.value:
+                        block[i] = AAsm(f"@{target}")
+            threaded_blocks.append(block)
+        return threaded_blocks
+
+    def lay_out_blocks(self, cfg: "ControlFlowGraph") -> list[list[Asm]]:
+        # blocks that fall through stay glued to their successor as a chain,
+        # a chain ending in a jump to the head of another one gets it placed
+        # right behind so the jump can go
+        chains: list[list[int]] = []
+        for index in range(len(cfg.blocks)):
+            if chains and cfg.fall_through(chains[-1][-1]) == index:
+                chains[-1].append(index)
+            else:
+                chains.append([index])
+        if not chains:
+            return []
+        heads = {chain[0]: number for number, chain in enumerate(chains)}
+        # a chain running off the end of the program has to stay last
+        last = len(chains) - 1 if not ends_with_jump(cfg.blocks[-1]) else None
+        placed = [False] * len(chains)
+        order = []
+        for number in range(len(chains)):
+            while number is not None and number != last and not placed[number]:
+                placed[number] = True
+                order.append(number)
+                target = jump_target(cfg.blocks[chains[number][-1]])
+                number = heads.get(cfg.labels.get(target))
+        if last is not None:
+            order.append(last)
+        return [cfg.blocks[index] for number in order for index in chains[number]]
+
+    def remove_jumps_to_next(self, asm: list[Asm]) -> list[Asm]:
+        optimized_asm: list[Asm] = []
+        for ins in asm:
+            if (
+                isinstance(ins, LAsm)
+                and len(optimized_asm) >= 2
+                and is_plain_jump(optimized_asm[-1])
+                and isinstance(optimized_asm[-2], AAsm)
+                and optimized_asm[-2].value == ins.label
+            ):
+                del optimized_asm[-2:]
+            optimized_asm.append(ins)
+        return optimized_asm
+
+
+# outlined sequences are this many words long, shorter ones rarely pay for
+# the 4-word call and 5 extra routine words
+MIN_OUTLINE_WORDS = 5
+MAX_OUTLINE_WORDS = 40
+HASH_MODULUS = (1 << 61) - 1
+HASH_BASE = 1_000_003
+R15_NAMES = {"R15", "15"}
+
+
+def outline_saving(length: int, count: int) -> int:
+    # @ret D=A @routine 0;JMP at each site, @R15 M=D ... @R15 A=M 0;JMP once
+    return count * length - (4 * count + length + 5)
+
+
+class Outliner:
+    def __init__(self, asm_code: list[str]) -> None:
+        parsed: dict[str, Asm] = {}
+        self.lines = asm_code
+        self.asm = [
+            parsed.get(line) or parsed.setdefault(line, parse(line))
+            for line in asm_code
+        ]
+        self.r15_dead = self.find_r15_dead()
+        # (sequence length, start of every copy) for each outlined routine,
+        # the routines go after an unconditional jump so the program needs one
+        self.outlined: list[tuple[int, list[int]]] = []
+        if any(isinstance(ins, CAsm) and ins.jump == "JMP" for ins in self.asm):
+            self.outlined = self.choose(self.find_repeats())
+        self.saved_words = sum(
+            outline_saving(length, len(starts)) for length, starts in self.outlined
+        )
+        self.outlined_asm = self.rewrite()
+
+    def find_r15_dead(self) -> list[bool]:
+        blocks = cut_to_basic_blocks(self.asm)
+        cfg = ControlFlowGraph(blocks)
+        live_in = [False] * len(blocks)
+        changed = True
+        while changed:
+            changed = False
+            for index in reversed(range(len(blocks))):
+                live = self.r15_live(blocks, cfg, index, live_in)[0]
+                if live != live_in[index]:
+                    live_in[index] = live
+                    changed = True
+        dead = []
+        for index in range(len(blocks)):
+            lives = self.r15_live(blocks, cfg, index, live_in)
+            dead.extend(not live for live in lives)
+        return dead
+
+    def r15_live(
+        self,
+        blocks: list[list[Asm]],
+        cfg: ControlFlowGraph,
+        index: int,
+        live_in: list[bool],
+    ) -> list[bool]:
+        # whether R15 is live before each instruction of the block, nothing
+        # is live after an indirect jump since every user of R15 sets it first
+        block = blocks[index]
+        addresses_r15 = []
+        a_is_r15 = False
+        for ins in block:
+            addresses_r15.append(a_is_r15)
+            if isinstance(ins, AAsm):
+                a_is_r15 = ins.value in R15_NAMES
+            elif isinstance(ins, CAsm) and "A" in ins.dest:
+                a_is_r15 = False
+        live = any(live_in[target] for target, _ in cfg.successors[index])
+        lives = [False] * len(block)
+        for position in reversed(range(len(block))):
+            ins = block[position]
+            if isinstance(ins, CAsm):
+                if addresses_r15[position]:
+                    if "M" in ins.comp:
+                        live = True
+                    elif "M" in ins.dest:
+                        live = False
+                if (
+                    ins.jump
+                    and position > 0
+                    and isinstance(block[position - 1], AAsm)
+                ):
+                    target = cfg.labels.get(block[position - 1].value)
+                    live = live or target is None or live_in[target]
+            lives[position] = live
+        return lives
+
+    def find_repeats(self) -> dict[tuple[int, int], list[int]]:
+        # every straight-line window that could become a call: it starts and
+        # is followed by an @, so A is dead at both ends, it writes D before
+        # reading it and R15 is dead in it
+        lines = self.lines
+        ids: dict[str, int] = {}
+        prefix = [0]
+        for line in lines:
+            line_id = ids.setdefault(line, len(ids) + 1)
+            prefix.append((prefix[-1] * HASH_BASE + line_id) % HASH_MODULUS)
+        powers = [1]
+        for _ in range(MAX_OUTLINE_WORDS):
+            powers.append(powers[-1] * HASH_BASE % HASH_MODULUS)
+        windows: list[tuple[int, int, int]] = []
+        for start, ins in enumerate(self.asm):
+            if not isinstance(ins, AAsm) or not self.r15_dead[start]:
+                continue
+            d_written = False
+            end = start
+            while end - start < MAX_OUTLINE_WORDS and end + 1 < len(lines):
+                ins = self.asm[end]
+                if isinstance(ins, LAsm) or (
+                    isinstance(ins, AAsm) and ins.value in R15_NAMES
+                ):
+                    break
+                elif isinstance(ins, CAsm):
+                    if ins.jump or (not d_written and "D" in ins.comp):
+                        break
+                    d_written = d_written or "D" in ins.dest
+                end += 1
+                length = end - start
+                if (
+                    d_written
+                    and length >= MIN_OUTLINE_WORDS
+                    and isinstance(self.asm[end], AAsm)
+                ):
+                    digest = (
+                        prefix[end] - prefix[start] * powers[length]
+                    ) % HASH_MODULUS
+                    windows.append((length, digest, start))
+        counts = Counter((length, digest) for length, digest, _ in windows)
+        repeats: dict[tuple[int, int], list[int]] = {}
+        for length, digest, start in windows:
+            if counts[length, digest] > 1:
+                repeats.setdefault((length, digest), []).append(start)
+        return repeats
+
+    def choose(
+        self, repeats: dict[tuple[int, int], list[int]]
+    ) -> list[tuple[int, list[int]]]:
+        # greedy by estimated saving, copies that overlap an earlier choice
+        # or are only hash collisions are dropped
+        candidates = sorted(
+            repeats.items(),
+            key=lambda item: outline_saving(item[0][0], len(item[1])),
+            reverse=True,
+        )
+        taken = bytearray(len(self.lines))
+        outlined = []
+        for (length, _), starts in candidates:
+            if outline_saving(length, len(starts)) <= 0:
+                break
+            body = self.lines[starts[0] : starts[0] + length]
+            chosen = []
+            for start in starts:
+                if (
+                    (not chosen or start >= chosen[-1] + length)
+                    and not any(taken[start : start + length])
+                    and self.lines[start : start + length] == body
+                ):
+                    chosen.append(start)
+            if len(chosen) > 1 and outline_saving(length, len(chosen)) > 0:
+                for start in chosen:
+                    taken[start : start + length] = b"\1" * length
+                outlined.append((length, chosen))
+        return outlined
+
+    def rewrite(self) -> list[str]:
+        lines = self.lines
+        calls: dict[int, tuple[int, int]] = {}
+        routines = []
+        for num, (length, starts) in enumerate(self.outlined):
+            routines.append(f"(Outline{num}_share)")
+            routines.extend(["@R15", "M=D"])
+            routines.extend(lines[starts[0] : starts[0] + length])
+            routines.extend(["@R15", "A=M", "0;JMP"])
+            for start in starts:
+                calls[start] = (num, length)
+        outlined_asm: list[str] = []
+        site_num = -1
+        i = 0
+        while i < len(lines):
+            if i in calls:
+                num, length = calls[i]
+                site_num += 1
+                label = f"OutlineReturn.{site_num}"
+                outlined_asm.extend(
+                    [
+                        f"@{label}",
+                        "D=A",
+                        f"@Outline{num}_share",
+                        "0;JMP",
+                        f"({label})",
+                    ]
+                )
+                i += length
+            else:
+                outlined_asm.append(lines[i])
+                ins = self.asm[i]
+                if routines and isinstance(ins, CAsm) and ins.jump == "JMP":
+                    # nothing falls through into the routines after a jump
+                    outlined_asm.extend(routines)
+                    routines = []
+                i += 1
+        return outlined_asm
+
+
+def constant_value(code: list[Instruction], end: int) -> Optional[tuple[int, int]]:
+    # (value, length) of the constant pushed by the instructions before end
+    last = code[end - 1] if end > 0 else None
+    if is_constant_push(last):
+        return last.index, 1
+    elif (
+        isinstance(last, ArithmeticLogicalInstruction)
+        and last.operation in ("neg", "not")
+        and end > 1
+        and is_constant_push(code[end - 2])
+    ):
+        value = code[end - 2].index
+        return (-value if last.operation == "neg" else ~value) & 0xFFFF, 2
+    return None
+
+
+def is_constant_push(ins: Optional[Instruction]) -> bool:
+    return (
+        isinstance(ins, PushPopInstruction)
+        and ins.command == "push"
+        and ins.segment == "constant"
+    )
+
+
+def push_constant(value: int) -> list[Instruction]:
+    # push constant only takes 0..32767, the rest goes through neg or not
+    value &= 0xFFFF
+    if value < 0x8000:
+        return [PushPopInstruction("push", "constant", value)]
+    elif value == 0x8000:
+        return [
+            PushPopInstruction("push", "constant", 0x7FFF),
+            ArithmeticLogicalInstruction("not"),
+        ]
+    return [
+        PushPopInstruction("push", "constant", -value & 0xFFFF),
+        ArithmeticLogicalInstruction("neg"),
+    ]
+
+
+def fold(operation: str, x: int, y: int) -> Optional[int]:
+    if operation == "add":
+        return (x + y) & 0xFFFF
+    elif operation == "sub":
+        return (x - y) & 0xFFFF
+    elif operation == "and":
+        return x & y
+    elif operation == "or":
+        return x | y
+    # eq/gt/lt look at the sign of x - y, only fold where that cannot overflow
+    difference = to_signed(x) - to_signed(y)
+    if not -0x8000 <= difference < 0x8000:
+        return None
+    result = {"eq": difference == 0, "gt": difference > 0, "lt": difference < 0}
+    return 0xFFFF if result[operation] else 0
+
+
+def to_signed(value: int) -> int:
+    return value - 0x10000 if value & 0x8000 else value
+
 
 class VMCodeOptimizer:
-    def __init__(self, vm_code: list[Instruction]) -> None:
+    def __init__(
+        self,
+        vm_code: list[Instruction],
+        inlines: Optional[dict[str, tuple]] = None,
+    ) -> None:
         self.vm_code = vm_code
+        # (static frame, body, file) of the functions copied into callers
+        self.inlines = inlines or {}
+        self.inline_num = -1
+        self.passes = [
+            ("fold constants", self.fold_constants),
+            ("simplify algebra", self.simplify_algebra),
+            ("remove dead code", self.remove_dead_code),
+        ]
+        if self.inlines:
+            # first, so the other passes see the copies
+            self.passes.insert(0, ("inline calls", self.inline_calls))
+        # (pass, seconds, instructions before, instructions after)
+        self.stats: list[tuple[str, float, int, int]] = []
+        self.optimized_code = self.run()
+
+    def run(self) -> list[Instruction]:
+        code = self.vm_code
+        for name, run_pass in self.passes:
+            start = time.perf_counter()
+            optimized_code = run_pass(code)
+            elapsed = time.perf_counter() - start
+            self.stats.append((name, elapsed, len(code), len(optimized_code)))
+            code = optimized_code
+        return code
+
+    def inline_calls(self, code: list[Instruction]) -> list[Instruction]:
+        optimized_code: list[Instruction] = []
+        for ins in code:
+            if (
+                isinstance(ins, FunctionInstruction)
+                and ins.command == "call"
+                and ins.function_name in self.inlines
+            ):
+                optimized_code.extend(self.inline_body(ins))
+            else:
+                optimized_code.append(ins)
+        return optimized_code
+
+    def inline_body(self, call: FunctionInstruction) -> list[Instruction]:
+        frame, body, file_name = self.inlines[call.function_name]
+        self.inline_num += 1
+        # labels of the copy get a prefix, the end label is the prefix itself
+        prefix = f"{call.function_name}.{self.inline_num}"
+        code: list[Instruction] = [
+            PushPopInstruction("pop", "frame", frame.argument(index))
+            for index in reversed(range(call.num_args))
+        ]
+        restore: list[Instruction] = []
+        for pointer in frame.saved_pointers:
+            cell = frame.saved_pointer(pointer)
+            code.append(PushPopInstruction("push", "pointer", pointer))
+            code.append(PushPopInstruction("pop", "frame", cell))
+            restore.append(PushPopInstruction("push", "frame", cell))
+            restore.append(PushPopInstruction("pop", "pointer", pointer))
+        for index in range(frame.num_locals):
+            code.append(PushPopInstruction("push", "constant", 0))
+            code.append(PushPopInstruction("pop", "frame", frame.local(index)))
+        jumps_to_end = False
+        for position, ins in enumerate(body):
+            if isinstance(ins, PushPopInstruction) and ins.segment == "local":
+                ins = PushPopInstruction(ins.command, "frame", frame.local(ins.index))
+            elif isinstance(ins, PushPopInstruction) and ins.segment == "argument":
+                cell = frame.argument(ins.index)
+                ins = PushPopInstruction(ins.command, "frame", cell)
+            elif isinstance(ins, PushPopInstruction) and ins.segment == "static":
+                ins = PushPopInstruction(ins.command, "static", ins.index, file_name)
+            elif isinstance(ins, BranchingInstruction):
+                ins = BranchingInstruction(ins.command, f"{prefix}.{ins.label}")
+            elif isinstance(ins, FunctionInstruction) and ins.command == "return":
+                # the return value is the only thing the body left on the stack
+                code.extend(restore)
+                if position < len(body) - 1:
+                    code.append(BranchingInstruction("goto", prefix))
+                    jumps_to_end = True
+                continue
+            code.append(ins)
+        if jumps_to_end:
+            code.append(BranchingInstruction("label", prefix))
+        return code
+
+    def fold_constants(self, code: list[Instruction]) -> list[Instruction]:
+        optimized_code: list[Instruction] = []
+        for ins in code:
+            if (
+                isinstance(ins, ArithmeticLogicalInstruction)
+                and ins.operation in ("add", "sub", "and", "or", "eq", "gt", "lt")
+                and (y := constant_value(optimized_code, len(optimized_code)))
+                and (x := constant_value(optimized_code, len(optimized_code) - y[1]))
+                and (value := fold(ins.operation, x[0], y[0])) is not None
+            ):
+                del optimized_code[-(x[1] + y[1]) :]
+                optimized_code.extend(push_constant(value))
+            else:
+                optimized_code.append(ins)
+        return optimized_code
+
+    def simplify_algebra(self, code: list[Instruction]) -> list[Instruction]:
+        optimized_code: list[Instruction] = []
+        for ins in code:
+            operation = (
+                ins.operation if isinstance(ins, ArithmeticLogicalInstruction) else None
+            )
+            last = optimized_code[-1] if optimized_code else None
+            if (
+                operation in ("add", "sub", "or")
+                and is_constant_push(last)
+                and last.index == 0
+            ):
+                # x + 0, x - 0, x | 0
+                optimized_code.pop()
+            elif (
+                operation in ("add", "or")
+                and len(optimized_code) > 1
+                and isinstance(last, PushPopInstruction)
+                and last.command == "push"
+                and is_constant_push(optimized_code[-2])
+                and optimized_code[-2].index == 0
+            ):
+                # 0 + x, 0 | x
+                del optimized_code[-2]
+            elif (
+                operation in ("not", "neg")
+                and isinstance(last, ArithmeticLogicalInstruction)
+                and last.operation == operation
+            ):
+                optimized_code.pop()
+            else:
+                optimized_code.append(ins)
+        return optimized_code
+
+    def remove_dead_code(self, code: list[Instruction]) -> list[Instruction]:
+        # nothing after goto or return runs before the next label or function
+        optimized_code: list[Instruction] = []
+        dead = False
+        for ins in code:
+            if isinstance(ins, BranchingInstruction) and ins.command == "label":
+                dead = False
+            elif isinstance(ins, FunctionInstruction) and ins.command == "function":
+                dead = False
+            if dead:
+                continue
+            optimized_code.append(ins)
+            if isinstance(ins, BranchingInstruction) and ins.command == "goto":
+                dead = True
+            elif isinstance(ins, FunctionInstruction) and ins.command == "return":
+                dead = True
+        return optimized_code
+
+
+class OptimizationStats:
+    def __init__(self) -> None:
+        self.passes: dict[str, list] = {}
+        # (shared routine, call sites, words added)
+        self.inlined: list[tuple[str, int, int]] = []
+        # (sequence length, start of every copy) of the outlined sequences
+        self.outlined: list[tuple[int, list[int]]] = []
+        # (opt level, ROM words) for every level tried
+        self.levels: list[tuple[str, int]] = []
+        self.rom_budget = 0
+        self.contributions: Counter = Counter()
+        self.static_frames: dict[str, StaticFrame] = {}
+        self.functions = 0
+        # functions copied into their callers at the VM level
+        self.inline_candidates: list[str] = []
+        # (function, VM instructions) dropped by tree shaking
+        self.removed_functions: list[tuple[str, int]] = []
+
+    def add(self, stats: list[tuple[str, float, int, int]]) -> None:
+        for name, seconds, before, after in stats:
+            totals = self.passes.setdefault(name, [0.0, 0, 0])
+            totals[0] += seconds
+            totals[1] += before
+            totals[2] += after
+
+    def summary(self) -> str:
+        lines = []
+        for name, (seconds, before, after) in self.passes.items():
+            lines.append(
+                f"{name}: {seconds * 1000:.1f}ms, "
+                f"{before} -> {after} VM instructions ({after - before:+d})"
+            )
+        if self.removed_functions:
+            instructions = sum(count for _, count in self.removed_functions)
+            lines.append(
+                f"tree shaking: removed {len(self.removed_functions)} functions "
+                f"({instructions} VM instructions)"
+            )
+        if self.inline_candidates:
+            lines.append(
+                f"inlinable functions: {len(self.inline_candidates)} "
+                f"({', '.join(self.inline_candidates[:5])}"
+                f"{', ...' if len(self.inline_candidates) > 5 else ''})"
+            )
+        for name, sites, growth in self.inlined:
+            lines.append(f"inlined {name}: {sites} call sites ({growth:+d} words)")
+        if self.outlined:
+            sites = sum(len(starts) for _, starts in self.outlined)
+            saved = sum(
+                outline_saving(length, len(starts)) for length, starts in self.outlined
+            )
+            lines.append(
+                f"outlined {len(self.outlined)} sequences from {sites} places "
+                f"({-saved:+d} words)"
+            )
+        if self.static_frames:
+            cells = max(f.start + f.size() for f in self.static_frames.values())
+            lines.append(
+                f"static frames: {len(self.static_frames)} of {self.functions} "
+                f"functions in {cells} RAM words"
+            )
+        for level, words in self.levels:
+            lines.append(f"--opt={level}: {words} of {self.rom_budget} ROM words")
+        lines.extend(self.top_contributions())
+        return "\n".join(lines)
+
+    def top_contributions(self, count: int = 10) -> list[str]:
+        total = sum(self.contributions.values())
+        return [
+            f"  {words:>6} words {100 * words / total:5.1f}%  {name}"
+            for name, words in self.contributions.most_common(count)
+        ]
+
+
+def cut_to_basic_blocks(asm: list[Asm]) -> list[list[Asm]]:
+    blocks: list[list[Asm]] = []
+    current_block: list[Asm] = []
+    for ins in asm:
+        if isinstance(ins, LAsm):
+            if current_block:
+                blocks.append(current_block)
+            current_block = [ins]
+        elif isinstance(ins, CAsm) and ins.jump == "JMP":
+            current_block.append(ins)
+            blocks.append(current_block)
+            current_block = []
+        else:
+            current_block.append(ins)
+    if current_block:
+        blocks.append(current_block)
+    return blocks
+
+
+def is_plain_jump(ins: Asm) -> bool:
+    # a jump whose only effect is going to the address in A
+    return (
+        isinstance(ins, CAsm)
+        and ins.jump != ""
+        and ins.dest == ""
+        and "A" not in ins.comp
+        and "M" not in ins.comp
+    )
+
+
+def ends_with_jump(block: list[Asm]) -> bool:
+    return isinstance(block[-1], CAsm) and block[-1].jump == "JMP"
+
+
+def jump_target(block: list[Asm]) -> Optional[str]:
+    if (
+        len(block) >= 2
+        and ends_with_jump(block)
+        and is_plain_jump(block[-1])
+        and isinstance(block[-2], AAsm)
+    ):
+        return block[-2].value
+    return None
+
+
+def without_m(ins: CAsm, comp: str) -> Optional[CAsm]:
+    dest = ins.dest.replace("M", "")
+    return CAsm(f"{dest}={comp}") if dest else None
 
 
 def parse(asm_code: str) -> Asm:
@@ -1306,11 +2513,813 @@ def parse(asm_code: str) -> Asm:
         return CAsm(asm_code)
 
 
+class TranslationCache:
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(__file__, "rb") as f:
+            # a changed translator must not serve fragments made by the old one
+            self.fingerprint = hashlib.sha256(f.read()).hexdigest()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def key(self, source: tuple[str, str], variant: str = "") -> str:
+        path, content = source
+        digest = hashlib.sha256(self.fingerprint.encode())
+        # the code generator options change every fragment
+        digest.update(variant.encode())
+        digest.update(b"\0")
+        # the file name ends up in static and numbered labels
+        digest.update(os.path.basename(path).encode())
+        digest.update(b"\0")
+        digest.update(content.encode())
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(
+        self, source: tuple[str, str], variant: str = ""
+    ) -> Optional[tuple[list[str], set[int]]]:
+        try:
+            with open(self.entry_path(self.key(source, variant)), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["asm"], set(entry["function_local_set"])
+
+    def put(
+        self,
+        source: tuple[str, str],
+        result: tuple[list[str], set[int]],
+        variant: str = "",
+    ) -> None:
+        path = self.entry_path(self.key(source, variant))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        asm, local_set = result
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"asm": asm, "function_local_set": sorted(local_set)}, f)
+        os.replace(tmp_path, path)
+        self.stores += 1
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0.0
+        return (
+            f"cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), "
+            f"{self.stores} entries written to {self.cache_dir}"
+        )
+
+
+ROM_SIZE = 32768
+OPT_MODES = ["speed", "balanced", "size"]
+# balanced only grows the program for routines called from this few places
+BALANCED_MAX_CALL_SITES = 4
+R15_RETURN = ["@R15", "A=M", "0;JMP"]
+
+
+def shared_routines(function_local_set: set[int]) -> dict[str, list[str]]:
+    routines = [
+        eq_share,
+        eqafterpush_share,
+        gt_share,
+        gtafterpush_share,
+        lt_share,
+        ltafterpush_share,
+        call_share,
+        return_share,
+    ]
+    routines.extend(gen_Function_m_Local_share(m) for m in sorted(function_local_set))
+    return {routine[0][1:-1]: routine for routine in routines}
+
+
+def count_words(asm: list[str]) -> int:
+    return sum(1 for line in asm if line[0] != "(")
+
+
+class RoutineInliner:
+    def __init__(
+        self,
+        asm: list[str],
+        routines: dict[str, list[str]],
+        opt: str = "balanced",
+        rom_budget: int = ROM_SIZE,
+    ) -> None:
+        self.routines = routines
+        self.opt = opt
+        self.rom_budget = rom_budget
+        lines = Counter(asm)
+        self.call_sites = {name: lines[f"@{name}"] for name in routines}
+        self.site_num = -1
+        # (routine, call sites, words added)
+        self.decisions: list[tuple[str, int, int]] = []
+        self.inlined = self.decide(count_words(asm))
+
+    def returns_through_r15(self, name: str) -> bool:
+        return self.routines[name][-3:] == R15_RETURN
+
+    def inline_body(self, name: str) -> list[str]:
+        body = self.routines[name][1:]
+        return body[:-3] if self.returns_through_r15(name) else body
+
+    def growth(self, name: str) -> int:
+        # an R15 call site is @label D=A @R15 M=D @routine 0;JMP, a plain
+        # one is @routine 0;JMP
+        call_words = 6 if self.returns_through_r15(name) else 2
+        inline_words = count_words(self.inline_body(name))
+        routine_words = count_words(self.routines[name])
+        return self.call_sites[name] * (inline_words - call_words) - routine_words
+
+    def wanted(self, name: str) -> bool:
+        sites = self.call_sites[name]
+        if sites == 0:
+            return False
+        elif self.growth(name) <= 0 or self.opt == "speed":
+            return True
+        elif self.opt == "balanced":
+            return sites <= BALANCED_MAX_CALL_SITES
+        return False
+
+    def decide(self, code_words: int) -> set[str]:
+        size = code_words + sum(
+            count_words(routine)
+            for name, routine in self.routines.items()
+            if self.call_sites[name]
+        )
+        candidates = sorted(
+            (name for name in self.routines if self.wanted(name)), key=self.growth
+        )
+        inlined = set()
+        for name in candidates:
+            growth = self.growth(name)
+            if growth > 0 and size + growth > self.rom_budget:
+                continue
+            size += growth
+            inlined.add(name)
+            self.decisions.append((name, self.call_sites[name], growth))
+        return inlined
+
+    def kept_routines(self) -> list[str]:
+        asm = []
+        for name, routine in self.routines.items():
+            if name not in self.inlined and self.call_sites[name]:
+                asm.extend(routine)
+        return asm
+
+    def inline(self, asm: list[str]) -> list[str]:
+        if not self.inlined:
+            return list(asm)
+        inlined_asm: list[str] = []
+        i = 0
+        while i < len(asm):
+            line = asm[i]
+            name = line[1:]
+            if name in self.inlined and line[0] == "@" and asm[i + 1] == "0;JMP":
+                if self.returns_through_r15(name):
+                    # drop @label D=A @R15 M=D, the body falls through to label
+                    del inlined_asm[-4:]
+                inlined_asm.extend(self.renamed_body(name))
+                i += 2
+            else:
+                inlined_asm.append(line)
+                i += 1
+        return inlined_asm
+
+    def renamed_body(self, name: str) -> list[str]:
+        # labels inside the routine get a copy per call site
+        self.site_num += 1
+        body = self.inline_body(name)
+        labels = {line[1:-1] for line in body if line[0] == "("}
+        renamed = []
+        for line in body:
+            if line[0] == "(" and line[1:-1] in labels:
+                renamed.append(f"({line[1:-1]}.{self.site_num})")
+            elif line[0] == "@" and line[1:] in labels:
+                renamed.append(f"@{line[1:]}.{self.site_num}")
+            else:
+                renamed.append(line)
+        return renamed
+
+
+# the statics and the static frames share RAM[16..255]
+FRAME_RAM_WORDS = 256 - 16
+
+
+def frame_slot(cell: int) -> str:
+    # no dot, so it cannot clash with a static variable
+    return f"StaticFrame_{cell}"
+
+
+class StaticFrame:
+    def __init__(
+        self, start: int, num_args: int, num_locals: int, saved_pointers: list[int]
+    ) -> None:
+        # cells from start on: return address, arguments, locals and the
+        # THIS/THAT of the caller for the pointers the function pops
+        self.start = start
+        self.num_args = num_args
+        self.num_locals = num_locals
+        self.saved_pointers = saved_pointers
+
+    def __repr__(self) -> str:
+        return (
+            f"StaticFrame({self.start}, {self.num_args}, {self.num_locals}, "
+            f"{self.saved_pointers})"
+        )
+
+    def size(self) -> int:
+        return 1 + self.num_args + self.num_locals + len(self.saved_pointers)
+
+    def argument(self, index: int) -> int:
+        return self.start + 1 + index
+
+    def local(self, index: int) -> int:
+        return self.start + 1 + self.num_args + index
+
+    def return_address(self) -> str:
+        return frame_slot(self.start)
+
+    def saved_pointer(self, pointer: int) -> int:
+        position = self.saved_pointers.index(pointer)
+        return self.start + 1 + self.num_args + self.num_locals + position
+
+    def entry(self) -> list[str]:
+        asm = []
+        for pointer in self.saved_pointers:
+            cell = frame_slot(self.saved_pointer(pointer))
+            asm.extend([f"@{3 + pointer}", "D=M", f"@{cell}", "M=D"])
+        for index in range(self.num_locals):
+            asm.extend([f"@{frame_slot(self.local(index))}", "M=0"])
+        return asm
+
+    def restore_pointers(self) -> list[str]:
+        asm = []
+        for pointer in self.saved_pointers:
+            cell = frame_slot(self.saved_pointer(pointer))
+            asm.extend([f"@{cell}", "D=M", f"@{3 + pointer}", "M=D"])
+        return asm
+
+    def return_jump(self) -> list[str]:
+        return [f"@{self.return_address()}", "A=M", "0;JMP"]
+
+
+def stack_effect(ins: Instruction) -> tuple[int, int]:
+    # (values popped, values pushed)
+    if isinstance(ins, ArithmeticLogicalInstruction):
+        return (1, 1) if ins.operation in ("neg", "not") else (2, 1)
+    elif isinstance(ins, PushPopInstruction):
+        return (0, 1) if ins.command == "push" else (1, 0)
+    elif isinstance(ins, BranchingInstruction):
+        return (1, 0) if ins.command == "if-goto" else (0, 0)
+    elif ins.command == "call":
+        return ins.num_args, 1
+    elif ins.command == "return":
+        return 1, 0
+    return 0, 0
+
+
+def returns_one_value(body: list[Instruction]) -> bool:
+    # the stack depth is the same on every path to an instruction, never
+    # reaches below the arguments and is just the return value at a return
+    labels = {
+        ins.label: index
+        for index, ins in enumerate(body)
+        if isinstance(ins, BranchingInstruction) and ins.command == "label"
+    }
+    depths: dict[int, int] = {}
+    work = [(0, 0)]
+    while work:
+        index, depth = work.pop()
+        if index in depths:
+            if depths[index] != depth:
+                return False
+            continue
+        elif index == len(body):
+            # runs into the next function
+            return False
+        depths[index] = depth
+        ins = body[index]
+        pops, pushes = stack_effect(ins)
+        if depth < pops:
+            return False
+        depth += pushes - pops
+        if isinstance(ins, FunctionInstruction) and ins.command == "return":
+            if depth != 0:
+                return False
+            continue
+        if isinstance(ins, BranchingInstruction) and ins.command != "label":
+            if ins.label not in labels:
+                return False
+            work.append((labels[ins.label], depth))
+            if ins.command == "goto":
+                continue
+        work.append((index + 1, depth))
+    return True
+
+
+class CallGraph:
+    def __init__(self, sources: list[tuple[str, str]]) -> None:
+        parser = VMTranslator("")
+        # (source, function or None for the code before the first one, source
+        # lines, instructions) in program order
+        self.chunks: list[
+            tuple[int, Optional[str], list[str], list[Instruction]]
+        ] = []
+        self.bodies: dict[str, list[Instruction]] = {}
+        self.num_locals: dict[str, int] = {}
+        self.definitions: Counter = Counter()
+        # the most arguments any call passes to a function
+        self.call_args: Counter = Counter()
+        self.statics: set[tuple[str, int]] = set()
+        self.file_names: dict[str, str] = {}
+        for source, (path, content) in enumerate(sources):
+            file_name = TranslationContext(path).get_file_name()
+            chunk = (source, None, [], [])
+            self.chunks.append(chunk)
+            for line in content.splitlines(keepends=True):
+                for text in parser.cut(line):
+                    ins = parser.str_to_instruction(text)
+                    if isinstance(ins, FunctionInstruction):
+                        if ins.command == "function":
+                            chunk = (source, ins.function_name, [], [])
+                            self.chunks.append(chunk)
+                            self.definitions[ins.function_name] += 1
+                            self.num_locals[ins.function_name] = ins.num_args
+                            self.bodies[ins.function_name] = chunk[3]
+                            self.file_names[ins.function_name] = file_name
+                            continue
+                        elif ins.command == "call":
+                            name = ins.function_name
+                            args = max(self.call_args[name], ins.num_args)
+                            self.call_args[name] = args
+                    elif (
+                        isinstance(ins, PushPopInstruction)
+                        and ins.segment == "static"
+                    ):
+                        self.statics.add((file_name, ins.index))
+                    chunk[3].append(ins)
+                chunk[2].append(line)
+        self.callees = {
+            name: [
+                ins.function_name
+                for ins in body
+                if isinstance(ins, FunctionInstruction)
+                and ins.function_name in self.bodies
+            ]
+            for name, body in self.bodies.items()
+        }
+
+    def reachable_chunks(self, bootstrap: bool) -> list[bool]:
+        # from Sys.init or the start of the program along calls and functions
+        # running into the next one, code outside functions is always kept
+        chunks_of: dict[str, list[int]] = {}
+        for index, (_, name, _, _) in enumerate(self.chunks):
+            if name is not None:
+                chunks_of.setdefault(name, []).append(index)
+        roots = [
+            index
+            for index, (_, name, _, code) in enumerate(self.chunks)
+            if name is None and code
+        ]
+        roots.extend(chunks_of.get("Sys.init", []) if bootstrap else [0])
+        reachable = [False] * len(self.chunks)
+        for index in roots:
+            reachable[index] = True
+        while roots:
+            index = roots.pop()
+            code = self.chunks[index][3]
+            successors = [
+                target
+                for ins in code
+                if isinstance(ins, FunctionInstruction) and ins.command == "call"
+                for target in chunks_of.get(ins.function_name, [])
+            ]
+            last = code[-1] if code else None
+            if index + 1 < len(self.chunks) and not (
+                isinstance(last, FunctionInstruction)
+                and last.command == "return"
+                or isinstance(last, BranchingInstruction)
+                and last.command == "goto"
+            ):
+                successors.append(index + 1)
+            for target in successors:
+                if not reachable[target]:
+                    reachable[target] = True
+                    roots.append(target)
+        return reachable
+
+
+def tree_shake(
+    sources: list[tuple[str, str]],
+    bootstrap: bool,
+    stats: Optional["OptimizationStats"] = None,
+) -> list[tuple[str, str]]:
+    # drops the functions nothing can reach before they are translated
+    graph = CallGraph(sources)
+    if bootstrap and "Sys.init" not in graph.bodies:
+        return sources
+    reachable = graph.reachable_chunks(bootstrap)
+    contents: list[list[str]] = [[] for _ in sources]
+    removed = []
+    for (source, name, lines, code), keep in zip(graph.chunks, reachable):
+        if keep:
+            contents[source].extend(lines)
+        elif name is not None:
+            removed.append((name, len(code) + 1))
+    if stats:
+        stats.removed_functions = removed
+    if not removed:
+        return sources
+    return [(path, "".join(lines)) for (path, _), lines in zip(sources, contents)]
+
+
+class StaticFramePlanner:
+    def __init__(self, graph: CallGraph, bootstrap: bool) -> None:
+        self.bodies = graph.bodies
+        self.num_locals = graph.num_locals
+        self.definitions = graph.definitions
+        self.call_args = graph.call_args
+        self.callees = graph.callees
+        # entered with the frame the caller or the test set up
+        if bootstrap:
+            self.roots = {"Sys.init"}
+        else:
+            self.roots = set(list(self.bodies)[:1])
+        self.budget = FRAME_RAM_WORDS - len(graph.statics)
+        self.frames = self.allocate(self.find_components())
+
+    def find_components(self) -> list[list[str]]:
+        # strongly connected components of the call graph, Tarjan's algorithm
+        # without recursion, a component comes after everything it calls
+        number: dict[str, int] = {}
+        low: dict[str, int] = {}
+        stack: list[str] = []
+        on_stack: set[str] = set()
+        components = []
+        for root in self.bodies:
+            if root in number:
+                continue
+            number[root] = low[root] = len(number)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.callees[root]))]
+            while work:
+                name, callees = work[-1]
+                for callee in callees:
+                    if callee not in number:
+                        number[callee] = low[callee] = len(number)
+                        stack.append(callee)
+                        on_stack.add(callee)
+                        work.append((callee, iter(self.callees[callee])))
+                        break
+                    elif callee in on_stack:
+                        low[name] = min(low[name], number[callee])
+                else:
+                    work.pop()
+                    if work:
+                        caller = work[-1][0]
+                        low[caller] = min(low[caller], low[name])
+                    if low[name] == number[name]:
+                        component = []
+                        while not component or component[-1] != name:
+                            component.append(stack.pop())
+                            on_stack.discard(component[-1])
+                        components.append(component)
+        return components
+
+    def frame_shape(self, name: str) -> Optional[tuple[int, int, list[int]]]:
+        # (arguments, locals, popped pointers), None if the function needs a
+        # frame on the stack
+        body = self.bodies[name]
+        if (
+            name in self.roots
+            or self.definitions[name] > 1
+            or name in self.callees[name]
+            or not returns_one_value(body)
+        ):
+            return None
+        num_args = self.call_args[name]
+        num_locals = self.num_locals[name]
+        saved_pointers = set()
+        for ins in body:
+            if not isinstance(ins, PushPopInstruction):
+                continue
+            elif ins.segment == "argument":
+                num_args = max(num_args, ins.index + 1)
+            elif ins.segment == "local":
+                num_locals = max(num_locals, ins.index + 1)
+            elif ins.segment == "pointer" and ins.command == "pop":
+                saved_pointers.add(ins.index)
+        return num_args, num_locals, sorted(saved_pointers)
+
+    def allocate(self, components: list[list[str]]) -> dict[str, StaticFrame]:
+        # a frame starts after the frames of every function that can be
+        # active below it, functions never active together share cells
+        frames = {}
+        first_free: Counter = Counter()
+        for component in reversed(components):
+            start = max(first_free[name] for name in component)
+            end = start
+            shape = self.frame_shape(component[0]) if len(component) == 1 else None
+            if shape is not None:
+                frame = StaticFrame(start, *shape)
+                if start + frame.size() <= self.budget:
+                    frames[component[0]] = frame
+                    end = start + frame.size()
+            for name in component:
+                for callee in self.callees[name]:
+                    first_free[callee] = max(first_free[callee], end)
+        return frames
+
+
+def frame_segments(
+    code: list[Instruction], static_frames: dict[str, StaticFrame]
+) -> list[Instruction]:
+    # the arguments and locals of a function with a static frame are cells
+    # of the frame segment, addressed like statics
+    framed_code: list[Instruction] = []
+    frame = None
+    for ins in code:
+        if isinstance(ins, FunctionInstruction) and ins.command == "function":
+            frame = static_frames.get(ins.function_name)
+        elif (
+            frame is not None
+            and isinstance(ins, PushPopInstruction)
+            and ins.segment in ("local", "argument")
+        ):
+            if ins.segment == "local":
+                cell = frame.local(ins.index)
+            else:
+                cell = frame.argument(ins.index)
+            ins = PushPopInstruction(ins.command, "frame", cell)
+        framed_code.append(ins)
+    return framed_code
+
+
+def inline_candidates(
+    graph: CallGraph, frames: dict[str, StaticFrame], max_instructions: int
+) -> dict[str, tuple[StaticFrame, list[Instruction], str]]:
+    # functions small enough to copy into their callers, (frame, body, file)
+    # for each, the copies keep arguments and locals in the frame cells
+    return {
+        name: (frame, graph.bodies[name], graph.file_names[name])
+        for name, frame in frames.items()
+        if len(graph.bodies[name]) <= max_instructions
+        and not any(
+            isinstance(ins, FunctionInstruction) and ins.command == "call"
+            for ins in graph.bodies[name]
+        )
+    }
+
+
+def translate_file(
+    source: tuple[str, str],
+    tos_cache: bool = False,
+    virtual_sp: bool = False,
+    static_frames: Optional[dict[str, StaticFrame]] = None,
+    inlines: Optional[dict[str, tuple[StaticFrame, list[Instruction], str]]] = None,
+) -> tuple[list[str], set[int], list[tuple[str, float, int, int]]]:
+    path, content = source
+    ctx = TranslationContext(path)
+    vm_translator = VMTranslator(
+        content, ctx, tos_cache, virtual_sp, static_frames, inlines
+    )
+    stats = vm_translator.vm_code_optimizer.stats
+    return vm_translator.asm, ctx.function_local_set, stats
+
+
+def translate(
+    sources: list[tuple[str, str]],
+    bootstrap: bool,
+    jobs: int = 1,
+    cache: Optional[TranslationCache] = None,
+    stats: Optional[OptimizationStats] = None,
+    opt: str = "balanced",
+    rom_budget: int = ROM_SIZE,
+    tos_cache: bool = False,
+    virtual_sp: bool = False,
+    static_frames: bool = False,
+    tree_shaking: bool = True,
+    max_inline_instructions: int = 0,
+) -> list[str]:
+    if tree_shaking:
+        sources = tree_shake(sources, bootstrap, stats)
+    frames = {}
+    inlines = {}
+    if static_frames or max_inline_instructions:
+        graph = CallGraph(sources)
+        planned_frames = StaticFramePlanner(graph, bootstrap).frames
+        if static_frames:
+            frames = planned_frames
+        if max_inline_instructions:
+            inlines = inline_candidates(graph, planned_frames, max_inline_instructions)
+    # every file sees the frames and inlined functions of the whole program
+    variant = (
+        f"tos_cache={tos_cache} virtual_sp={virtual_sp} frames={frames} "
+        f"inlines={inlines}"
+    )
+    results = [cache.get(source, variant) if cache else None for source in sources]
+    missing = [source for source, result in zip(sources, results) if result is None]
+    if jobs > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            chunksize = max(1, len(missing) // (4 * jobs))
+            translated = list(
+                pool.map(
+                    partial(
+                        translate_file,
+                        tos_cache=tos_cache,
+                        virtual_sp=virtual_sp,
+                        static_frames=frames,
+                        inlines=inlines,
+                    ),
+                    missing,
+                    chunksize=chunksize,
+                )
+            )
+    else:
+        translated = [
+            translate_file(source, tos_cache, virtual_sp, frames, inlines)
+            for source in missing
+        ]
+    if stats:
+        for _, _, pass_stats in translated:
+            stats.add(pass_stats)
+    translated = [(code, local_set) for code, local_set, _ in translated]
+    if cache:
+        for source, result in zip(missing, translated):
+            cache.put(source, result, variant)
+    translated.reverse()
+    results = [result or translated.pop() for result in results]
+    ctx = TranslationContext()
+    if bootstrap:
+        prologue = ["@256", "D=A", "@SP", "M=D"]
+        initCall = FunctionInstruction("call", "Sys.init", 0)
+        prologue.extend(initCall.to_asm(ctx))
+    else:
+        prologue = ["@StartUp", "0;JMP"]
+    for _, local_set in results:
+        ctx.function_local_set.update(local_set)
+    code = [line for lines, _ in results for line in lines]
+    routines = shared_routines(ctx.function_local_set)
+    owners = function_names(sources) | set(routines)
+    # trade speed for size until the program fits
+    for level in OPT_MODES[OPT_MODES.index(opt) :]:
+        inliner = RoutineInliner(prologue + code, routines, level, rom_budget)
+        linked = inliner.inline(prologue)
+        linked.extend(inliner.kept_routines())
+        if not bootstrap:
+            linked.append("(StartUp)")
+        linked.extend(inliner.inline(code))
+        asm = [f"{line}" for line in AsmOptimizer(linked).optimized_asm]
+        outlined = []
+        if level == "size":
+            outliner = Outliner(asm)
+            asm = outliner.outlined_asm
+            outlined = outliner.outlined
+        words = count_words(asm)
+        if stats:
+            stats.levels.append((level, words))
+            stats.inlined = inliner.decisions
+            stats.outlined = outlined
+        if words <= rom_budget:
+            break
+    if stats:
+        stats.inline_candidates = sorted(inlines)
+        stats.static_frames = frames
+        stats.functions = len(owners - set(routines))
+        stats.rom_budget = rom_budget
+        label_owner = label_owners(linked, owners)
+        for num in range(len(outlined)):
+            label_owner[f"Outline{num}_share"] = f"Outline{num}_share"
+        stats.contributions = word_contributions(asm, label_owner)
+    return asm
+
+
+def function_names(sources: list[tuple[str, str]]) -> set[str]:
+    names = set()
+    for _, content in sources:
+        for line in content.splitlines():
+            parts = line.split()
+            if len(parts) > 1 and parts[0] == "function":
+                names.add(parts[1])
+    return names
+
+
+def label_owners(asm: list[str], owners: set[str]) -> dict[str, str]:
+    # before the blocks are moved around every label belongs to the function
+    # or shared routine above it
+    label_owner = {}
+    owner = "(bootstrap)"
+    for line in asm:
+        if line[0] == "(":
+            label = line[1:-1]
+            if label in owners:
+                owner = label
+            label_owner[label] = owner
+    return label_owner
+
+
+def word_contributions(asm: list[str], label_owner: dict[str, str]) -> Counter:
+    contributions: Counter = Counter()
+    owner = "(bootstrap)"
+    for line in asm:
+        if line[0] == "(":
+            owner = label_owner.get(line[1:-1], owner)
+        else:
+            contributions[owner] += 1
+    return contributions
+
+
+def read_sources(inputpath: str) -> list[tuple[str, str]]:
+    if os.path.isdir(inputpath):
+        paths = [
+            os.path.join(inputpath, file_name)
+            for file_name in sorted(os.listdir(inputpath))
+            if file_name.endswith(".vm")
+        ]
+    else:
+        paths = [inputpath]
+    sources = []
+    for path in paths:
+        with open(path, "r") as f:
+            sources.append((path, f.read()))
+    return sources
+
+
 def main():
     parser = argparse.ArgumentParser(description="VM to ASM Translator")
     parser.add_argument("inputpath", help="Path to the file or dir to read")
     parser.add_argument("-o", help="Output file path")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Translate the files of a directory in this many processes "
+        "(0: one per CPU)",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="Reuse translations of unchanged .vm files stored in this directory",
+    )
+    parser.add_argument(
+        "--stats", action="store_true", help="Print translation statistics"
+    )
+    parser.add_argument(
+        "--opt",
+        choices=OPT_MODES,
+        default="balanced",
+        help="Inline shared routines at every call site (speed), where it does "
+        "not grow the program and outline repeated code (size) or also where "
+        "they have few call sites (balanced)",
+    )
+    parser.add_argument(
+        "--tos-cache",
+        action="store_true",
+        help="Keep the top of the stack in D between VM instructions",
+    )
+    parser.add_argument(
+        "--virtual-sp",
+        action="store_true",
+        help="Track SP at compile time within straight-line code and write it "
+        "back before labels, jumps and calls (implies --tos-cache)",
+    )
+    parser.add_argument(
+        "--static-frames",
+        action="store_true",
+        help="Give functions that are never active twice at the same time "
+        "fixed RAM cells for their arguments and locals instead of a frame on "
+        "the stack",
+    )
+    parser.add_argument(
+        "--inline-functions",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Copy functions of at most N VM instructions that call nothing "
+        "into their callers (default: 0, off)",
+    )
+    parser.add_argument(
+        "--no-tree-shaking",
+        action="store_true",
+        help="Translate functions that cannot be reached from Sys.init too",
+    )
+    parser.add_argument(
+        "--rom-budget",
+        type=int,
+        default=ROM_SIZE,
+        help="Fall back to smaller --opt levels while the program has more "
+        "words than this",
+    )
     args = parser.parse_args()
+    jobs = args.jobs or os.cpu_count() or 1
+    cache = TranslationCache(args.cache) if args.cache else None
+    stats = OptimizationStats()
     inputpath = args.inputpath
     if not os.path.exists(inputpath):
         raise FileNotFoundError(f"Input path does not exist: {inputpath}")
@@ -1321,56 +3330,55 @@ def main():
             dir_name = os.path.basename(os.path.normpath(inputpath))
             parent_dir = os.path.dirname(os.path.normpath(inputpath))
             output_path = os.path.join(parent_dir, dir_name + ".asm")
-        asm = ["@256", "D=A", "@SP", "M=D"]
-        initCall = FunctionInstruction("call", "Sys.init", 0)
-        asm.extend(initCall.to_asm())
-        asm.extend(eq_share)
-        asm.extend(eqafterpush_share)
-        asm.extend(gt_share)
-        asm.extend(gtafterpush_share)
-        asm.extend(lt_share)
-        asm.extend(ltafterpush_share)
-        asm.extend(call_share)
-        asm.extend(return_share)
-        asm.extend(function_Local_share)
-        for file_name in os.listdir(inputpath):
-            if file_name.endswith(".vm"):
-                set_file_path(os.path.join(inputpath, file_name))
-                set_function_current("WarningNotInAFunction")
-                with open(os.path.join(inputpath, file_name), "r") as f:
-                    content = f.read()
-                vm_translator = VMTranslator(content)
-                asm.extend(vm_translator.asm)
-        asm_optimizer = AsmOptimizer(asm)
-        with open(output_path, "w") as f:
-            for line in asm_optimizer.optimized_asm:
-                f.write(f"{line}" + "\n")
+        asm = translate(
+            read_sources(inputpath),
+            bootstrap=True,
+            jobs=jobs,
+            cache=cache,
+            stats=stats,
+            opt=args.opt,
+            rom_budget=args.rom_budget,
+            tos_cache=args.tos_cache,
+            virtual_sp=args.virtual_sp,
+            static_frames=args.static_frames,
+            tree_shaking=not args.no_tree_shaking,
+            max_inline_instructions=args.inline_functions,
+        )
     else:
-        set_file_path(args.inputpath)
-        with open(args.inputpath, "r") as f:
-            content = f.read()
-        vm_translator = VMTranslator(content)
         if args.o:
             output_path = args.o
         else:
             base, _ = os.path.splitext(args.inputpath)
             output_path = base + ".asm"
-        asm = ["@StartUp", "0;JMP"]
-        asm.extend(eq_share)
-        asm.extend(eqafterpush_share)
-        asm.extend(gt_share)
-        asm.extend(gtafterpush_share)
-        asm.extend(lt_share)
-        asm.extend(ltafterpush_share)
-        asm.extend(call_share)
-        asm.extend(return_share)
-        asm.extend(function_Local_share)
-        asm.append("(StartUp)")
-        asm.extend(vm_translator.asm)
-        asm_optimizer = AsmOptimizer(asm)
-        with open(output_path, "w") as f:
-            for line in asm_optimizer.optimized_asm:
-                f.write(f"{line}" + "\n")
+        asm = translate(
+            read_sources(inputpath),
+            bootstrap=False,
+            cache=cache,
+            stats=stats,
+            opt=args.opt,
+            rom_budget=args.rom_budget,
+            tos_cache=args.tos_cache,
+            virtual_sp=args.virtual_sp,
+            static_frames=args.static_frames,
+            tree_shaking=not args.no_tree_shaking,
+            max_inline_instructions=args.inline_functions,
+        )
+    with open(output_path, "w") as f:
+        for line in asm:
+            f.write(line + "\n")
+    if args.stats:
+        print(stats.summary())
+        if cache:
+            print(cache.summary())
+    words = stats.levels[-1][1]
+    if words > args.rom_budget:
+        print(
+            f"{output_path} has {words} words, over the ROM budget of "
+            f"{args.rom_budget} even with --opt=size. Largest functions:",
+            file=sys.stderr,
+        )
+        print("\n".join(stats.top_contributions()), file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":